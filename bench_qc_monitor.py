@@ -0,0 +1,248 @@
+import os
+import argparse
+import json
+import random
+import resource
+import shutil
+import sqlite3
+import tempfile
+import time
+
+from multiprocessing import Process, Queue
+
+import numpy as np
+
+from protocol_qc_monitor import QCMonitor
+
+SCALES = [1000, 10000, 100000]
+FRAMES = 40
+
+# (label_property, value for the i-th movie) for each synthetic set database
+MOVIE_COLUMNS = [
+    ('_filename', lambda i: 'Runs/import/extra/movie_%06d.mrcs' % i),
+    ('_samplingRate', lambda i: 1.06),
+    ('_acquisition._magnification', lambda i: 47170.0),
+    ('_acquisition._voltage', lambda i: 300.0),
+    ('_acquisition._dosePerFrame', lambda i: 1.2),
+]
+MICROGRAPH_COLUMNS = [
+    ('_filename',
+     lambda i: 'Runs/align/extra/movie_%06d_aligned_mic.mrc' % i),
+    ('_samplingRate', lambda i: 1.06),
+]
+CTF_COLUMNS = [
+    ('_micObj._filename',
+     lambda i: 'Runs/align/extra/movie_%06d_aligned_mic.mrc' % i),
+    ('_defocusU', lambda i: 15000.0 + (i % 97) * 100),
+    ('_defocusV', lambda i: 14500.0 + (i % 89) * 100),
+    ('_defocusAngle', lambda i: float(i % 180)),
+    ('_gctf_crossCorrelation', lambda i: 0.05 + (i % 13) / 100.0),
+]
+DATABASES = [
+    ('movies.sqlite', MOVIE_COLUMNS),
+    ('micrographs.sqlite', MICROGRAPH_COLUMNS),
+    ('ctfs.sqlite', CTF_COLUMNS),
+]
+
+
+class _BenchmarkProject(object):
+
+    def __init__(self, path):
+        self.path = path
+
+
+class _BenchmarkProtocol(object):
+    '''
+    Stand-in for ProtQCSummary with no input protocols
+    '''
+    inputProtocols = []
+
+    def __init__(self, path):
+        self._project = _BenchmarkProject(path)
+
+    def getProject(self):
+        return self._project
+
+
+def create_set_database(sqlite_file, columns):
+    '''
+    Creates an empty database with the Classes/Objects layout of a Scipion
+    set
+    '''
+    connection = sqlite3.connect(sqlite_file)
+    connection.execute(
+        'CREATE TABLE Classes (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+        'label_property TEXT UNIQUE, column_name TEXT UNIQUE, '
+        'class_name TEXT DEFAULT NULL)')
+    connection.execute(
+        'CREATE TABLE Objects (id INTEGER PRIMARY KEY, enabled INTEGER '
+        'DEFAULT 1, label TEXT DEFAULT NULL, comment TEXT DEFAULT NULL, '
+        'creation DATE, {})'.format(', '.join(
+            'c%02d' % (i + 1) for i in range(len(columns)))))
+    connection.executemany(
+        'INSERT INTO Classes (label_property, column_name, class_name) '
+        'VALUES (?, ?, ?)',
+        [(label, 'c%02d' % (i + 1), 'Float')
+         for i, (label, _) in enumerate(columns)])
+    connection.commit()
+    connection.close()
+
+
+def append_set_rows(sqlite_file, columns, start, stop):
+    connection = sqlite3.connect(sqlite_file)
+    connection.executemany(
+        'INSERT INTO Objects (id, creation, {}) VALUES (?, ?, {})'.format(
+            ', '.join('c%02d' % (i + 1) for i in range(len(columns))),
+            ', '.join('?' for _ in columns)),
+        ((i + 1, '2016-01-01 00:00:00') + tuple(f(i) for _, f in columns)
+         for i in range(start, stop)))
+    connection.commit()
+    connection.close()
+
+
+def write_epa_file(epa_file, points=500):
+    resolutions = np.linspace(20.0, 2.0, points)
+    ccc = np.clip(1.1 - np.linspace(0.0, 1.2, points), -0.2, 1.0)
+    with open(epa_file, 'w') as OUTPUT:
+        OUTPUT.write('Resolution CTFSim EPA EPABg CCC\n')
+        for resolution, c in zip(resolutions, ccc):
+            OUTPUT.write('{} {} {} {} {}\n'.format(
+                resolution, abs(np.sin(1.0 / resolution)),
+                random.random(), random.random(), c))
+
+
+def synthetic_shifts(count, frames=FRAMES, seed=0):
+    rng = np.random.RandomState(seed)
+    steps = rng.normal(0.0, 0.5, size=(2, count, frames))
+    steps[:, :, :frames // 4] *= 4  # Early frames drift most
+    shifts = np.cumsum(steps, axis=2)
+    return list(shifts[0]), list(shifts[1])
+
+
+def peak_rss_mb():
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def _timed(timings, name, function, *args):
+    start = time.time()
+    function(*args)
+    timings[name] = time.time() - start
+
+
+def run_tick(monitor, directory, first, last, render_sample):
+    '''
+    Runs the parts of a QCMonitor tick over movies [first, last) and
+    returns their wall times
+    '''
+    timings = dict()
+    names = ['movie_%06d' % i for i in range(first, last)]
+
+    start = time.time()
+    for db, _ in DATABASES:
+        monitor.read_txt_fields_from_sqlite(os.path.join(directory, db))
+    timings['sqlite'] = time.time() - start
+
+    x_shifts, y_shifts = synthetic_shifts(len(names), seed=first)
+    _timed(timings, 'drift', monitor.set_drift_metrics,
+           x_shifts, y_shifts, names)
+
+    start = time.time()
+    for name in names:
+        monitor.set_defocus_delta(name)
+    timings['defocus'] = time.time() - start
+
+    epa_file = os.path.join(directory, 'sample_EPA.txt')
+    start = time.time()
+    for i in range(min(render_sample, len(names))):
+        monitor.generateEPAPlot(epa_file, os.path.join(
+            directory, 'extra', '%s_EPAplot.png' % names[i]))
+    timings['render'] = time.time() - start
+
+    _timed(timings, 'csv', monitor.write_txt_file)
+    timings['total'] = sum(timings.values())
+    return timings
+
+
+def benchmark_scale(count, increment, render_sample, result_queue):
+    directory = tempfile.mkdtemp(prefix='qc_bench_')
+    try:
+        os.makedirs(os.path.join(directory, 'extra'))
+        write_epa_file(os.path.join(directory, 'sample_EPA.txt'))
+
+        start = time.time()
+        for db, columns in DATABASES:
+            sqlite_file = os.path.join(directory, db)
+            create_set_database(sqlite_file, columns)
+            append_set_rows(sqlite_file, columns, 0, count)
+        setup = time.time() - start
+
+        monitor = QCMonitor(_BenchmarkProtocol(directory),
+                            workingDir=directory, samplingInterval=0,
+                            monitorTime=0)
+
+        cold = run_tick(monitor, directory, 0, count, render_sample)
+
+        for db, columns in DATABASES:
+            append_set_rows(os.path.join(directory, db), columns,
+                            count, count + increment)
+        incremental = run_tick(monitor, directory, count,
+                               count + increment, render_sample)
+
+        result_queue.put({
+            'movies': count,
+            'increment': increment,
+            'setup': setup,
+            'cold': cold,
+            'incremental': incremental,
+            'peak_rss_mb': peak_rss_mb(),
+        })
+    except Exception as e:
+        result_queue.put({'movies': count, 'error': repr(e)})
+        raise
+    finally:
+        shutil.rmtree(directory)
+
+
+def format_result(result):
+    phases = ['sqlite', 'drift', 'defocus', 'render', 'csv', 'total']
+    lines = ['{} movies (+{} incremental), peak RSS {:.1f} MB'.format(
+        result['movies'], result['increment'], result['peak_rss_mb'])]
+    for tick in ['cold', 'incremental']:
+        lines.append('  {:<12} '.format(tick) + '  '.join(
+            '{} {:.3f}s'.format(p, result[tick][p]) for p in phases))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark QCMonitor tick phases on synthetic sessions')
+    parser.add_argument('--scales', type=int, nargs='+', default=SCALES,
+                        help='Numbers of movies to simulate')
+    parser.add_argument('--increment', type=float, default=0.01,
+                        help='Fraction of new movies in the incremental tick')
+    parser.add_argument('--render_sample', type=int, default=5,
+                        help='EPA plots rendered per tick')
+    parser.add_argument('--json', type=str, default=None,
+                        help='Also write results as JSON lines to this file')
+    args = parser.parse_args()
+
+    for count in args.scales:
+        # Each scale runs in its own process so peak RSS is per scale
+        queue = Queue()
+        process = Process(target=benchmark_scale, args=(
+            count, max(1, int(count * args.increment)),
+            args.render_sample, queue))
+        process.start()
+        result = queue.get()
+        process.join()
+
+        if 'error' in result:
+            print('{} movies: failed with {}'.format(
+                count, result['error']))
+            continue
+        print(format_result(result))
+        if args.json:
+            with open(args.json, 'a') as OUTPUT:
+                OUTPUT.write(json.dumps(result, sort_keys=True) + '\n')
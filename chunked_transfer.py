@@ -0,0 +1,106 @@
+import os
+import hashlib
+import posixpath
+
+from ssh_pool import quote
+
+CHUNK_SIZE = 64 * 1024 * 1024
+
+
+def partial_name(remote_path):
+    '''
+    Hidden name a chunked transfer is assembled under
+    '''
+    directory, name = posixpath.split(remote_path)
+    return posixpath.join(directory, '.{}.part'.format(name))
+
+
+class ChunkedSender(object):
+    '''
+    Sends files in fixed-size chunks that survive interruptions.
+
+    Each chunk is written in place into a partial remote file with dd and
+    read back through md5sum in the same remote command; a chunk is
+    acknowledged in the ledger only when the remote checksum matches the
+    local one. A later attempt re-reads the file locally, to compute the
+    whole-file checksum and to check that acknowledged chunks are unchanged,
+    but only sends the chunks that were not acknowledged. The partial file
+    is renamed to its final name once its whole checksum matches.
+    '''
+
+    def __init__(self, pool, ledger, chunk_size=CHUNK_SIZE, bucket=None):
+        self.pool = pool
+        self.ledger = ledger
+        self.chunk_size = chunk_size
+        self.bucket = bucket
+
+    def _remote_size(self, path):
+        status, output = self.pool.run(
+            'stat -c %s {} 2>/dev/null || echo -1'.format(quote(path)))
+        try:
+            return int(output.strip())
+        except ValueError:
+            return -1
+
+    def _send_chunk(self, data, path, offset):
+        '''
+        Writes data at offset of the remote path; returns the MD5 of what
+        the remote has there afterwards
+        '''
+        status, output = self.pool.run(
+            'dd of={0} bs=1M seek={1} oflag=seek_bytes conv=notrunc '
+            'status=none && dd if={0} bs=1M skip={1} count={2} '
+            'iflag=skip_bytes,count_bytes status=none | md5sum'.format(
+                quote(path), offset, len(data)),
+            stdin=data)
+        if status != 0:
+            return None
+        return output.split()[0].decode('ascii') if output else None
+
+    def send(self, source, destination, local_file, remote_path):
+        '''
+        Sends local_file to remote_path, resuming an earlier attempt;
+        source and destination key the attempt in the ledger. Returns
+        (bytes sent over the network, md5 of the file) or None on failure.
+        '''
+        part_path = partial_name(remote_path)
+        size = os.path.getsize(local_file)
+        acknowledged = self.ledger.acknowledged_chunks(
+            source, destination, size, self.chunk_size)
+        if acknowledged and self._remote_size(part_path) < 0:
+            #  The partial file is gone, so start from scratch
+            self.ledger.clear_chunks(source, destination)
+            acknowledged = dict()
+
+        md5 = hashlib.md5()
+        sent = 0
+        chunks = max(1, -(-size // self.chunk_size))
+        with open(local_file, 'rb') as INPUT:
+            for chunk in range(chunks):
+                data = INPUT.read(self.chunk_size)
+                md5.update(data)
+                checksum = hashlib.md5(data).hexdigest()
+                if acknowledged.get(chunk) != checksum:
+                    if self.bucket is not None:
+                        self.bucket.consume(len(data))
+                    if self._send_chunk(
+                            data, part_path,
+                            chunk * self.chunk_size) != checksum:
+                        return None
+                    self.ledger.acknowledge_chunk(
+                        source, destination, size, self.chunk_size, chunk,
+                        checksum)
+                    sent += len(data)
+
+        checksum = md5.hexdigest()
+        status, output = self.pool.run(
+            'truncate -s {1} {0} && '
+            'test "$(md5sum < {0} | cut -d" " -f1)" = {2} && '
+            'mv -f {0} {3}'.format(
+                quote(part_path), size, checksum, quote(remote_path)))
+        self.ledger.clear_chunks(source, destination)
+        if status != 0:
+            #  Whole-file mismatch: the next attempt sends every chunk
+            self.pool.run('rm -f {}'.format(quote(part_path)))
+            return None
+        return sent, checksum
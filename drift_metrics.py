@@ -0,0 +1,102 @@
+import numpy as np
+
+DRIFT_FIELDS = [
+    'Average Drift',
+    'Maximum Drift',
+    'Path Length',
+    'Early Drift',
+    'Late Drift',
+    'Jitter',
+]
+
+# Fraction of frame-to-frame steps counted as "early" motion
+EARLY_FRACTION = 0.25
+
+
+def _pad(shift_lists):
+    '''
+    Stacks shift sequences of different lengths into a NaN-padded array
+    '''
+    n_frames = max([len(s) for s in shift_lists] or [0])
+    padded = np.full((len(shift_lists), n_frames), np.nan)
+    for i, shifts in enumerate(shift_lists):
+        padded[i, :len(shifts)] = shifts
+    return padded
+
+
+def _masked_mean(values, mask, counts):
+    totals = np.where(mask, values, 0.0).sum(axis=1)
+    return np.where(counts > 0, totals / np.maximum(counts, 1), 0.0)
+
+
+def frame_steps(x_shifts, y_shifts):
+    '''
+    Converts cumulative shifts into frame-to-frame (non-cumulative) shifts
+    '''
+    return (np.diff(np.asarray(x_shifts, dtype=float)),
+            np.diff(np.asarray(y_shifts, dtype=float)))
+
+
+def compute_drift_metrics_batch(x_shift_lists, y_shift_lists,
+                                early_fraction=EARLY_FRACTION):
+    '''
+    Computes all drift metrics for a batch of movies in a single pass.
+
+    Takes one sequence of cumulative x and y shifts per movie and returns a
+    dict mapping each name in DRIFT_FIELDS to an array with one value per
+    movie.
+    '''
+    x = _pad(x_shift_lists)
+    y = _pad(y_shift_lists)
+    n_movies, n_frames = x.shape
+
+    frames = np.array([len(s) for s in x_shift_lists], dtype=int)
+    steps = np.maximum(frames - 1, 0)
+    accels = np.maximum(frames - 2, 0)
+
+    #  Absolute drift of each frame relative to the reference
+    absolute = np.hypot(x, y)
+    valid = np.arange(n_frames)[None, :] < frames[:, None]
+    average = _masked_mean(absolute, valid, frames)
+    maximum = np.where(valid, absolute, -np.inf).max(axis=1) \
+        if n_frames else np.zeros(n_movies)
+    maximum = np.where(frames > 0, maximum, 0.0)
+
+    #  Frame-to-frame motion
+    step_lengths = np.hypot(np.diff(x, axis=1), np.diff(y, axis=1))
+    step_index = np.arange(step_lengths.shape[1])[None, :]
+    step_valid = step_index < steps[:, None]
+    path_length = np.where(step_valid, step_lengths, 0.0).sum(axis=1)
+
+    early_steps = np.where(
+        steps > 0,
+        np.maximum(1, np.ceil(steps * early_fraction)).astype(int),
+        0,
+    )
+    early_mask = step_index < early_steps[:, None]
+    late_mask = step_valid & ~early_mask
+    early = _masked_mean(step_lengths, early_mask, early_steps)
+    late = _masked_mean(step_lengths, late_mask, steps - early_steps)
+
+    #  Jitter: RMS frame-to-frame change in velocity
+    accel = np.hypot(np.diff(x, n=2, axis=1), np.diff(y, n=2, axis=1)) ** 2
+    accel_valid = np.arange(accel.shape[1])[None, :] < accels[:, None]
+    jitter = np.sqrt(_masked_mean(accel, accel_valid, accels))
+
+    return {
+        'Average Drift': average,
+        'Maximum Drift': maximum,
+        'Path Length': path_length,
+        'Early Drift': early,
+        'Late Drift': late,
+        'Jitter': jitter,
+    }
+
+
+def compute_drift_metrics(x_shifts, y_shifts, early_fraction=EARLY_FRACTION):
+    '''
+    Computes all drift metrics for a single movie
+    '''
+    metrics = compute_drift_metrics_batch(
+        [x_shifts], [y_shifts], early_fraction=early_fraction)
+    return dict((key, float(values[0])) for key, values in metrics.items())
@@ -0,0 +1,79 @@
+import os
+import threading
+
+from watchdog.observers import Observer
+from watchdog.events import FileSystemEventHandler
+
+SET_DATABASES = [
+    'movies.sqlite',
+    'micrographs.sqlite',
+    'ctfs.sqlite',
+]
+
+
+class InputWatcher(FileSystemEventHandler):
+    '''
+    Watches the set databases and output directories of input protocols and
+    records which protocols have changed since the last call to pop_changed
+    '''
+
+    def __init__(self):
+        FileSystemEventHandler.__init__(self)
+        self.observer = Observer()
+        self.changed = threading.Event()
+        self._lock = threading.Lock()
+        self._changed_keys = set()
+        self._watched_files = dict()  # Absolute path -> key
+        self._watched_dirs = dict()  # Absolute directory -> key
+
+    def watch_protocol(self, key, protocol_dir, output_dirs=()):
+        '''
+        Watches the set databases in protocol_dir and any file in output_dirs
+        '''
+        protocol_dir = os.path.abspath(protocol_dir)
+        for db in SET_DATABASES:
+            self._watched_files[os.path.join(protocol_dir, db)] = key
+        self._schedule(protocol_dir)
+
+        for d in output_dirs:
+            d = os.path.abspath(d)
+            self._watched_dirs[d] = key
+            self._schedule(d)
+
+    def _schedule(self, directory):
+        if os.path.isdir(directory):
+            self.observer.schedule(self, path=directory, recursive=False)
+
+    def _match(self, path):
+        path = os.path.abspath(path)
+        if path in self._watched_files:
+            return self._watched_files[path]
+        return self._watched_dirs.get(os.path.dirname(path))
+
+    def on_any_event(self, event):
+        paths = [event.src_path, getattr(event, 'dest_path', None)]
+        keys = set(self._match(p) for p in paths if p) - set([None])
+        if keys:
+            with self._lock:
+                self._changed_keys.update(keys)
+            self.changed.set()
+
+    def wait(self, timeout):
+        '''
+        Blocks until a watched input changes or timeout seconds pass
+        '''
+        return self.changed.wait(timeout)
+
+    def pop_changed(self):
+        with self._lock:
+            self.changed.clear()
+            keys = self._changed_keys
+            self._changed_keys = set()
+        return keys
+
+    def start(self):
+        self.observer.start()
+
+    def stop(self):
+        self.observer.stop()
+        self.observer.join()
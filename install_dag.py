@@ -0,0 +1,229 @@
+import os
+import sys
+import time
+import traceback
+
+LOG_DIR = os.path.join('software', 'log')
+
+
+def _name(dep):
+    return dep if isinstance(dep, str) else dep.getName()
+
+
+def _build(target, log_file):
+    '''
+    Runs in the forked process of one target, so that the commands
+    changing directory do not affect the others
+    '''
+    if log_file is not None:
+        fd = os.open(log_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(fd, 1)
+        os.dup2(fd, 2)
+        os.close(fd)
+    try:
+        target.execute()
+    except BaseException:
+        traceback.print_exc()
+        sys.stdout.flush()
+        os._exit(1)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(0)
+
+
+def format_time(seconds):
+    if seconds < 60:
+        return '%.1f s' % seconds
+    return '%d m %02d s' % (seconds / 60, int(seconds) % 60)
+
+
+class ParallelBuild(object):
+    '''
+    Builds the install targets as a dependency DAG, optionally running
+    independent ones at the same time.
+
+    The -j processors are the job budget: up to parallel targets are built
+    at once and each gets processors // parallel of them, which is what
+    env.getProcessors() returns to the targets defined after this object
+    is created. The share is fixed, so a long chain of targets that follow
+    each other builds with fewer processors than it would alone; building
+    several at once is therefore opt-in with --parallel-targets=N, and by
+    default parallel is 1, each target getting all -j processors. Each
+    target is built in a forked process with its output in
+    software/log/<target>.log when several run at once. Ready targets
+    with the longest chain of dependents are started first. At the end, a
+    critical-path report shows which chain of targets set the install
+    time.
+    '''
+
+    def __init__(self, env, args, log_dir=LOG_DIR):
+        self.env = env
+        self.log_dir = log_dir
+        self.jobs = env.getProcessors()
+        self.parallel = 1
+        for arg in args:
+            if arg.startswith('--parallel-targets='):
+                self.parallel = int(arg.split('=', 1)[1])
+        self.parallel = max(1, min(self.parallel, self.jobs))
+        if getattr(env, 'showOnly', False):
+            self.parallel = 1
+        self.share = max(1, self.jobs // self.parallel)
+
+        env.getProcessors = lambda: self.share
+        self.times = dict()  # Target name -> (start, end)
+        self.started = None
+
+    def execute(self):
+        '''
+        Replaces env.execute(), which still picks the targets to build
+        '''
+        self.env._executeTargets = self.build
+        self.env.execute()
+
+    def _graph(self, targets):
+        '''
+        Returns the targets to build, in definition order, and the
+        dependency names of each, checking for cycles
+        '''
+        deps = dict()
+        order = []
+        state = dict()  # Name -> 1 while exploring, 2 once done
+
+        def visit(target):
+            name = target.getName()
+            if state.get(name) == 2:
+                return
+            if state.get(name) == 1:
+                raise RuntimeError('Cyclic dependency on %s' % name)
+            state[name] = 1
+            deps[name] = [_name(d) for d in target.getDeps()]
+            for dep in deps[name]:
+                visit(self.env.getTarget(dep))
+            state[name] = 2
+            order.append(target)
+
+        for target in targets:
+            visit(target)
+        return order, deps
+
+    @staticmethod
+    def _heights(order, deps):
+        '''
+        Length of the longest chain of targets depending on each target
+        '''
+        heights = dict((t.getName(), 0) for t in order)
+        for target in reversed(order):
+            name = target.getName()
+            for dep in deps[name]:
+                heights[dep] = max(heights[dep], heights[name] + 1)
+        return heights
+
+    def build(self, targets):
+        order, deps = self._graph(targets)
+        heights = self._heights(order, deps)
+        position = dict((t.getName(), i) for i, t in enumerate(order))
+        if self.parallel > 1 and not os.path.isdir(self.log_dir):
+            os.makedirs(self.log_dir)
+        print('Building %d targets, %d at a time with -j %d each.'
+              % (len(order), self.parallel, self.share))
+
+        pending = dict((t.getName(), t) for t in order)
+        running = dict()  # Process id -> target name
+        done = set()
+        failed = []
+        self.started = time.time()
+        while pending or running:
+            if not failed:
+                ready = sorted(
+                    [n for n in pending if set(deps[n]) <= done],
+                    key=lambda n: (-heights[n], position[n]))
+                for name in ready[:self.parallel - len(running)]:
+                    running[self._start(pending.pop(name))] = name
+            if not running:
+                break  # Only targets after a failure are left
+            pid, status = os.wait()
+            name = running.pop(pid)
+            self.times[name] = (self.times[name][0], time.time())
+            if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+                done.add(name)
+                print('Done %s (%s)' % (name, format_time(
+                    self.times[name][1] - self.times[name][0])))
+            else:
+                failed.append(name)
+                self._reportFailure(name)
+
+        self.report(deps, time.time() - self.started)
+        if failed:
+            raise RuntimeError('Failed to build: %s. Not built: %s.' % (
+                ', '.join(failed), ', '.join(sorted(pending)) or 'none'))
+
+    def _logFile(self, name):
+        if self.parallel == 1:
+            return None
+        return os.path.join(self.log_dir, '%s.log' % name)
+
+    def _start(self, target):
+        name = target.getName()
+        log_file = self._logFile(name)
+        if log_file is not None:
+            print('Building %s ... (log in %s)' % (name, log_file))
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self.times[name] = (time.time(), None)
+        pid = os.fork()
+        if pid == 0:
+            _build(target, log_file)
+        return pid
+
+    def _reportFailure(self, name):
+        log_file = self._logFile(name)
+        print('ERROR building %s.' % name)
+        if log_file is not None and os.path.exists(log_file):
+            with open(log_file) as f:
+                lines = f.readlines()[-20:]
+            print('Last lines of %s:' % log_file)
+            sys.stdout.write(''.join('    ' + line for line in lines))
+
+    def criticalPath(self, deps):
+        '''
+        Walks back from the target that finished last, each time to the
+        dependency that finished last, and returns [(name, seconds
+        building, seconds waiting for a free slot after its dependencies)]
+        '''
+        built = dict((n, t) for n, t in self.times.items()
+                     if t[1] is not None)
+        if not built:
+            return []
+        path = []
+        name = max(built, key=lambda n: built[n][1])
+        while name is not None:
+            start, end = built[name]
+            last = [d for d in deps[name] if d in built]
+            previous = max(last, key=lambda d: built[d][1]) if last else None
+            ready = built[previous][1] if previous else self.started
+            path.append((name, end - start, max(0., start - ready)))
+            name = previous
+        return path[::-1]
+
+    def report(self, deps, wall):
+        '''
+        Prints the critical path: the chain of targets whose build times,
+        plus any wait for a free slot, add up to the install time
+        '''
+        path = self.criticalPath(deps)
+        if not path:
+            return
+        busy = sum(end - start for start, end in self.times.values()
+                   if end is not None)
+        print('')
+        print('Critical path (%s of %s wall time; %.1f targets built on '
+              'average at once):' % (
+                  format_time(sum(p[1] + p[2] for p in path)),
+                  format_time(wall), busy / wall if wall else 0.))
+        for name, seconds, waited in path:
+            line = '  %-20s %10s' % (name, format_time(seconds))
+            if waited >= 1:
+                line += '  (waited %s for a slot)' % format_time(waited)
+            print(line)
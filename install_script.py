@@ -26,12 +26,19 @@
 import os
 import sys
 from install.funcs import Environment, progInPath
+from install_dag import ParallelBuild
 
 get = lambda x: os.environ.get(x, 'y').lower() in ['true', 'yes', 'y', '1']
 
 
 env = Environment(args=sys.argv)
 
+# Targets are built in dependency order, one at a time with all the -j
+# processors unless --parallel-targets=N builds up to N independent ones
+# at once, each with a fixed share of them; this must come before the
+# targets are defined
+build = ParallelBuild(env, sys.argv)
+
 noOpencv = '--no-opencv' in sys.argv or not get('OPENCV')
 noScipy = '--no-scipy' in sys.argv or not get('SCIPY')
 
@@ -477,4 +484,4 @@ env.addPackage('gEMpicker_v1.1',
                default=False)
 
 
-env.execute()
+build.execute()
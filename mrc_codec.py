@@ -0,0 +1,326 @@
+import os
+import argparse
+import struct
+import time
+import zlib
+from collections import deque
+from io import BytesIO
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+from parallel_gzip import CompressionStats, gzip_member, write_atomically
+
+MAGIC = b'MRCZ\x01'
+MRC_HEADER_SIZE = 1024
+CHUNK_VALUES = 8 * 1024 * 1024
+
+#  MRC mode -> numpy type; other modes are stored as deflated raw bytes
+MRC_MODES = {
+    0: np.int8,
+    1: np.int16,
+    2: np.float32,
+    6: np.uint16,
+    12: np.float16,
+}
+
+PACK_BITS = (1, 2, 4, 8, 16, 32)
+
+RAW = 0
+PACKED = 1
+END = 255
+
+#  kind, bits, minimum, original bytes, payload bytes
+CHUNK_HEADER = struct.Struct('<BBqQQ')
+
+
+class MRCHeader(object):
+
+    def __init__(self, raw):
+        #  Machine stamp 0x11 0x11 marks big-endian files
+        self.byte_order = '>' if raw[212:213] == b'\x11' else '<'
+        self.nx, self.ny, self.nz, self.mode = struct.unpack(
+            self.byte_order + '4i', raw[:16])
+        self.extended = struct.unpack(self.byte_order + 'i', raw[92:96])[0]
+
+    @property
+    def dtype(self):
+        if self.mode not in MRC_MODES:
+            return None
+        return np.dtype(MRC_MODES[self.mode]).newbyteorder(self.byte_order)
+
+    @property
+    def data_size(self):
+        dtype = self.dtype
+        if dtype is None:
+            return None
+        return self.nx * self.ny * self.nz * dtype.itemsize
+
+
+def read_header(fileobj):
+    raw = fileobj.read(MRC_HEADER_SIZE)
+    if len(raw) < MRC_HEADER_SIZE:
+        raise ValueError('Not an MRC file')
+    header = MRCHeader(raw)
+    if min(header.nx, header.ny, header.nz) <= 0 or header.extended < 0:
+        raise ValueError('Not an MRC file')
+    return header, raw + fileobj.read(header.extended)
+
+
+def to_bytes(array):
+    '''
+    Bytes of array in C order; tobytes() only exists from numpy 1.9 and
+    Scipion installs numpy 1.8
+    '''
+    if hasattr(array, 'tobytes'):
+        return array.tobytes()
+    return array.tostring()
+
+
+def as_integers(values):
+    '''
+    Returns values as int64 if that loses nothing, otherwise None.
+
+    Floats must be finite and whole, and must not contain -0.0, which
+    compares equal to 0 but would come back as +0.0.
+    '''
+    if values.dtype.kind in 'iu':
+        return values.astype(np.int64)
+    if not np.all(np.isfinite(values)) or \
+            np.any(np.signbit(values) & (values == 0)):
+        return None
+    if len(values) and float(np.abs(values).max()) >= 2 ** 31:
+        return None
+    integers = values.astype(np.int64)
+    if not np.array_equal(integers.astype(values.dtype), values):
+        return None
+    return integers
+
+
+def pack_bits(values, bits):
+    '''
+    Packs non-negative values below 2 ** bits into a byte string
+    '''
+    if bits >= 8:
+        packed = values.astype('<u{}'.format(bits // 8))
+        #  Shuffle so the bytes of equal significance sit together
+        return to_bytes(packed.view(np.uint8).reshape(-1, bits // 8).T)
+    per_byte = 8 // bits
+    padded = np.zeros(-(-len(values) // per_byte) * per_byte, np.uint8)
+    padded[:len(values)] = values
+    padded = padded.reshape(-1, per_byte)
+    packed = np.zeros(len(padded), np.uint8)
+    for i in range(per_byte):
+        packed |= padded[:, i] << (bits * i)
+    return to_bytes(packed)
+
+
+def unpack_bits(data, bits, count):
+    if bits >= 8:
+        width = bits // 8
+        shuffled = np.frombuffer(data, np.uint8).reshape(width, -1)
+        return shuffled.T.copy().view('<u{}'.format(width)).ravel()[:count]
+    per_byte = 8 // bits
+    packed = np.frombuffer(data, np.uint8)
+    values = np.empty((len(packed), per_byte), np.uint8)
+    for i in range(per_byte):
+        values[:, i] = (packed >> (bits * i)) & ((1 << bits) - 1)
+    return values.ravel()[:count]
+
+
+def encode_chunk(data, dtype, level=6):
+    '''
+    Encodes the bytes of one chunk of voxels, packed if they are integers
+    '''
+    if dtype is not None and len(data) % dtype.itemsize == 0:
+        integers = as_integers(np.frombuffer(data, dtype))
+        if integers is not None and len(integers):
+            minimum = int(integers.min())
+            span = int(integers.max()) - minimum
+            bits = [b for b in PACK_BITS if span < 2 ** b]
+            if bits:
+                payload = zlib.compress(
+                    pack_bits(integers - minimum, bits[0]), level)
+                return CHUNK_HEADER.pack(
+                    PACKED, bits[0], minimum, len(data),
+                    len(payload)) + payload
+    payload = zlib.compress(data, level)
+    return CHUNK_HEADER.pack(RAW, 0, 0, len(data), len(payload)) + payload
+
+
+def decode_chunk(kind, bits, minimum, size, payload, dtype):
+    data = zlib.decompress(payload)
+    if kind == RAW:
+        return data
+    count = size // dtype.itemsize
+    values = unpack_bits(data, bits, count).astype(np.int64) + minimum
+    return to_bytes(values.astype(dtype))
+
+
+def iter_encoded(fileobj, level=6, threads=4, chunk_values=CHUNK_VALUES):
+    '''
+    Yields the .mrcz encoding of the MRC file in fileobj.
+
+    The header is stored as is, followed by the voxel data in chunks of
+    chunk_values. Each chunk whose values are all integers is shifted by
+    its minimum, bit-packed to the narrowest of 1, 2, 4, 8, 16 or 32 bits,
+    byte-shuffled and deflated; any other chunk, and anything after the
+    data, is deflated as it is. Chunks are encoded on a thread pool.
+    '''
+    header, raw_header = read_header(fileobj)
+    dtype = header.dtype
+    itemsize = dtype.itemsize if dtype is not None else 1
+
+    compressed = zlib.compress(raw_header, level)
+    yield MAGIC + struct.pack('<Q', len(compressed)) + compressed
+
+    pool = ThreadPool(max(1, threads))
+    pending = deque()
+    remaining = header.data_size
+    try:
+        while True:
+            if remaining is None:
+                data = fileobj.read(chunk_values)
+                chunk_dtype = None
+            elif remaining > 0:
+                data = fileobj.read(min(remaining, chunk_values * itemsize))
+                remaining -= len(data)
+                chunk_dtype = dtype
+            else:
+                #  Whatever follows the voxel data
+                data = fileobj.read(chunk_values)
+                chunk_dtype = None
+            if not data:
+                break
+            pending.append(pool.apply_async(
+                encode_chunk, (data, chunk_dtype, level)))
+            if len(pending) >= 2 * max(1, threads):
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+    yield CHUNK_HEADER.pack(END, 0, 0, 0, 0)
+
+
+def _read_exactly(fileobj, size):
+    data = fileobj.read(size)
+    if len(data) != size:
+        raise ValueError('Truncated .mrcz file')
+    return data
+
+
+def iter_decoded(fileobj):
+    '''
+    Yields the bytes of the original MRC file from a .mrcz stream
+    '''
+    if _read_exactly(fileobj, len(MAGIC)) != MAGIC:
+        raise ValueError('Not a .mrcz file')
+    size = struct.unpack('<Q', _read_exactly(fileobj, 8))[0]
+    raw_header = zlib.decompress(_read_exactly(fileobj, size))
+    dtype = MRCHeader(raw_header).dtype
+    yield raw_header
+
+    while True:
+        kind, bits, minimum, size, length = CHUNK_HEADER.unpack(
+            _read_exactly(fileobj, CHUNK_HEADER.size))
+        if kind == END:
+            return
+        yield decode_chunk(kind, bits, minimum, size,
+                           _read_exactly(fileobj, length), dtype)
+
+
+def encode_file(source, destination, level=6, threads=4):
+    '''
+    Writes source as .mrcz to destination; returns CompressionStats
+    '''
+    stats = CompressionStats()
+    stats.input_bytes = os.path.getsize(source)
+    with open(source, 'rb') as INPUT:
+        write_atomically(iter_encoded(INPUT, level, threads), destination,
+                         stats)
+    stats.finish()
+    return stats
+
+
+def decode_file(source, destination):
+    with open(source, 'rb') as INPUT:
+        write_atomically(iter_decoded(INPUT), destination)
+
+
+def is_packable(path):
+    '''
+    True if path is an MRC file whose first frame is integer-valued, i.e.
+    one the codec is expected to compress better than gzip
+    '''
+    try:
+        with open(path, 'rb') as INPUT:
+            header, _ = read_header(INPUT)
+            dtype = header.dtype
+            if dtype is None:
+                return False
+            frame = INPUT.read(header.nx * header.ny * dtype.itemsize)
+    except (IOError, ValueError, struct.error):
+        return False
+    values = np.frombuffer(frame[:len(frame) // dtype.itemsize *
+                                 dtype.itemsize], dtype)
+    return len(values) > 0 and as_integers(values) is not None
+
+
+def benchmark(path, level=6, threads=4):
+    '''
+    Compares ratio and speed of the codec with gzip on one file, checking
+    that the codec round trip is byte-identical
+    '''
+    size = os.path.getsize(path)
+    results = dict()
+
+    start = time.time()
+    gzip_size = 0
+    with open(path, 'rb') as INPUT:
+        for block in iter(lambda: INPUT.read(4 * 1024 * 1024), b''):
+            gzip_size += len(gzip_member(block, level))
+    results['gzip'] = (size / float(gzip_size), time.time() - start)
+
+    start = time.time()
+    with open(path, 'rb') as INPUT:
+        encoded = b''.join(iter_encoded(INPUT, level, threads))
+    results['mrcz'] = (size / float(len(encoded)), time.time() - start)
+
+    with open(path, 'rb') as INPUT:
+        original = INPUT.read()
+    if b''.join(iter_decoded(BytesIO(encoded))) != original:
+        raise AssertionError('Round trip of {} differs'.format(path))
+    return size, results
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Lossless MRC movie codec (.mrcz)')
+    subparsers = parser.add_subparsers(dest='command')
+    encode = subparsers.add_parser('encode')
+    encode.add_argument('input')
+    encode.add_argument('output')
+    encode.add_argument('--level', type=int, default=6)
+    encode.add_argument('--threads', type=int, default=4)
+    decode = subparsers.add_parser('decode')
+    decode.add_argument('input')
+    decode.add_argument('output')
+    bench = subparsers.add_parser('bench')
+    bench.add_argument('inputs', nargs='+')
+    bench.add_argument('--level', type=int, default=6)
+    bench.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+
+    if args.command == 'encode':
+        print(encode_file(args.input, args.output, args.level, args.threads))
+    elif args.command == 'decode':
+        decode_file(args.input, args.output)
+    elif args.command == 'bench':
+        for path in args.inputs:
+            size, results = benchmark(path, args.level, args.threads)
+            for codec, (ratio, seconds) in sorted(results.items()):
+                print('{} {}: ratio {:.2f}, {:.1f} MB/s'.format(
+                    os.path.basename(path), codec, ratio,
+                    size / 1024. / 1024. / seconds))
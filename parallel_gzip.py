@@ -0,0 +1,126 @@
+import os
+import struct
+import tempfile
+import time
+import zlib
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+BLOCK_SIZE = 4 * 1024 * 1024
+
+#  Magic, deflate, no flags, no mtime, no extra flags, unknown OS
+GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+
+
+def gzip_member(data, level=6):
+    '''
+    Compresses data as one complete gzip member
+    '''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    body = compressor.compress(data) + compressor.flush()
+    return GZIP_HEADER + body + struct.pack(
+        '<II', zlib.crc32(data) & 0xffffffff, len(data) & 0xffffffff)
+
+
+def iter_blocks(fileobj, block_size=BLOCK_SIZE):
+    while True:
+        block = fileobj.read(block_size)
+        if not block:
+            return
+        yield block
+
+
+def iter_compressed(fileobj, level=6, threads=4, block_size=BLOCK_SIZE,
+                    pool=None):
+    '''
+    Yields a gzip stream of fileobj as a sequence of gzip members, one per
+    block, compressed concurrently but yielded in order.
+
+    zlib releases the GIL while compressing, so blocks are compressed in
+    parallel by a thread pool. At most twice as many blocks as threads are
+    read ahead, which bounds memory use. gunzip and Python's gzip module
+    read the concatenated members as a single file.
+    '''
+    own_pool = pool is None
+    if own_pool:
+        pool = ThreadPool(max(1, threads))
+    pending = deque()
+    try:
+        for block in iter_blocks(fileobj, block_size):
+            pending.append(pool.apply_async(gzip_member, (block, level)))
+            if len(pending) >= 2 * max(1, threads):
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        if own_pool:
+            pool.terminate()
+
+
+class CompressionStats(object):
+
+    def __init__(self):
+        self.input_bytes = 0
+        self.output_bytes = 0
+        self.start = time.time()
+        self.seconds = 0.
+
+    def finish(self):
+        self.seconds = time.time() - self.start
+
+    @property
+    def ratio(self):
+        return float(self.input_bytes) / self.output_bytes \
+            if self.output_bytes else 0.
+
+    @property
+    def mb_per_s(self):
+        return self.input_bytes / 1024. / 1024. / self.seconds \
+            if self.seconds else 0.
+
+    def __str__(self):
+        return '{:.1f} MB in {:.1f}s ({:.1f} MB/s), ratio {:.2f}'.format(
+            self.input_bytes / 1024. / 1024., self.seconds, self.mb_per_s,
+            self.ratio)
+
+
+def compress_file(source, destination, level=6, threads=4,
+                  block_size=BLOCK_SIZE):
+    '''
+    Writes source to destination as multi-member gzip; the file appears
+    under its final name only once it is complete. Returns CompressionStats.
+    '''
+    stats = CompressionStats()
+    stats.input_bytes = os.path.getsize(source)
+    with open(source, 'rb') as INPUT:
+        write_atomically(iter_compressed(INPUT, level, threads, block_size),
+                         destination, stats)
+    stats.finish()
+    return stats
+
+
+def write_atomically(chunks, destination, stats=None):
+    '''
+    Writes the byte strings from chunks to a temporary file of its own
+    next to destination and renames it, so that concurrent writers of the
+    same destination never mix their output; the temporary file is removed
+    on error
+    '''
+    fd, tmp_file = tempfile.mkstemp(
+        prefix='.{}.'.format(os.path.basename(destination)), suffix='.tmp',
+        dir=os.path.dirname(destination) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as OUTPUT:
+            for chunk in chunks:
+                OUTPUT.write(chunk)
+                if stats is not None:
+                    stats.output_bytes += len(chunk)
+        #  mkstemp makes the file private, which scp and rsync would keep
+        os.chmod(tmp_file, 0o644)
+        os.rename(tmp_file, destination)
+    except BaseException:
+        try:
+            os.remove(tmp_file)
+        except OSError:
+            pass
+        raise
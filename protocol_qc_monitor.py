@@ -14,11 +14,21 @@ import json
 import re
 import string
 import csv
-import math
-import numpy as np
 import datetime
+import time
 from collections import defaultdict
 
+from drift_metrics import (DRIFT_FIELDS, compute_drift_metrics_batch,
+                           frame_steps)
+from input_watcher import InputWatcher
+from record_store import RecordStore
+from set_cursor import CursorTable, SetCursor, file_signature
+from step_profiler import StepProfiler, summarize_tick
+from qc_statistics import SessionStatistics, parse_bounds
+from qc_resources import InlineRenderer, SqliteReaderCache, \
+    render_atomically
+from qc_atlas import Atlas
+
 SQLITE_TO_TXT = {
     'Acquisition Magnification': 'Magnification',
     'Acquisition Voltage': 'Voltage',
@@ -28,6 +38,21 @@ SQLITE_TO_TXT = {
     'Gctf Cross Correlation': 'CCC',
     'Sampling Rate': 'Pixel Size',
 }
+# Columns kept in QCMonitor.protocol_fields unless configured otherwise
+DEFAULT_RECORD_COLUMNS = list(SQLITE_TO_TXT) + [
+    'Filename',
+    'Mic Obj Filename',
+]
+#  Ticks a failed render is tried on before it is given up
+RENDER_ATTEMPTS = 3
+
+# Per-movie panels of the quad plot: (file suffix, atlas name)
+QUAD_PANELS = [
+    ('_aligned_mic.png', 'mic'),
+    ('.shift_plot.png', 'shift_plot'),
+    ('_aligned_mic_PSD.png', 'PSD'),
+    ('_aligned_mic_EPAplot.png', 'EPAplot'),
+]
 TXT_FIELDS = [
     'Movie',
     'Micrograph',
@@ -41,8 +66,8 @@ TXT_FIELDS = [
     'DF1-DF2',
     'Angast',
     'CCC',
-    'Average Drift',
-    'Maximum Drift',
+] + DRIFT_FIELDS + [
+    'QC Flags',
 ]
 
 
@@ -53,6 +78,17 @@ def dict_factory(cursor, row):
     return d
 
 
+def quad_panel(file_name):
+    '''
+    Returns (movie base name, atlas name) for a panel PNG, or None
+    '''
+    file_name = os.path.basename(file_name)
+    for suffix, kind in QUAD_PANELS:
+        if file_name.endswith(suffix):
+            return file_name[:-len(suffix)], kind
+    return None
+
+
 def standardize_label(label):
     '''
     Formats Scipion SQLite class names consistently
@@ -71,28 +107,124 @@ def standardize_label(label):
     return label.title()
 
 
-def get_absolute_drifts(x_shifts, y_shifts):
-    return list(
-        [math.sqrt(x ** 2 + y ** 2) for x, y in zip(x_shifts, y_shifts)])
-
-
 class ProtQCSummary(ProtMonitor):
     _label = 'QC summary'
 
     def _defineParams(self, form):
         ProtMonitor._defineParams(self, form)
 
+        form.addParam('watchInputs', params.BooleanParam, default=False,
+                      label='Watch inputs for changes?',
+                      help='Process an input protocol only when its set '
+                           'databases or output directory change, instead '
+                           'of rescanning every input each sampling '
+                           'interval.')
+
+        form.addParam('fallbackInterval', params.IntParam, default=300,
+                      condition='watchInputs',
+                      label='Fallback polling interval (sec)',
+                      help='Run a full pass at least this often when '
+                           'watching inputs, in case an event is missed.')
+
+        form.addParam('qcBounds', params.TextParam, default='',
+                      label='QC bounds',
+                      help='Movies outside these bounds are flagged, one '
+                           'bound per line or separated by ";", e.g. '
+                           '"CCC > 0.05; Maximum Drift < 10; DF1 < 40000".')
+
+        form.addParam('statisticsWindow', params.IntParam, default=50,
+                      label='Rolling window (movies)',
+                      help='Number of recent movies used for rolling '
+                           'statistics.')
+
+        form.addParam('outlierSigma', params.FloatParam, default=3.0,
+                      label='Outlier threshold (sigma)',
+                      help='Flag values further than this many standard '
+                           'deviations from the rolling mean. Use 0 to only '
+                           'flag values outside the QC bounds.')
+
+        form.addParam('outputMode', params.EnumParam, default=0,
+                      choices=['files', 'atlas'],
+                      label='Thumbnail output',
+                      help='"files" writes one PNG per panel and movie. '
+                           '"atlas" packs thumbnails into sprite sheets in '
+                           'extra/atlas with a JSON index per panel type.')
+
+        form.addParam('dashboardPort', params.IntParam, default=0,
+                      label='Dashboard port',
+                      help='Serve the QC table and quad thumbnails over HTTP '
+                           'on this port (requires tornado). Use 0 to '
+                           'disable.')
+
+        form.addParam('dashboardAddress', params.StringParam,
+                      default='127.0.0.1', condition='dashboardPort',
+                      label='Dashboard address',
+                      help='Address the dashboard binds to. The default '
+                           'only accepts local connections.')
+
+        form.addParam('profileEvery', params.IntParam, default=0,
+                      label='cProfile every N ticks',
+                      help='Write a cProfile dump of every Nth tick to the '
+                           'extra directory. Use 0 to disable.')
+
+        form.addParam('recordColumns', params.StringParam, default='',
+                      label='Retained SQLite columns',
+                      help='Comma-separated list of set database columns '
+                           'kept per movie. Leave empty for the columns used '
+                           'in the QC table, or use "all" to keep every '
+                           'column.')
+
+        form.addParam('maxRecords', params.IntParam, default=1000,
+                      label='Movies kept in memory',
+                      help='Maximum number of movies whose SQLite rows are '
+                           'held in memory; older ones are dropped or '
+                           'spilled to disk.')
+
+        form.addParam('spillRecords', params.BooleanParam, default=False,
+                      label='Spill evicted rows to disk?',
+                      help='Keep rows evicted from memory in a SQLite cache '
+                           'in the extra directory.')
+
     def _validate(self):
         errors = []
+        try:
+            parse_bounds(self.qcBounds.get())
+        except ValueError as e:
+            errors.append(str(e))
         return errors
 
     def _insertAllSteps(self):
         self._insertFunctionStep('monitorStep')
 
     def monitorStep(self):
+        columns = self.recordColumns.get()
+        if not columns:
+            columns = DEFAULT_RECORD_COLUMNS
+        elif columns.strip().lower() == 'all':
+            columns = None
+        else:
+            columns = [c.strip() for c in columns.split(',') if c.strip()]
+
+        spill_file = None
+        if self.spillRecords.get():
+            spill_file = self._getExtraPath('protocol_fields.sqlite')
+
         monitor = QCMonitor(self, workingDir=self._getPath(),
                             samplingInterval=self.samplingInterval.get(),
                             monitorTime=100,
+                            watchInputs=self.watchInputs.get(),
+                            fallbackInterval=self.fallbackInterval.get(),
+                            recordColumns=columns,
+                            maxRecords=self.maxRecords.get(),
+                            recordSpillFile=spill_file,
+                            profileEvery=self.profileEvery.get(),
+                            qcBounds=parse_bounds(self.qcBounds.get()),
+                            statisticsWindow=self.statisticsWindow.get(),
+                            outlierSigma=self.outlierSigma.get(),
+                            outputMode=['files', 'atlas'][
+                                self.outputMode.get()],
+                            dashboardPort=self.dashboardPort.get(),
+                            dashboardAddress=self.dashboardAddress.get(),
                             )
         monitor.addNotifier(PrintNotifier())
         monitor.loop()
@@ -104,10 +236,51 @@ class QCMonitor(Monitor):
 
         Monitor.__init__(self, **kwargs)
         self.protocol = protocol
-        self.project = protocol.getProject()
+        self.project = kwargs.get('project') or protocol.getProject()
         self.run_count = 1
 
-        self.protocol_fields = dict()  # Populated with Scipion SQLITE entries
+        #  Without a protocol, inputs are given as protocol ids in project
+        self.inputProtocolIds = kwargs.get('inputProtocolIds')
+
+        #  May be shared between monitors, see qc_aggregator.py
+        self.renderer = kwargs.get('renderer') or InlineRenderer()
+        self.sqlite_cache = kwargs.get('sqliteCache') or SqliteReaderCache(
+            row_factory=dict_factory, label_function=standardize_label)
+        self.render_jobs = []
+        self.failed_renders = []  # Submitted again on the next tick
+
+        #  In atlas mode thumbnails are packed into sprite sheets instead of
+        #  being written as one PNG per panel
+        self.atlases = None
+        if kwargs.get('outputMode', 'files') == 'atlas':
+            atlas_dir = os.path.join(self.workingDir, 'extra', 'atlas')
+            self.atlases = dict(
+                (kind, Atlas(atlas_dir, kind)) for _, kind in QUAD_PANELS)
+            self.atlases['quad'] = Atlas(
+                atlas_dir, 'quad', tile_size=(1600, 400), grid=(2, 16))
+            self.staging_dir = os.path.join(atlas_dir, 'staging')
+            if not os.path.isdir(self.staging_dir):
+                os.makedirs(self.staging_dir)
+        self.staged_panels = set()  # Panels rendered but not yet packed
+        self.new_quads = []
+
+        #  Optional HTTP dashboard served from an in-memory index
+        self.changed_movies = set()
+        self.dashboard = None
+        self.dashboard_index = None
+        if kwargs.get('dashboardPort'):
+            from qc_dashboard import DashboardServer, QCIndex
+            self.dashboard_index = QCIndex()
+            self.dashboard = DashboardServer(
+                self.dashboard_index, kwargs['dashboardPort'],
+                kwargs.get('dashboardAddress', '127.0.0.1'))
+
+        #  Populated with Scipion SQLITE entries
+        self.protocol_fields = RecordStore(
+            columns=kwargs.get('recordColumns', DEFAULT_RECORD_COLUMNS),
+            max_records=kwargs.get('maxRecords', 1000),
+            spill_file=kwargs.get('recordSpillFile'),
+        )
         self.txt_fields = defaultdict(dict)  # Printed to CSV
         self.txt_output = os.path.join(
             self.workingDir,
@@ -115,142 +288,344 @@ class QCMonitor(Monitor):
             'compiled_qc_fields.txt',
         )
 
-    def step(self):
-
-        for protPointer in self.protocol.inputProtocols:
-            prot = protPointer.get()
-
-            if isinstance(prot, ProtAlignMovies):
-
-                #  Create PNGs of micrographs
-                if hasattr(prot, 'outputMicrographs'):
-                    for mic in prot.outputMicrographs:
-                        input_file = os.path.join(
-                            self.project.path, mic.getFileName())
-                        base_name = os.path.splitext(
-                            os.path.basename(mic.getFileName()))[0]
-
-                        self.set_micrograph_path(
-                            input_file, base_name.split('_aligned_mic')[0])
-
-                        output_file = os.path.join(
-                            self.workingDir,
-                            'extra',
-                            base_name + '.png',
-                        )
-                        if not os.path.isfile(output_file):
-                            self.generateMicImage(input_file, output_file)
-
-                #  Create plots of offset values
-                if hasattr(prot, 'outputMovies'):
-                    for movie in prot.outputMovies:
-                        base_name = os.path.splitext(
-                            os.path.basename(movie.getFileName()))[0]
-
-                        output_file = os.path.join(
-                            self.workingDir,
-                            'extra',
-                            base_name + '.shift_plot.png'  # noqa
-                        )
-                        x_shifts, y_shifts = movie.getAlignment().getShifts()
-                        if not os.path.isfile(output_file):
-                            self.generateShiftPlot(
-                                x_shifts, y_shifts, output_file)
-                        self.set_average_drift(x_shifts, y_shifts, base_name)
-                        self.set_maximum_drift(x_shifts, y_shifts, base_name)
-
-                # Read SQLite database
-                sqlite_file = prot._getPath('micrographs.sqlite')
-                self.read_txt_fields_from_sqlite(sqlite_file)
-
-            elif isinstance(prot, ProtCTFMicrographs):
-
-                # Read SQLite database
-                sqlite_file = prot._getPath('ctfs.sqlite')
-                self.read_txt_fields_from_sqlite(sqlite_file)
-
-                if hasattr(prot, 'outputCTF'):
-                    for ctf in prot.outputCTF:
-
-                        base_name = os.path.basename(
-                            ctf.getMicrograph().getFileName()
-                        ).split('_aligned_mic.mrc')[0]
-                        self.set_defocus_delta(base_name)
-
-                        psd_file = ctf.getPsdFile()
-                        epa_file = os.path.splitext(psd_file)[0] + '_EPA.txt'
-
-                        #  Generate PSD png
-                        input_file = psd_file
-                        output_file = os.path.join(
-                            self.workingDir,
-                            'extra',
-                            psd_file.split('/')[-2] + '_PSD.png',
-                        )
-                        if not os.path.exists(output_file):
-                            self.generateMicImage(input_file, output_file)
-
-                        #  Generate EPA plot
-                        input_file = epa_file
-                        output_file = os.path.join(
-                            self.workingDir,
-                            'extra',
-                            psd_file.split('/')[-2] + '_EPAplot.png',
-                        )
-                        if not os.path.exists(output_file):
-                            self.generateEPAPlot(input_file, output_file)
-
-            elif isinstance(prot, ProtImportMovies):
-                for movie in prot.outputMovies:
-
-                    movie_path = os.path.join(
-                        self.project.path, movie.getFileName())
-                    movie_base_name = \
-                        os.path.splitext(os.path.basename(
-                            movie.getFileName()))[0]
-
-                    self.set_movie_counts(movie, movie_base_name)
-                    self.set_movie_path(movie_path, movie_base_name)
-                    self.set_movie_time(movie_path, movie_base_name)
-
-                    #  Compile plot
-                    exts = [
-                        '_aligned_mic.png',
-                        '.shift_plot.png',
-                        '_aligned_mic_PSD.png',
-                        '_aligned_mic_EPAplot.png',
-                    ]
-                    files = []
-                    for e in exts:
-                        files.append(os.path.join(
-                            self.workingDir,
-                            'extra',
-                            movie_base_name + e,
-                        ))
-
-                    create = True
-                    for f in files:
-                        if not os.path.isfile(f):
-                            create = False
-                    if create:
-                        result = Image.new("RGB", (1600, 400))
-                        for i, f in enumerate(files):
-                            img = Image.open(f)
-                            img.thumbnail((400, 400), Image.ANTIALIAS)
-                            x = i * 400
-                            w, h = img.size
-                            result.paste(img, (x, 0, x + w, h))
-                        result.save(os.path.join(
-                            self.workingDir,
-                            'extra',
-                            movie_base_name + '_quad.png'
-                        ))
-
-                # Read SQLite database
-                sqlite_file = prot._getPath('movies.sqlite')
-                self.read_txt_fields_from_sqlite(sqlite_file)
-
-        self.write_txt_file()
+        #  Session-wide running statistics and outlier flags
+        self.statistics = SessionStatistics(
+            bounds=kwargs.get('qcBounds'),
+            window=kwargs.get('statisticsWindow', 50),
+            sigma=kwargs.get('outlierSigma', 3.0),
+        )
+        self.flagged_movies = set()
+        self.statistics_output = os.path.join(
+            self.workingDir,
+            'extra',
+            'session_statistics.json',
+        )
+
+        self.watchInputs = kwargs.get('watchInputs', False)
+        self.fallbackInterval = kwargs.get('fallbackInterval', 300)
+        self.settleTime = kwargs.get('settleTime', 0.25)
+
+        #  Only objects added since the previous tick are visited
+        self.set_cursor = SetCursor()
+        self.sqlite_cursor = CursorTable()
+        self.pending_quads = set()  # Movies still missing quad panels
+
+        self.profiler = StepProfiler(
+            os.path.join(self.workingDir, 'extra', 'step_profile.jsonl'),
+            profile_every=kwargs.get('profileEvery', 0),
+        )
+
+    def loop(self):
+        if self.dashboard is not None:
+            self.dashboard.start()
+        try:
+            self._loop()
+        finally:
+            if self.dashboard is not None:
+                self.dashboard.stop()
+
+    def _loop(self):
+        if not self.watchInputs:
+            return Monitor.loop(self)
+
+        watcher = InputWatcher()
+        for prot in self.getInputProtocols():
+            watcher.watch_protocol(prot.getObjId(), prot._getPath(),
+                                   [prot._getExtraPath()])
+        watcher.start()
+
+        self.initLoop()
+        timeout = time.time() + 60. * self.monitorTime
+        try:
+            finished = self.step()
+            while not finished and time.time() < timeout:
+                wait = min(self.fallbackInterval, timeout - time.time())
+                if watcher.wait(max(wait, 0)):
+                    #  Let bursts of writes to the same database coalesce
+                    time.sleep(self.settleTime)
+                    finished = self.step(watcher.pop_changed())
+                else:
+                    finished = self.step()
+        finally:
+            watcher.stop()
+
+    def step(self, protocolIds=None):
+        '''
+        Processes the input protocols; if protocolIds is given, only the
+        protocols with those object ids are processed
+        '''
+        self.profiler.start_tick()
+        self.retry_renders()
+
+        for prot in self.getInputProtocols():
+            if protocolIds is None or prot.getObjId() in protocolIds:
+                self.processProtocol(prot)
+        self.collect_renders()
+        #  Every tick, as the last panel may come from any input protocol
+        self.compose_pending_quads()
+        self.flush_atlases()
+
+        with self.profiler.phase('csv'):
+            self.write_txt_file()
+            self.write_statistics()
+        self.publish_changes()
+
+        record = self.profiler.end_tick()
+        if record['counters']:
+            self.info(summarize_tick(record))
+
+    def getInputProtocols(self):
+        if self.inputProtocolIds is not None:
+            return [self.project.getProtocol(protId)
+                    for protId in self.inputProtocolIds]
+        return [protPointer.get() for protPointer in
+                self.protocol.inputProtocols]
+
+    def processProtocol(self, prot):
+        if isinstance(prot, ProtAlignMovies):
+            self._processAlignMovies(prot)
+        elif isinstance(prot, ProtCTFMicrographs):
+            self._processCTFMicrographs(prot)
+        elif isinstance(prot, ProtImportMovies):
+            self._processImportMovies(prot)
+
+    def _iterNew(self, prot, set_name):
+        for item in self.profiler.timed_iter(
+                self.set_cursor.iter_new(prot, set_name), 'set_iteration'):
+            self.profiler.count('set_items')
+            yield item
+
+    def has_output(self, output_file):
+        if self.atlases is None:
+            return os.path.isfile(output_file)
+        panel = quad_panel(output_file)
+        return os.path.basename(output_file) in self.staged_panels or \
+            (panel is not None and self.atlases[panel[1]].has(panel[0]))
+
+    def _render(self, render, *args):
+        output_file = args[-1]
+        if self.atlases is not None:
+            #  Rendered into a staging file that is packed once finished
+            name = os.path.basename(output_file)
+            output_file = os.path.join(self.staging_dir, name)
+            self.staged_panels.add(name)
+            args = args[:-1] + (output_file,)
+        self._submit_render(render, args, 1)
+
+    def _submit_render(self, render, args, attempt):
+        #  Written under a temporary name, so that quads and atlases never
+        #  read a panel still being written
+        with self.profiler.phase('render'):
+            job = self.renderer.submit(render_atomically, render, *args)
+        self.render_jobs.append((args[-1], job, render, args, attempt))
+        self.profiler.count('images_rendered')
+
+    def retry_renders(self):
+        failed, self.failed_renders = self.failed_renders, []
+        for render, args, attempt in failed:
+            self._submit_render(render, args, attempt + 1)
+
+    def collect_renders(self):
+        '''
+        Packs or forgets finished rendering jobs; failed ones are kept for
+        the next tick until they have been tried RENDER_ATTEMPTS times
+        '''
+        pending = []
+        for output_file, job, render, args, attempt in self.render_jobs:
+            if not job.ready():
+                pending.append((output_file, job, render, args, attempt))
+                continue
+            try:
+                job.get()
+            except Exception as e:
+                if attempt < RENDER_ATTEMPTS:
+                    self.info('Could not render {}, trying again: {}'.format(
+                        output_file, e))
+                    self.failed_renders.append((render, args, attempt))
+                    continue
+                self.info('Could not render {}: {}'.format(output_file, e))
+            else:
+                if self.atlases is not None:
+                    self.pack_panel(output_file)
+            if self.atlases is not None:
+                self.staged_panels.discard(os.path.basename(output_file))
+        self.render_jobs = pending
+
+    def pack_panel(self, staged_file):
+        movie_base_name, kind = quad_panel(staged_file)
+        with self.profiler.phase('atlas'):
+            image = Image.open(staged_file)
+            self.atlases[kind].add(movie_base_name, image)
+            os.remove(staged_file)
+
+    def flush_atlases(self):
+        if self.atlases is None:
+            return
+        with self.profiler.phase('atlas'):
+            for atlas in self.atlases.values():
+                atlas.flush()
+        if self.dashboard_index is not None:
+            for movie_base_name in self.new_quads:
+                sheet_path, box = self.atlases['quad'].box(movie_base_name)
+                self.dashboard_index.set_thumbnail(
+                    movie_base_name, sheet_path, box)
+        self.new_quads = []
+
+    def _processAlignMovies(self, prot):
+
+        #  Create PNGs of micrographs
+        for mic in self._iterNew(prot, 'outputMicrographs'):
+            input_file = os.path.join(
+                self.project.path, mic.getFileName())
+            base_name = os.path.splitext(
+                os.path.basename(mic.getFileName()))[0]
+
+            self.set_micrograph_path(
+                input_file, base_name.split('_aligned_mic')[0])
+
+            output_file = os.path.join(
+                self.workingDir,
+                'extra',
+                base_name + '.png',
+            )
+            if not self.has_output(output_file):
+                self._render(generate_mic_image, input_file, output_file)
+
+        #  Create plots of offset values
+        base_names = []
+        all_x_shifts = []
+        all_y_shifts = []
+        for movie in self._iterNew(prot, 'outputMovies'):
+            base_name = os.path.splitext(
+                os.path.basename(movie.getFileName()))[0]
+
+            output_file = os.path.join(
+                self.workingDir,
+                'extra',
+                base_name + '.shift_plot.png'  # noqa
+            )
+            x_shifts, y_shifts = movie.getAlignment().getShifts()
+            if not self.has_output(output_file):
+                self._render(generate_shift_plot,
+                             x_shifts, y_shifts, output_file)
+            base_names.append(base_name)
+            all_x_shifts.append(x_shifts)
+            all_y_shifts.append(y_shifts)
+        self.set_drift_metrics(all_x_shifts, all_y_shifts, base_names)
+
+        # Read SQLite database
+        sqlite_file = prot._getPath('micrographs.sqlite')
+        self.read_txt_fields_from_sqlite(sqlite_file)
+
+    def _processCTFMicrographs(self, prot):
+
+        # Read SQLite database
+        sqlite_file = prot._getPath('ctfs.sqlite')
+        self.read_txt_fields_from_sqlite(sqlite_file)
+
+        for ctf in self._iterNew(prot, 'outputCTF'):
+
+            base_name = os.path.basename(
+                ctf.getMicrograph().getFileName()
+            ).split('_aligned_mic.mrc')[0]
+            self.set_defocus_delta(base_name)
+
+            psd_file = ctf.getPsdFile()
+            epa_file = os.path.splitext(psd_file)[0] + '_EPA.txt'
+
+            #  Generate PSD png
+            input_file = psd_file
+            output_file = os.path.join(
+                self.workingDir,
+                'extra',
+                psd_file.split('/')[-2] + '_PSD.png',
+            )
+            if not self.has_output(output_file):
+                self._render(generate_mic_image, input_file, output_file)
+
+            #  Generate EPA plot
+            input_file = epa_file
+            output_file = os.path.join(
+                self.workingDir,
+                'extra',
+                psd_file.split('/')[-2] + '_EPAplot.png',
+            )
+            if not self.has_output(output_file):
+                self._render(generate_epa_plot, input_file, output_file)
+
+    def _processImportMovies(self, prot):
+        for movie in self._iterNew(prot, 'outputMovies'):
+
+            movie_path = os.path.join(
+                self.project.path, movie.getFileName())
+            movie_base_name = \
+                os.path.splitext(os.path.basename(
+                    movie.getFileName()))[0]
+
+            self.set_movie_counts(movie, movie_base_name)
+            self.set_movie_path(movie_path, movie_base_name)
+            self.set_movie_time(movie_path, movie_base_name)
+            self.pending_quads.add(movie_base_name)
+
+        # Read SQLite database
+        sqlite_file = prot._getPath('movies.sqlite')
+        self.read_txt_fields_from_sqlite(sqlite_file)
+
+    def compose_pending_quads(self):
+        '''
+        Compiles plots for movies whose panels are all available
+        '''
+        with self.profiler.phase('quad'):
+            for movie_base_name in sorted(self.pending_quads):
+                if self.compose_quad(movie_base_name):
+                    self.pending_quads.discard(movie_base_name)
+                    self.profiler.count('quads_composed')
+
+    def compose_quad(self, movie_base_name):
+        if self.atlases is not None:
+            return self.compose_atlas_quad(movie_base_name)
+
+        files = []
+        for e, _ in QUAD_PANELS:
+            files.append(os.path.join(
+                self.workingDir,
+                'extra',
+                movie_base_name + e,
+            ))
+
+        for f in files:
+            if not os.path.isfile(f):
+                return False
+
+        result = Image.new("RGB", (1600, 400))
+        for i, f in enumerate(files):
+            img = Image.open(f)
+            img.thumbnail((400, 400), Image.ANTIALIAS)
+            x = i * 400
+            w, h = img.size
+            result.paste(img, (x, 0, x + w, h))
+        quad_file = os.path.join(
+            self.workingDir,
+            'extra',
+            movie_base_name + '_quad.png'
+        )
+        result.save(quad_file)
+        if self.dashboard_index is not None:
+            self.dashboard_index.set_thumbnail(movie_base_name, quad_file)
+        return True
+
+    def compose_atlas_quad(self, movie_base_name):
+        for _, kind in QUAD_PANELS:
+            if not self.atlases[kind].has(movie_base_name):
+                return False
+
+        result = Image.new("RGB", (1600, 400))
+        for i, (_, kind) in enumerate(QUAD_PANELS):
+            result.paste(self.atlases[kind].extract(movie_base_name),
+                         (i * 400, 0))
+        self.atlases['quad'].add(movie_base_name, result)
+        self.new_quads.append(movie_base_name)
+        return True
 
     def write_txt_file(self):
         # self.info(self.txt_fields)
@@ -261,13 +636,51 @@ class QCMonitor(Monitor):
                     self.txt_fields.items(), key=lambda x: x[0]):
                 writer.writerow(field_dict)
 
+    def set_txt_field(self, base_name, key, value):
+        '''
+        Sets a CSV field, feeding the first value of each field per movie to
+        the session statistics
+        '''
+        fields = self.txt_fields[base_name]
+        first = key not in fields
+        fields[key] = value
+        self.changed_movies.add(base_name)
+        if first:
+            flags = self.statistics.observe(key, value)
+            if flags:
+                self.flag_movie(base_name, flags)
+
+    def flag_movie(self, base_name, flags):
+        self.flagged_movies.add(base_name)
+        fields = self.txt_fields[base_name]
+        fields['QC Flags'] = '; '.join(
+            ([fields['QC Flags']] if fields.get('QC Flags') else []) + flags)
+        self.notify('Scipion QC Monitor: outlier',
+                    '{}: {}'.format(base_name, '; '.join(flags)))
+
+    def publish_changes(self):
+        '''
+        Sends the rows changed during this tick to the dashboard index
+        '''
+        if self.dashboard_index is not None:
+            self.dashboard_index.update(dict(
+                (name, self.txt_fields[name])
+                for name in self.changed_movies))
+        self.changed_movies = set()
+
+    def write_statistics(self):
+        with open(self.statistics_output, 'w') as OUTPUT:
+            json.dump(self.statistics.summary(), OUTPUT, indent=2,
+                      sort_keys=True)
+
     def set_movie_path(self, movie_path, base_name):
-        self.txt_fields[base_name]['Movie'] = os.path.realpath(movie_path)
+        self.set_txt_field(base_name, 'Movie', os.path.realpath(movie_path))
 
     def set_movie_time(self, movie_path, base_name):
         real_path = os.path.realpath(movie_path)
         t = os.path.getmtime(real_path)
-        self.txt_fields[base_name]['Date'] = datetime.datetime.fromtimestamp(t)
+        self.set_txt_field(
+            base_name, 'Date', datetime.datetime.fromtimestamp(t))
 
     def set_movie_counts(self, movie, base_name):
         dose_per_frame = max(0, movie.getAcquisition().getDosePerFrame())
@@ -275,18 +688,22 @@ class QCMonitor(Monitor):
         frames = movie.getNumberOfFrames()
 
         counts = float(initial_dose) + float(dose_per_frame) * frames
-        self.txt_fields[base_name]['Counts'] = counts
+        self.set_txt_field(base_name, 'Counts', counts)
 
     def set_micrograph_path(self, micrograph_path, base_name):
-        self.txt_fields[base_name]['Micrograph'] = micrograph_path
-
-    def set_average_drift(self, x_shifts, y_shifts, base_name):
-        drifts = get_absolute_drifts(x_shifts, y_shifts)
-        self.txt_fields[base_name]['Average Drift'] = np.average(drifts)
-
-    def set_maximum_drift(self, x_shifts, y_shifts, base_name):
-        drifts = get_absolute_drifts(x_shifts, y_shifts)
-        self.txt_fields[base_name]['Maximum Drift'] = max(drifts)
+        self.set_txt_field(base_name, 'Micrograph', micrograph_path)
+
+    def set_drift_metrics(self, x_shift_lists, y_shift_lists, base_names):
+        '''
+        Computes drift metrics for a batch of movies in one vectorized pass
+        '''
+        if not base_names:
+            return
+        metrics = compute_drift_metrics_batch(x_shift_lists, y_shift_lists)
+        for i, base_name in enumerate(base_names):
+            for field in DRIFT_FIELDS:
+                self.set_txt_field(
+                    base_name, field, float(metrics[field][i]))
 
     def set_defocus_delta(self, base_name):
         try:
@@ -295,76 +712,66 @@ class QCMonitor(Monitor):
         except KeyError:
             pass
         else:
-            self.txt_fields[base_name]['DF1-DF2'] = df_1 - df_2
+            self.set_txt_field(base_name, 'DF1-DF2', df_1 - df_2)
 
     def read_txt_fields_from_sqlite(self, sqlite_file):
-        connection = sqlite3.connect(sqlite_file)
-        connection.row_factory = dict_factory
-        cursor = connection.cursor()
-
-        col_name_to_label = dict()
-        for row in cursor.execute('SELECT * FROM Classes'):
-            label_property = standardize_label(row['label_property'])
-            col_name_to_label[row['column_name']] = label_property
-
-        try:
-            for row in cursor.execute('SELECT * FROM Objects'):
-
-                row_keys = row.keys()
-                for key in row_keys:
-                    if key in col_name_to_label:
-                        row[col_name_to_label[key]] = row.pop(key)
-
-                sqlite_base = os.path.basename(sqlite_file)
-
-                if sqlite_base == 'movies.sqlite':
-                    base_name = (os.path
-                                   .basename(row['Filename'])
-                                   .split('.mrcs')[0])
-                elif sqlite_base == 'micrographs.sqlite':
-                    base_name = (os.path
-                                   .basename(row['Filename'])
-                                   .split('_aligned_mic.mrc')[0])
-                elif sqlite_base == 'ctfs.sqlite':
-                    base_name = (os.path
-                                   .basename(row['Mic Obj Filename'])
-                                   .split('_aligned_mic.mrc')[0])
-
-                if base_name not in self.protocol_fields:
-                    self.protocol_fields[base_name] = dict()
-
-                self.protocol_fields[base_name].update(row)
+        '''
+        Reads the rows added to a set database since the previous call
+        '''
+        with self.profiler.phase('sqlite'):
+            for base_name, row in self.iter_sqlite_rows(
+                    sqlite_file, self.sqlite_cursor):
+                self.protocol_fields.update(base_name, row)
+                self.profiler.count('rows_read')
 
                 for key, value in row.items():
                     if key in SQLITE_TO_TXT:
                         txt_key = SQLITE_TO_TXT[key]
-                        self.txt_fields[base_name][txt_key] = value
+                        self.set_txt_field(base_name, txt_key, value)
 
-        except sqlite3.OperationalError:
-            pass
+            self.protocol_fields.flush()
 
     def read_to_protocol_fields(self, sqlite_file):
+        for base_name, row in self.iter_sqlite_rows(sqlite_file):
+            self.protocol_fields.update(base_name, row)
 
-        connection = sqlite3.connect(sqlite_file)
-        connection.row_factory = dict_factory
-        cursor = connection.cursor()
+        self.protocol_fields.flush()
 
-        col_name_to_label = dict()
+    def iter_sqlite_rows(self, sqlite_file, cursor_table=None):
+        '''
+        Yields (base name, labelled row) pairs from a set database; with a
+        cursor table only rows added since the previous call are read
+        '''
+        signature = file_signature(sqlite_file)
+        if signature is None:
+            return
 
-        for row in cursor.execute('SELECT * FROM Classes'):
-            label_property = standardize_label(row['label_property'])
-            col_name_to_label[row['column_name']] = label_property
+        sqlite_base = os.path.basename(sqlite_file)
+        cursor = None
 
         try:
-            for row in cursor.execute('SELECT * FROM Objects'):
-
-                row_keys = row.keys()
+            connection, col_name_to_label = self.sqlite_cache.open(
+                sqlite_file, signature)
+            cursor = connection.cursor()
+
+            last_id = 0
+            if cursor_table is not None:
+                max_id = cursor.execute(
+                    'SELECT MAX(id) AS max_id FROM Objects'
+                ).fetchone()['max_id']
+                last_id = cursor_table.start(
+                    sqlite_file, signature, max_id or 0)
+
+            for row in cursor.execute(
+                    'SELECT * FROM Objects WHERE id > ? ORDER BY id',
+                    (last_id,)):
+
+                row_id = row['id']
+                row_keys = list(row.keys())
                 for key in row_keys:
                     if key in col_name_to_label:
                         row[col_name_to_label[key]] = row.pop(key)
 
-                sqlite_base = os.path.basename(sqlite_file)
-
                 if sqlite_base == 'movies.sqlite':
                     base_name = (os.path
                                    .basename(row['Filename'])
@@ -378,193 +785,205 @@ class QCMonitor(Monitor):
                                    .basename(row['Mic Obj Filename'])
                                    .split('_aligned_mic.mrc')[0])
 
-                if base_name not in self.protocol_fields:
-                    self.protocol_fields[base_name] = dict()
+                yield base_name, row
 
-                self.protocol_fields[base_name].update(row)
+                if cursor_table is not None:
+                    cursor_table.advance(sqlite_file, row_id)
 
         except sqlite3.OperationalError:
-            pass
+            self.sqlite_cache.invalidate(sqlite_file)
+            cursor = None
+        finally:
+            #  Release the read lock even if the caller stops early
+            if cursor is not None:
+                cursor.close()
 
     def generateMicImage(self, input_file, output_file=None):
-        if not output_file:
-            output_file = os.path.splitext(input_file)[0] + '.png'
-        img = ImageHandler().createImage()
-        img.read(input_file)
-        pimg = getPILImage(img)
-        pwutils.makeFilePath(output_file)
-        pimg.save(output_file, "PNG")
+        generate_mic_image(input_file, output_file)
 
     def generateShiftPlot(self, cume_x_shifts, cume_y_shifts, output_file):
-        x_shifts = []
-        y_shifts = []
-        for i in range(1, len(cume_x_shifts)):
-            x_shifts.append(cume_x_shifts[i] - cume_x_shifts[i - 1])
-        for j in range(1, len(cume_y_shifts)):
-            y_shifts.append(cume_y_shifts[j] - cume_y_shifts[j - 1])
-
-        width = 1 / 1.5
-
-        f, axarr = plt.subplots(2, sharex=True)
-
-        axarr[0].bar(range(len(x_shifts)), x_shifts, width, color='blue')
-        axarr[0].set_title('X axis shifts (non-cumulative)')
-        axarr[0].set_ylabel('Shift')
-
-        axarr[1].bar(range(len(y_shifts)), y_shifts, width, color='blue')
-        axarr[1].set_title('Y axis shifts (non-cumulative)')
-        axarr[1].set_xlabel('Frame')
-        axarr[1].set_ylabel('Shift')
-
-        f.set_size_inches(8, 8)
-        plt.savefig(output_file)
-        plt.clf()
+        generate_shift_plot(cume_x_shifts, cume_y_shifts, output_file)
 
     def generateEPAPlot(self, input_file, output_file):
+        generate_epa_plot(input_file, output_file)
+
+
+def generate_mic_image(input_file, output_file=None):
+    if not output_file:
+        output_file = os.path.splitext(input_file)[0] + '.png'
+    img = ImageHandler().createImage()
+    img.read(input_file)
+    pimg = getPILImage(img)
+    pwutils.makeFilePath(output_file)
+    pimg.save(output_file, "PNG")
+
+
+def generate_shift_plot(cume_x_shifts, cume_y_shifts, output_file):
+    x_shifts, y_shifts = frame_steps(cume_x_shifts, cume_y_shifts)
+
+    width = 1 / 1.5
+
+    f, axarr = plt.subplots(2, sharex=True)
+
+    axarr[0].bar(range(len(x_shifts)), x_shifts, width, color='blue')
+    axarr[0].set_title('X axis shifts (non-cumulative)')
+    axarr[0].set_ylabel('Shift')
+
+    axarr[1].bar(range(len(y_shifts)), y_shifts, width, color='blue')
+    axarr[1].set_title('Y axis shifts (non-cumulative)')
+    axarr[1].set_xlabel('Frame')
+    axarr[1].set_ylabel('Shift')
+
+    f.set_size_inches(8, 8)
+    plt.savefig(output_file)
+    plt.clf()
+
+
+def generate_epa_plot(input_file, output_file):
+
+    def _plot_subset(axis, resolution_list, ctf_sim_list, epa_ln_f_bg_list,
+                     ccc_list, res_max=float('inf'), res_min=float('-inf')):
+
+        plot_ccc_lists = {
+            1.0: [],
+            0.8: [],
+            0.5: [],
+        }
+        res_limits = {
+            0.8: None,
+            0.5: None,
+        }
+        current_list = plot_ccc_lists[1.0]
+
+        plot_resolution_list = []
+        plot_ctf_sim_list = []
+        plot_epa_ln_f_bg_list = []
+
+        for resolution, ctf_sim, epa_ln_f_bg, ccc in zip(
+                resolution_list, ctf_sim_list, epa_ln_f_bg_list, ccc_list):
+
+            if resolution <= res_max and resolution >= res_min:
+
+                plot_resolution_list.append(1.0 / resolution)
+                plot_ctf_sim_list.append(ctf_sim)
+                plot_epa_ln_f_bg_list.append(epa_ln_f_bg)
+
+                if not res_limits[0.8]:
+                    if ccc <= 0.5:
+                        res_limits[0.5] = resolution
+                        res_limits[0.8] = resolution
+                        current_list.append({
+                            'resolution': 1.0 / resolution,
+                            'ccc': ccc,
+                        })
+                        current_list = plot_ccc_lists[0.5]
+                    elif ccc <= 0.8:
+                        res_limits[0.8] = resolution
+                        current_list.append({
+                            'resolution': 1.0 / resolution,
+                            'ccc': ccc,
+                        })
+                        current_list = plot_ccc_lists[0.8]
+                elif not res_limits[0.5]:
+                    if ccc <= 0.5:
+                        res_limits[0.5] = resolution
+                        current_list.append({
+                            'resolution': 1.0 / resolution,
+                            'ccc': ccc,
+                        })
+                        current_list = plot_ccc_lists[0.5]
+                        if not res_limits[0.8]:
+                            res_limits[0.8] = resolution
+                current_list.append({
+                    'resolution': 1.0 / resolution,
+                    'ccc': ccc,
+                })
+
+        epa_max = max(plot_epa_ln_f_bg_list)
+        epa_min = min(plot_epa_ln_f_bg_list)
+        epa_diff = epa_max - epa_min
+
+        epa_norm = []
+        for val in plot_epa_ln_f_bg_list:
+            epa_norm.append(
+                (val - epa_min) / epa_diff
+            )
 
-        def _plot_subset(axis, resolution_list, ctf_sim_list, epa_ln_f_bg_list,
-                         ccc_list, res_max=float('inf'), res_min=float('-inf')):
-
-            plot_ccc_lists = {
-                1.0: [],
-                0.8: [],
-                0.5: [],
-            }
-            res_limits = {
-                0.8: None,
-                0.5: None,
-            }
-            current_list = plot_ccc_lists[1.0]
-
-            plot_resolution_list = []
-            plot_ctf_sim_list = []
-            plot_epa_ln_f_bg_list = []
-
-            for resolution, ctf_sim, epa_ln_f_bg, ccc in zip(
-                    resolution_list, ctf_sim_list, epa_ln_f_bg_list, ccc_list):
-
-                if resolution <= res_max and resolution >= res_min:
-
-                    plot_resolution_list.append(1.0 / resolution)
-                    plot_ctf_sim_list.append(ctf_sim)
-                    plot_epa_ln_f_bg_list.append(epa_ln_f_bg)
+        axis.plot(
+            plot_resolution_list,
+            plot_ctf_sim_list,
+            color='gray',
+            label='CTF Sim.',
+            alpha=0.7,
+        )
+        axis.plot(
+            plot_resolution_list,
+            epa_norm,
+            color='blue',
+            label='BG-Corr. EPA'
+        )
 
-                    if not res_limits[0.8]:
-                        if ccc <= 0.5:
-                            res_limits[0.5] = resolution
-                            res_limits[0.8] = resolution
-                            current_list.append({
-                                'resolution': 1.0 / resolution,
-                                'ccc': ccc,
-                            })
-                            current_list = plot_ccc_lists[0.5]
-                        elif ccc <= 0.8:
-                            res_limits[0.8] = resolution
-                            current_list.append({
-                                'resolution': 1.0 / resolution,
-                                'ccc': ccc,
-                            })
-                            current_list = plot_ccc_lists[0.8]
-                    elif not res_limits[0.5]:
-                        if ccc <= 0.5:
-                            res_limits[0.5] = resolution
-                            current_list.append({
-                                'resolution': 1.0 / resolution,
-                                'ccc': ccc,
-                            })
-                            current_list = plot_ccc_lists[0.5]
-                            if not res_limits[0.8]:
-                                res_limits[0.8] = resolution
-                    current_list.append({
-                        'resolution': 1.0 / resolution,
-                        'ccc': ccc,
-                    })
-
-            epa_max = max(plot_epa_ln_f_bg_list)
-            epa_min = min(plot_epa_ln_f_bg_list)
-            epa_diff = epa_max - epa_min
-
-            epa_norm = []
-            for val in plot_epa_ln_f_bg_list:
-                epa_norm.append(
-                    (val - epa_min) / epa_diff
-                )
+        for limit, color in zip([(1.0, 0.8), (0.8, 0.5), (0.5, -1.0)],
+                                ['green', 'orange', 'red']):
 
             axis.plot(
-                plot_resolution_list,
-                plot_ctf_sim_list,
-                color='gray',
-                label='CTF Sim.',
-                alpha=0.7,
-            )
-            axis.plot(
-                plot_resolution_list,
-                epa_norm,
-                color='blue',
-                label='BG-Corr. EPA'
+                [x['resolution'] for x in plot_ccc_lists[limit[0]]],
+                [x['ccc'] for x in plot_ccc_lists[limit[0]]],
+                linewidth=2,
+                color=color,
+                label='{} >= CCC > {}'.format(str(limit[0]), str(limit[1])),
             )
 
-            for limit, color in zip([(1.0, 0.8), (0.8, 0.5), (0.5, -1.0)],
-                                    ['green', 'orange', 'red']):
-
-                axis.plot(
-                    [x['resolution'] for x in plot_ccc_lists[limit[0]]],
-                    [x['ccc'] for x in plot_ccc_lists[limit[0]]],
-                    linewidth=2,
-                    color=color,
-                    label='{} >= CCC > {}'.format(str(limit[0]), str(limit[1])),
-                )
-
-            if res_limits[0.8]:
-                axis.axvline(1 / res_limits[0.8], color='orange')
-            if res_limits[0.5]:
-                axis.axvline(1 / res_limits[0.5], color='red')
-
-            axis.set_xlabel('Resolution (1 / A)')
-            axis.set_ylabel('Correlation')
-
-            axis.set_xlim(min(plot_resolution_list), max(plot_resolution_list))
-            axis.set_ylim([-0.2, 1.2])
-
-            return res_limits
-
-        resolution_list = []
-        ctf_sim_list = []
-        epa_ln_f_bg_list = []
-        ccc_list = []
-
-        with open(input_file) as f:
-            next(f)
-            for line in f:
-                resolution, ctf_sim, epa_ln_f, epa_ln_f_bg, ccc = \
-                    [float(val) for val in line.strip().split()]
-
-                resolution_list.append(resolution)
-                ctf_sim_list.append(ctf_sim)
-                epa_ln_f_bg_list.append(epa_ln_f_bg)
-                ccc_list.append(ccc)
-
-        f, axarr = plt.subplots(4)
-        f.set_size_inches(8, 8)
-
-        res_limits = _plot_subset(axarr[0], resolution_list, ctf_sim_list,
-                                  epa_ln_f_bg_list, ccc_list)
-        axarr[0].set_title(
-            'Resolution limits: {} A at 0.8 CCC and {} A at 0.5 CCC'.format(
-                str(round(res_limits[0.8], 2)),
-                str(round(res_limits[0.5], 2)),
-            ))
-
-        _plot_subset(axarr[1], resolution_list, ctf_sim_list, epa_ln_f_bg_list,
-                     ccc_list, res_min=10)
-        axarr[1].set_title('20 A to 10 A')
-        _plot_subset(axarr[2], resolution_list, ctf_sim_list, epa_ln_f_bg_list,
-                     ccc_list, res_max=10, res_min=5)
-        axarr[2].set_title('10 A to 5 A')
-        _plot_subset(axarr[3], resolution_list, ctf_sim_list, epa_ln_f_bg_list,
-                     ccc_list, res_max=5, res_min=2)
-        axarr[3].set_title('5 A to 2 A')
-
-        plt.tight_layout()
-        plt.savefig(output_file)
-        plt.clf()
+        if res_limits[0.8]:
+            axis.axvline(1 / res_limits[0.8], color='orange')
+        if res_limits[0.5]:
+            axis.axvline(1 / res_limits[0.5], color='red')
+
+        axis.set_xlabel('Resolution (1 / A)')
+        axis.set_ylabel('Correlation')
+
+        axis.set_xlim(min(plot_resolution_list), max(plot_resolution_list))
+        axis.set_ylim([-0.2, 1.2])
+
+        return res_limits
+
+    resolution_list = []
+    ctf_sim_list = []
+    epa_ln_f_bg_list = []
+    ccc_list = []
+
+    with open(input_file) as f:
+        next(f)
+        for line in f:
+            resolution, ctf_sim, epa_ln_f, epa_ln_f_bg, ccc = \
+                [float(val) for val in line.strip().split()]
+
+            resolution_list.append(resolution)
+            ctf_sim_list.append(ctf_sim)
+            epa_ln_f_bg_list.append(epa_ln_f_bg)
+            ccc_list.append(ccc)
+
+    f, axarr = plt.subplots(4)
+    f.set_size_inches(8, 8)
+
+    res_limits = _plot_subset(axarr[0], resolution_list, ctf_sim_list,
+                              epa_ln_f_bg_list, ccc_list)
+    axarr[0].set_title(
+        'Resolution limits: {} A at 0.8 CCC and {} A at 0.5 CCC'.format(
+            str(round(res_limits[0.8], 2)),
+            str(round(res_limits[0.5], 2)),
+        ))
+
+    _plot_subset(axarr[1], resolution_list, ctf_sim_list, epa_ln_f_bg_list,
+                 ccc_list, res_min=10)
+    axarr[1].set_title('20 A to 10 A')
+    _plot_subset(axarr[2], resolution_list, ctf_sim_list, epa_ln_f_bg_list,
+                 ccc_list, res_max=10, res_min=5)
+    axarr[2].set_title('10 A to 5 A')
+    _plot_subset(axarr[3], resolution_list, ctf_sim_list, epa_ln_f_bg_list,
+                 ccc_list, res_max=5, res_min=2)
+    axarr[3].set_title('5 A to 2 A')
+
+    plt.tight_layout()
+    plt.savefig(output_file)
+    plt.clf()
@@ -1,24 +1,62 @@
 import os
+import threading
+import time
+from functools import partial
 
 import pexpect
-from subprocess import call
 from Tkinter import Tk, Label, Button, Entry
 
 import pyworkflow.protocol.params as params
 import pyworkflow.utils as pwutils
 from protocol_monitor import ProtMonitor, Monitor, PrintNotifier
-from pyworkflow.em.protocol import ProtImportMovies
+from pyworkflow.em.protocol import (ProtAlignMovies, ProtCTFMicrographs,
+                                    ProtImportMovies)
+from protocol_qc_monitor import ProtQCSummary
+from set_cursor import SetCursor
+from ssh_pool import SSHConnectionPool, quote
+from step_profiler import StepProfiler, summarize_tick
+from transfer_telemetry import TransferTelemetry, summarize_telemetry
+from transfer_scheduler import TransferScheduler, TokenBucket
+from transfer_rules import (TransferRule, PendingFiles, own_name,
+                            prefixed_name)
+from staging_cache import StagingCache, scan
+from parallel_gzip import compress_file, iter_compressed, iter_blocks
+from stream_transfer import stream_to_remote, stream_to_remotes
+from chunked_transfer import ChunkedSender
+import mrc_codec
+from transfer_tuner import TransferTuner
+from transfer_backends import BACKEND_NAMES
+from transfer_destination import TransferDestination, parse_destinations
+from transfer_ledger import TransferLedger, file_checksum, SENT, FAILED
 
 
-def checkRemoteFile(user, host, path, password=None):
-    child = pexpect.spawn(' '.join([
-        'ssh', '{}@{}'.format(user, host), 'test', '-f', path,
-    ]))
-    if child.expect(['password:', pexpect.EOF]) == 0:
-        child.sendline(password)
-        child.expect(pexpect.EOF)
-    child.close()
-    return child.exitstatus == 0
+def _ctf_files(ctf):
+    psd_file = ctf.getPsdFile()
+    return prefixed_name(psd_file) + \
+        prefixed_name(os.path.splitext(psd_file)[0] + '_EPA.txt')
+
+
+def _qc_files(prot):
+    return own_name(prot._getPath('extra', 'compiled_qc_fields.txt')) + \
+        own_name(prot._getPath('extra', 'session_statistics.json'))
+
+
+#  Small outputs downstream processing starts from go ahead of the movies
+TRANSFER_RULES = [
+    TransferRule('qc', ProtQCSummary, 0, _qc_files),
+    TransferRule('micrograph', ProtAlignMovies, 1,
+                 lambda mic: own_name(mic.getFileName()),
+                 set_name='outputMicrographs'),
+    TransferRule('ctf', ProtCTFMicrographs, 2, _ctf_files,
+                 set_name='outputCTF'),
+    TransferRule('movie', ProtImportMovies, 5,
+                 lambda movie: own_name(movie.getFileName()),
+                 set_name='outputMovies', compress=True),
+]
+
+#  Seconds a destination may keep a shared stream waiting before it is
+#  dropped from it and retried on its own
+STREAM_STALL = 60
 
 
 def check_password(user, host, password):
@@ -76,11 +114,79 @@ class ProtTransfer(ProtMonitor):
         ProtMonitor._defineParams(self, form)
 
         form.addParam('transferMethod', params.EnumParam, default=0,
-                      choices=['scp', 'bbcp'], label='Transfer method')
+                      choices=BACKEND_NAMES, label='Transfer method',
+                      help='local copies into a mounted destination '
+                           'directory (NFS, Lustre) without SSH; the '
+                           'destination host and user are then not used.')
+
+        form.addParam('adaptiveTuning', params.BooleanParam, default=True,
+                      condition='transferMethod == 1',
+                      label='Tune bbcp window and streams?',
+                      help='Learn from the measured throughput which window '
+                           'size and stream count work best for the '
+                           'destination host. What is learnt is kept in '
+                           'extra/transfer_tuning.json.')
+
+        form.addParam('calibrate', params.BooleanParam, default=False,
+                      condition='transferMethod == 1 and adaptiveTuning',
+                      label='Calibrate before transferring?',
+                      help='Send a synthetic file with a sweep of bbcp '
+                           'settings before the first movie.')
+
+        form.addParam('calibrationSize', params.IntParam, default=512,
+                      condition='transferMethod == 1 and adaptiveTuning '
+                                'and calibrate',
+                      label='Calibration file size (MB)')
 
         form.addParam('compress', params.BooleanParam, default=True,
                       label='Compress before transfer?')
 
+        form.addParam('codec', params.EnumParam, default=0,
+                      choices=['gzip', 'mrc', 'auto'], condition='compress',
+                      label='Compression codec',
+                      help='mrc packs integer-valued MRC movies to the '
+                           'fewest bits before deflating them, into .mrcz '
+                           'files restored with "mrc_codec.py decode". auto '
+                           'uses it for each MRC movie whose first frame '
+                           'is integer-valued and gzip otherwise.')
+
+        form.addParam('compressionLevel', params.IntParam, default=6,
+                      condition='compress', label='Compression level',
+                      help='gzip level from 1 (fastest) to 9 (smallest).')
+
+        form.addParam('compressionThreads', params.IntParam, default=4,
+                      condition='compress', label='Compression threads',
+                      help='Blocks of each movie are compressed in parallel '
+                           'by this many threads.')
+
+        form.addParam('stagingBudget', params.FloatParam, default=0,
+                      condition='compress and not streamTransfer',
+                      label='Staging space (GB)',
+                      help='Most space compressed movies waiting in the '
+                           'extra directory may take. The oldest ones '
+                           'already transferred are deleted to make room, '
+                           'and compression pauses while none can be. Use 0 '
+                           'for no limit.')
+
+        form.addParam('streamTransfer', params.BooleanParam, default=False,
+                      label='Stream without local copies?',
+                      help='Send the (compressed) movie straight over SSH '
+                           'while it is read, instead of writing a .gz to '
+                           'the extra directory first. The transfer method '
+                           'is then not used.')
+
+        form.addParam('chunkedTransfer', params.BooleanParam, default=False,
+                      condition='not streamTransfer',
+                      label='Resumable chunked transfers?',
+                      help='Send files in checksummed chunks over SSH. An '
+                           'interrupted transfer resumes from the first '
+                           'chunk the destination did not acknowledge. The '
+                           'transfer method is then not used.')
+
+        form.addParam('chunkSize', params.IntParam, default=64,
+                      condition='chunkedTransfer and not streamTransfer',
+                      label='Chunk size (MB)')
+
         form.addParam('destinationHost', params.StringParam, default=None,
                       label='Destination host')
 
@@ -90,8 +196,74 @@ class ProtTransfer(ProtMonitor):
         form.addParam('destinationUser', params.StringParam, default=None,
                       label='Destination user name')
 
+        form.addParam('extraDestinations', params.TextParam, default='',
+                      label='Additional destinations',
+                      help='Further places to send every file to, one per '
+                           'line as user@host:directory, or as a directory '
+                           'with the local transfer method. Each file is '
+                           'read and compressed once for all destinations, '
+                           'and each destination keeps its own transfer '
+                           'slots, retries and ledger entries, so a slow '
+                           'one does not hold back the others. They use '
+                           'the password of the destination host, if one '
+                           'is asked for.')
+
+        form.addParam('sshPoolSize', params.IntParam, default=2,
+                      label='SSH connections',
+                      help='Number of multiplexed SSH master connections '
+                           'reused for remote checks and transfers.')
+
+        form.addParam('inventoryTTL', params.IntParam, default=60,
+                      label='Remote listing lifetime (sec)',
+                      help='How long a listing of the destination directory '
+                           'is reused before it is fetched again.')
+
+        form.addParam('transferSlots', params.IntParam, default=2,
+                      label='Concurrent transfers',
+                      help='Number of files sent at the same time to each '
+                           'destination. The next files are compressed '
+                           'while these are sent.')
+
+        form.addParam('bandwidthLimit', params.FloatParam, default=0,
+                      label='Bandwidth limit (MB/s)',
+                      help='Total rate shared by all the concurrent '
+                           'transfers to all the destinations, so that the '
+                           'microscope storage is not starved. Use 0 for '
+                           'no limit.')
+
+        form.addParam('agingInterval', params.IntParam, default=60,
+                      label='Queue aging (sec)',
+                      help='Outputs of QC, alignment and CTF protocols '
+                           'among the inputs are sent ahead of movies. A '
+                           'queued file moves up one priority level for '
+                           'every this many seconds it waits, so movies are '
+                           'never starved.')
+
+        form.addParam('transferRetries', params.IntParam, default=3,
+                      label='Retries per file',
+                      help='A failed file is tried again after 30 s, then '
+                           'after twice as long each time.')
+
+        form.addParam('profileEvery', params.IntParam, default=0,
+                      label='cProfile every N ticks',
+                      help='Write a cProfile dump of every Nth tick to the '
+                           'extra directory. Use 0 to disable.')
+
     def _validate(self):
         errors = []
+        if BACKEND_NAMES[self.transferMethod.get()] == 'local' and (
+                self.streamTransfer.get() or self.chunkedTransfer.get()):
+            errors.append('Streaming and chunked transfers need SSH; they '
+                          'cannot be used with the local transfer method.')
+        local = BACKEND_NAMES[self.transferMethod.get()] == 'local'
+        for user, host, directory in parse_destinations(
+                self.extraDestinations.get()):
+            if local and host is not None:
+                errors.append('{}@{}:{} is not a local directory.'.format(
+                    user, host, directory))
+            elif not local and not (user and host):
+                errors.append('{} is not of the form user@host:directory.'
+                              .format(directory))
         return errors
 
     def _insertAllSteps(self):
@@ -107,12 +279,35 @@ class ProtTransfer(ProtMonitor):
             samplingInterval=self.samplingInterval.get(),
             monitorTime=100,
             compress=self.compress.get(),
+            codec=self.codec.get(),
+            compressionLevel=self.compressionLevel.get(),
+            compressionThreads=self.compressionThreads.get(),
+            stagingBudget=self.stagingBudget.get(),
+            streamTransfer=self.streamTransfer.get(),
+            chunkedTransfer=self.chunkedTransfer.get(),
+            chunkSize=self.chunkSize.get(),
             transferMethod=self.transferMethod.get(),
+            adaptiveTuning=self.adaptiveTuning.get(),
+            calibrate=self.calibrate.get(),
+            calibrationSize=self.calibrationSize.get(),
             destinationHost=host,
             destinationDirectory=self.destinationDirectory.get(),
             destinationUser=user,
+            extraDestinations=self.extraDestinations.get(),
+            profileEvery=self.profileEvery.get(),
+            sshPoolSize=self.sshPoolSize.get(),
+            inventoryTTL=self.inventoryTTL.get(),
+            transferSlots=self.transferSlots.get(),
+            bandwidthLimit=self.bandwidthLimit.get(),
+            transferRetries=self.transferRetries.get(),
+            agingInterval=self.agingInterval.get(),
         )
 
+        if BACKEND_NAMES[self.transferMethod.get()] == 'local':
+            monitor.addNotifier(PrintNotifier())
+            monitor.loop()
+            return
+
         get_password = False
         check_ssh = pexpect.spawn(' '.join([
             'ssh',
@@ -158,100 +353,701 @@ class TransferMonitor(Monitor):
         self.run_count = 1
 
         self.compress = kwargs['compress']
-        if kwargs['transferMethod'] == 0:
-            self.transferMethod = 'scp'
-        elif kwargs['transferMethod'] == 1:
-            self.transferMethod = 'bbcp'
-
-        self.destinationHost = kwargs['destinationHost']
-        self.destinationDirectory = kwargs['destinationDirectory']
-        if not self.destinationDirectory:
-            self.destinationDirectory = ''
-        self.destinationUser = kwargs['destinationUser']
+        self.codec = ['gzip', 'mrc', 'auto'][kwargs.get('codec', 0)]
+        self._codecs = dict()  # Movie file -> codec chosen for it
+        self.compressionLevel = kwargs.get('compressionLevel', 6)
+        self.compressionThreads = kwargs.get('compressionThreads', 4)
+        self.streamTransfer = kwargs.get('streamTransfer', False)
+        self.chunkedTransfer = kwargs.get('chunkedTransfer', False)
+        self.chunkSize = kwargs.get('chunkSize', 64)
+        self.transferMethod = BACKEND_NAMES[kwargs['transferMethod']]
 
         self.password = None
+        self.sshPoolSize = kwargs.get('sshPoolSize', 2)
+        self._ssh_pools = dict()  # (user, host) -> SSHConnectionPool
+        self._pool_lock = threading.Lock()
+
+        #  The primary destination first, then the additional ones
+        self.destinations = [
+            TransferDestination(user, host, directory, self.transferMethod,
+                                self.getSSHPool,
+                                inventory_ttl=kwargs.get('inventoryTTL', 60))
+            for user, host, directory in
+            [(kwargs['destinationUser'], kwargs['destinationHost'],
+              kwargs['destinationDirectory'])] +
+            parse_destinations(kwargs.get('extraDestinations'))
+        ]
+
+        self.tuner = None
+        if self.destinations[0].backend.tunable and \
+                kwargs.get('adaptiveTuning', True):
+            self.tuner = TransferTuner(os.path.join(
+                self.workingDir, 'extra', 'transfer_tuning.json'))
+        self.calibrateFirst = kwargs.get('calibrate', False)
+        self.calibrationSize = kwargs.get('calibrationSize', 512)
+
+        #  Only set items added since the previous tick are visited
+        self.set_cursor = SetCursor()
+        self.rules = TRANSFER_RULES
+        #  Files of set items that were not written yet when visited
+        self.pending_files = PendingFiles()
+
+        #  Files are prepared once, then handed to a scheduler per
+        #  destination, so each destination retries and backs off alone;
+        #  all of them draw on one bandwidth limit
+        slots = kwargs.get('transferSlots', 2)
+        bandwidth = kwargs.get('bandwidthLimit', 0)
+        self.bucket = TokenBucket(bandwidth * 1024 * 1024) \
+            if bandwidth else None
+        retries = kwargs.get('transferRetries', 3)
+        aging = kwargs.get('agingInterval', 60) or None
+        self.scheduler = TransferScheduler(
+            self.prepareFile, self.fanOut, slots=slots, retries=retries,
+            aging=aging)
+        for destination in self.destinations:
+            destination.scheduler = TransferScheduler(
+                partial(self.checkDestination, destination),
+                partial(self.sendFile, destination),
+                slots=slots, bucket=self.bucket,
+                retries=retries, aging=aging,
+                on_finish=self._destinationFinished)
+
+        #  Prepared files handed to the destinations and not yet finished
+        #  by all of them; at most two per slot, as when each send slot
+        #  has one file waiting, so compression cannot run far ahead
+        self.maxOutstanding = 2 * max(1, slots)
+        self._outstanding = dict()  # (item, file) -> destinations left
+        self._outstanding_changed = threading.Condition(threading.Lock())
+        self._closing = False
+
+        self.profiler = StepProfiler(
+            os.path.join(self.workingDir, 'extra', 'step_profile.jsonl'),
+            profile_every=kwargs.get('profileEvery', 0),
+        )
+
+        self.telemetry = TransferTelemetry(
+            os.path.join(self.workingDir, 'extra', 'transfer_telemetry.jsonl'),
+            os.path.join(self.workingDir, 'extra', 'transfer.prom'))
+        self._compress_times = dict()  # Source -> seconds spent compressing
+        self._source_sizes = dict()  # Source of each queued file -> bytes
+        #  Compressed file -> (source, os.stat() of the source when read)
+        self._source_stats = dict()
+        self._compressing = set()  # Compressed files being written
+        self._compressing_changed = threading.Condition(threading.Lock())
+
+        #  What was sent where survives restarts of the protocol
+        self.ledger = TransferLedger(
+            os.path.join(self.workingDir, 'extra', 'transfer_ledger.sqlite'))
+
+        self.staging = None
+        budget = kwargs.get('stagingBudget', 0)
+        if budget and self.compress and not self.streamTransfer:
+            staging_dir = os.path.join(os.getcwd(), self.workingDir, 'extra')
+            self.staging = StagingCache(
+                int(budget * 1024 ** 3), self.artifactSent,
+                scan(staging_dir, ['.gz', '.mrcz']),
+                is_abandoned=self.artifactAbandoned)
+        self._staging_reported = (0, 0, False)  # Evictions, abandoned, paused
+        self._abandoned = set()  # Artifacts a destination gave up on
+
+    def getSSHPool(self, user, host):
+        '''
+        Returns the connection pool to a host, created on first use so that
+        it picks up the password
+        '''
+        with self._pool_lock:
+            if (user, host) not in self._ssh_pools:
+                self._ssh_pools[(user, host)] = SSHConnectionPool(
+                    user, host, size=self.sshPoolSize,
+                    password=self.password)
+        return self._ssh_pools[(user, host)]
+
+    def schedulers(self):
+        return [self.scheduler] + \
+            [destination.scheduler for destination in self.destinations]
+
+    def loop(self):
+        if self.tuner is not None and self.calibrateFirst:
+            self.calibrateTransfers()
+        for scheduler in self.schedulers():
+            scheduler.start()
+        try:
+            Monitor.loop(self)
+            #  Let the files already queued finish before exiting; files
+            #  are handed to the destinations until preparation is done
+            for scheduler in self.schedulers():
+                scheduler.drain()
+            self.collectResults()
+        finally:
+            with self._outstanding_changed:
+                self._closing = True
+                self._outstanding_changed.notify_all()
+            if self.staging is not None:
+                self.staging.close()
+            for scheduler in self.schedulers():
+                scheduler.stop()
+            for pool in self._ssh_pools.values():
+                pool.close()
+            self.ledger.close()
 
     def step(self):
+        self.profiler.start_tick()
+
+        #  Files that ran out of retries, e.g. during an outage, are tried
+        #  again once the longest backoff has passed, unless they are gone
+        for scheduler in self.schedulers():
+            resubmitted = scheduler.resubmit_given_up(
+                keep=self.sourceExists)
+            if resubmitted:
+                self.profiler.count('files_resubmitted', resubmitted)
 
         for protPointer in self.protocol.inputProtocols:
             prot = protPointer.get()
 
-            if isinstance(prot, ProtImportMovies):
-                for movie in prot.outputMovies:
-                    movie_base_name = \
-                        os.path.splitext(os.path.basename(
-                            movie.getFileName()))[0]
-
-                    #  Transfer movie file:
-                    transfer_file = os.path.join(
-                        os.getcwd(),
-                        movie.getFileName(),
-                    )
-
-                    #  Compress movie file
-                    if self.compress:
-                        compressed_movie_file = os.path.join(
-                            os.getcwd(),
-                            self.workingDir,
-                            'extra',
-                            movie_base_name + '.gz',
-                        )
-                        if not os.path.isfile(compressed_movie_file):
-                            self.info('Compressing {} by gzip.'.format(
-                                os.path.basename(movie.getFileName()),
-                            ))
-                            with open(compressed_movie_file, 'w') as OUT:
-                                call([
-                                    'gzip', '-c',
-                                    movie.getFileName(),
-                                ], stdout=OUT)
-                        transfer_file = compressed_movie_file
-
-                    #  Perform transfer
-                    user = self.destinationUser
-                    host = self.destinationHost
-                    path = os.path.join(self.destinationDirectory,
-                        os.path.basename(transfer_file))
-
-                    if not checkRemoteFile(user, host, path, self.password):
-
-                        if self.destinationDirectory == '':
-                            destination_dir = '.'
-                        else:
-                            destination_dir = self.destinationDirectory
-
-                        if self.transferMethod == 'scp':
-                            self.info('Sending {} to {} by scp.'.format(
-                                os.path.basename(transfer_file),
-                                self.destinationHost,
-                            ))
-                            child = pexpect.spawn(' '.join([
-                                'scp',
-                                transfer_file,
-                                self.destinationUser + '@' +
-                                self.destinationHost + ':' +
-                                destination_dir,
-                            ]))
-                            if child.expect(['password:', pexpect.EOF],
-                                            timeout=None) == 0:
-                                child.sendline(self.password)
-                                child.expect(pexpect.EOF)
-                            child.close()
-
-                        elif self.transferMethod == 'bbcp':
-                            self.info('Sending {} to {} by bbcp.'.format(
-                                os.path.basename(transfer_file),
-                                self.destinationHost,
-                            ))
-                            child = pexpect.spawn(' '.join([
-                                'bbcp', '-w', '8m', '-s', '16',
-                                transfer_file,
-                                self.destinationUser + '@' +
-                                self.destinationHost + ':' +
-                                destination_dir,
-                            ]))
-                            if child.expect(['password:', pexpect.EOF],
-                                            timeout=None) == 0:
-                                child.sendline(self.password)
-                                child.expect(pexpect.EOF)
-                            child.close()
+            for rule in self.rules:
+                if not rule.matches(prot):
+                    continue
+                for item in rule.iter_items(prot, self.set_cursor,
+                                            self.profiler.timed_iter,
+                                            self.pending_files):
+                    if self.scheduler.submit(item, item.priority):
+                        self.profiler.count('files_queued')
+
+        for item in self.pending_files.ready():
+            if self.scheduler.submit(item, item.priority):
+                self.profiler.count('files_queued')
+
+        self.collectResults()
+        self.reportStaging()
+        self.reportTelemetry()
+
+        record = self.profiler.end_tick()
+        if record['counters']:
+            self.info(summarize_tick(record))
+
+    def collectResults(self):
+        '''
+        Accounts for the jobs the schedulers finished since the last call
+        '''
+        for result in self.scheduler.poll():
+            self.profiler.add_time('worker_prepare', result.prepare_time)
+            self.profiler.add_time('worker_transfer', result.send_time)
+            #  Only the first time a file is given up is notified
+            if not result.success and not result.resubmits:
+                self.profiler.count('files_failed')
+                self.notify('Transfer failed', '{} failed after {} attempts: '
+                            '{}'.format(result.key.name, result.attempts,
+                                        result.error))
+            elif result.bytes:
+                #  Streamed to several destinations in one pass
+                self.profiler.count('{}_files_transferred'.format(
+                    result.key.kind))
+                self.profiler.count('bytes_moved', result.bytes)
+
+        for destination in self.destinations:
+            for result in destination.scheduler.poll():
+                item = result.key[0]
+                self.profiler.add_time('worker_transfer', result.send_time)
+                if not result.success or result.bytes:
+                    self.telemetry.file_done(
+                        item.name, item.kind, destination.label,
+                        result.success, self.sourceSize(item.source),
+                        result.bytes,
+                        self._compress_times.pop(
+                            item.source,
+                            None if self.streamTransfer else 0.),
+                        result.send_time, max(0, result.attempts - 1),
+                        result.error)
+                if not result.success:
+                    if not result.resubmits:
+                        self.profiler.count('files_failed')
+                        self.notify('Transfer failed', '{} to {} failed '
+                                    'after {} attempts: {}'.format(
+                                        item.name, destination.label,
+                                        result.attempts, result.error))
+                    self._abandoned.add(result.key[1])
+                    continue
+                self._abandoned.discard(result.key[1])
+                if result.bytes:
+                    self.profiler.count('{}_files_transferred'.format(
+                        item.kind))
+                    self.profiler.count('bytes_moved', result.bytes)
+                else:
+                    self.profiler.count('files_skipped')
+
+    def reportStaging(self):
+        '''
+        Reports staging space use when files were evicted or compression
+        paused or resumed since the last report
+        '''
+        if self.staging is None:
+            return
+        state = (self.staging.evictions, self.staging.abandoned,
+                 self.staging.paused)
+        if state == self._staging_reported:
+            return
+        evicted = state[0] - self._staging_reported[0]
+        abandoned = state[1] - self._staging_reported[1]
+        self._staging_reported = state
+        self.profiler.count('staging_evictions', evicted)
+        message = 'Staging: {:.1f} of {:.1f} GB used, {} files evicted ' \
+            '({:.1f} GB in total).'.format(
+                self.staging.usage() / 1024. ** 3,
+                self.staging.budget / 1024. ** 3,
+                self.staging.evictions,
+                self.staging.evicted_bytes / 1024. ** 3)
+        if abandoned:
+            self.notify('Untransferred files evicted', message + ' {} of '
+                        'them had not reached every destination; they are '
+                        'compressed again when retried.'.format(abandoned))
+        if state[2]:
+            self.notify('Compression paused', message + ' Compression is '
+                        'paused until transferred files can be evicted.')
+        elif not abandoned:
+            self.info(message)
+
+    def sourceSize(self, source):
+        if source not in self._source_sizes:
+            try:
+                self._source_sizes[source] = os.path.getsize(source)
+            except OSError:
+                self._source_sizes[source] = 0
+        return self._source_sizes[source]
+
+    def reportTelemetry(self):
+        '''
+        Records the backlog of each queue and summarizes throughput while
+        there is anything to report
+        '''
+        queued = dict()
+        pending = dict()  # Source -> times it is still to be sent
+        for item in self.scheduler.queued():
+            pending[item.source] = pending.get(item.source, 0) + \
+                len(self.destinations)
+        queued['preparing'] = len(pending)
+        for destination in self.destinations:
+            jobs = destination.scheduler.queued()
+            for item, _ in jobs:
+                pending[item.source] = pending.get(item.source, 0) + 1
+            queued[destination.label] = len(jobs)
+
+        pending_bytes = sum(self.sourceSize(source) * n
+                            for source, n in pending.items())
+        #  Sizes are only kept for files still queued
+        self._source_sizes = dict((source, self._source_sizes[source])
+                                  for source in pending)
+        for artifact, (source, _) in list(self._source_stats.items()):
+            if source not in pending:
+                self._source_stats.pop(artifact, None)
+
+        record = self.telemetry.tick(queued, pending_bytes)
+        if record['queued_files'] or record['finished_files']:
+            self.info(summarize_telemetry(record))
+
+    @staticmethod
+    def sourceExists(key):
+        '''
+        Keys are items in the main scheduler and (item, file) jobs in those
+        of the destinations
+        '''
+        item = key if hasattr(key, 'source') else key[0]
+        return os.path.exists(item.source)
+
+    def pendingDestinations(self, item):
+        return [destination for destination in self.destinations
+                if not self.ledger.is_current(item.source, destination.key)]
+
+    def prepareFile(self, item):
+        '''
+        Compresses a movie if needed; returns the file to send, or None if
+        every destination already has it. Runs in a scheduler worker.
+        '''
+        if not self.pendingDestinations(item):
+            return None
+
+        #  Transfer file:
+        transfer_file = os.path.join(
+            os.getcwd(),
+            item.source,
+        )
+
+        if self.streamTransfer:
+            return transfer_file
+
+        #  Compress movie file
+        if self.compresses(item):
+            compressed_movie_file = os.path.join(
+                os.getcwd(),
+                self.workingDir,
+                'extra',
+                self.remoteName(item),
+            )
+            self._compressOnce(item, compressed_movie_file)
+            transfer_file = compressed_movie_file
+
+        return transfer_file
+
+    def _compressOnce(self, item, compressed_file):
+        '''
+        Compresses the movie unless compressed_file exists. Destinations
+        recompressing an evicted file may race the main preparation worker
+        and each other, so only one of them writes it and the others wait.
+        '''
+        with self._compressing_changed:
+            while compressed_file in self._compressing:
+                self._compressing_changed.wait()
+            if os.path.isfile(compressed_file):
+                return
+            self._compressing.add(compressed_file)
+        try:
+            self._compress(item, compressed_file)
+        finally:
+            with self._compressing_changed:
+                self._compressing.discard(compressed_file)
+                self._compressing_changed.notify_all()
+
+    def _compress(self, item, compressed_file):
+        if self.codecFor(item.source) == 'mrc':
+            compress = mrc_codec.encode_file
+        else:
+            compress = compress_file
+        #  Compressed size is not known up front; the movie's own size is
+        #  the upper bound
+        reserved = self.staging.reserve(os.path.getsize(item.source)) \
+            if self.staging is not None else 0
+        source_stat = os.stat(item.source)
+        try:
+            stats = compress(
+                item.source, compressed_file,
+                level=self.compressionLevel,
+                threads=self.compressionThreads)
+        except Exception:
+            if self.staging is not None:
+                self.staging.release(reserved)
+            raise
+        if self.staging is not None:
+            self.staging.add(compressed_file, reserved)
+        self._source_stats[compressed_file] = (item.source, source_stat)
+        self._compress_times[item.source] = stats.seconds
+        self.info('Compressed {}: {}.'.format(
+            os.path.basename(item.source), stats))
+
+    def fanOut(self, item, transfer_file, rate_limit=None):
+        '''
+        Hands a prepared file to the scheduler of every destination, or in
+        stream mode streams it to all of them in one pass; returns the
+        bytes streamed. Blocks while maxOutstanding files are still being
+        sent. Runs in a scheduler worker.
+        '''
+        if self.streamTransfer:
+            return self._streamAll(item, transfer_file)
+
+        job = (item, transfer_file)
+        with self._outstanding_changed:
+            if job in self._outstanding:
+                return 0
+            while len(self._outstanding) >= self.maxOutstanding and \
+                    not self._closing:
+                self._outstanding_changed.wait(1.)
+            if self._closing:
+                return None
+            self._outstanding[job] = len(self.destinations)
+
+        submitted = len([destination for destination in self.destinations
+                         if destination.scheduler.submit(job, item.priority)])
+        #  Destinations already sending it from an earlier attempt will not
+        #  report back for this one
+        self._destinationsDone(job, len(self.destinations) - submitted)
+        return 0
+
+    def _destinationFinished(self, result):
+        self._destinationsDone(result.key, 1)
+
+    def _destinationsDone(self, job, n):
+        with self._outstanding_changed:
+            if job not in self._outstanding or not n:
+                return
+            self._outstanding[job] -= n
+            if self._outstanding[job] <= 0:
+                del self._outstanding[job]
+                self._outstanding_changed.notify_all()
+
+    def checkDestination(self, destination, job):
+        '''
+        Returns the file to send to destination, or None if it is already
+        there. Runs in the destination's scheduler worker.
+        '''
+        item, transfer_file = job
+        if self.ledger.is_current(item.source, destination.key):
+            return None
+        if not self.streamTransfer and not os.path.isfile(transfer_file):
+            #  Evicted from staging after an earlier attempt was given up
+            transfer_file = self.prepareFile(item)
+            if transfer_file is None:
+                return None
+        size = None if self.streamTransfer else \
+            os.path.getsize(transfer_file)
+        if self.onDestination(destination, item, transfer_file, size):
+            return None
+        return transfer_file
+
+    def onDestination(self, destination, item, transfer_file, size=None):
+        '''
+        True if destination already has the file, which is then recorded
+        as sent
+        '''
+        if item.rewritten:
+            #  Only the ledger can tell whether the remote copy is current
+            return False
+        #  Files only get their final name once complete
+        name = self.remoteName(item)
+        if not destination.inventory().exists(name, size):
+            return False
+        if size is None:
+            self.ledger.record(item.source, destination.key, SENT,
+                               artifact=name)
+        else:
+            self.ledger.record(item.source, destination.key, SENT,
+                               artifact=transfer_file, artifact_size=size)
+            self.confirmed()
+        return True
+
+    def sendFile(self, destination, job, transfer_file, rate_limit=None):
+        '''
+        Sends a prepared file to destination; returns the bytes sent, or
+        None on failure. Runs in the destination's scheduler worker.
+        '''
+        item = job[0]
+        if self.streamTransfer:
+            return self._stream(destination, item, transfer_file)
+        if self.chunkedTransfer:
+            return self._sendChunked(destination, item, transfer_file)
+
+        name = self.remoteName(item)
+        size = os.path.getsize(transfer_file)
+        source_stat = self.sourceStat(item, transfer_file)
+
+        setting = self.tuner.choose(destination.host) \
+            if self.tuner is not None else None
+        start = time.time()
+        status = self._send(destination, transfer_file, rate_limit, setting,
+                            name)
+        if status == 0 and self.tuner is not None:
+            self.tuner.record(destination.host, setting, size,
+                              time.time() - start)
+
+        if status != 0:
+            self.ledger.record(item.source, destination.key, FAILED,
+                               artifact=transfer_file, artifact_size=size)
+            return None
+
+        checksum = file_checksum(transfer_file)
+        self.ledger.record(item.source, destination.key, SENT,
+                           artifact=transfer_file, artifact_size=size,
+                           checksum=checksum, source_stat=source_stat)
+        destination.inventory().record(name, size)
+        self.confirmed()
+        return size
+
+    def sourceStat(self, item, transfer_file):
+        '''
+        os.stat() of the source as it was read for transfer_file: when it
+        was compressed, or now if it is sent as is. Taken before the read,
+        so a source rewritten meanwhile is not recorded as sent.
+        '''
+        if transfer_file in self._source_stats:
+            return self._source_stats[transfer_file][1]
+        return os.stat(item.source)
+
+    def artifactSent(self, artifact):
+        return self.ledger.artifact_sent(
+            artifact, [destination.key for destination in self.destinations])
+
+    def artifactAbandoned(self, artifact):
+        '''
+        True if a destination gave up on artifact and none is still trying
+        to send it, so it may be evicted and compressed again if retried
+        '''
+        if artifact not in self._abandoned:
+            return False
+        return not any(key[1] == artifact
+                       for destination in self.destinations
+                       for key in destination.scheduler.queued())
+
+    def confirmed(self):
+        if self.staging is not None:
+            self.staging.confirmed()
+
+    def compresses(self, item):
+        return self.compress and item.compress
+
+    def codecFor(self, movie_file):
+        if self.codec != 'auto':
+            return self.codec
+        if movie_file not in self._codecs:
+            self._codecs[movie_file] = 'mrc' \
+                if mrc_codec.is_packable(movie_file) else 'gzip'
+        return self._codecs[movie_file]
+
+    def remoteName(self, item):
+        name = item.name
+        if self.compresses(item):
+            extension = '.mrcz' if self.codecFor(item.source) == 'mrc' \
+                else '.gz'
+            name = os.path.splitext(name)[0] + extension
+        return name
+
+    def _chunks(self, item, INPUT):
+        if self.compresses(item) and self.codecFor(item.source) == 'mrc':
+            return mrc_codec.iter_encoded(INPUT, self.compressionLevel,
+                                          self.compressionThreads)
+        elif self.compresses(item):
+            return iter_compressed(INPUT, self.compressionLevel,
+                                   self.compressionThreads)
+        return iter_blocks(INPUT)
+
+    def _recordStream(self, destination, item, result, source_stat):
+        name = self.remoteName(item)
+        if result is None:
+            self.ledger.record(item.source, destination.key, FAILED,
+                               artifact=name)
+            return None
+        size, checksum = result
+        self.ledger.record(item.source, destination.key, SENT, artifact=name,
+                           artifact_size=size, checksum=checksum,
+                           source_stat=source_stat)
+        destination.inventory().record(name, size)
+        return size
+
+    def _streamAll(self, item, source_file):
+        '''
+        Compresses a movie once and streams it to every destination that
+        still needs it. A destination that fails or falls behind is left
+        to its own scheduler, which retries it alone.
+        '''
+        destinations = [
+            destination for destination in self.pendingDestinations(item)
+            if not self.onDestination(destination, item, source_file)]
+        if not destinations:
+            return 0
+        name = self.remoteName(item)
+        self.info('Streaming {} to {}.'.format(
+            name, ', '.join(d.label for d in destinations)))
+
+        start = time.time()
+        source_stat = os.stat(source_file)
+        with open(source_file, 'rb') as INPUT:
+            results = stream_to_remotes(
+                [(d.pool(), d.remote_path(name), self.bucket)
+                 for d in destinations],
+                self._chunks(item, INPUT),
+                stall=STREAM_STALL if len(destinations) > 1 else None)
+
+        seconds = time.time() - start
+
+        sent = 0
+        for destination, result in zip(destinations, results):
+            size = self._recordStream(destination, item, result,
+                                      source_stat)
+            if size is None:
+                destination.scheduler.submit((item, source_file),
+                                             item.priority)
+                continue
+            #  Failures are reported once the destination gives up
+            self.telemetry.file_done(
+                item.name, item.kind, destination.label, True,
+                source_stat.st_size, size, None, seconds)
+            sent += size
+        return sent
+
+    def _stream(self, destination, item, source_file):
+        '''
+        Compresses and sends a movie in one pass, with no staging file
+        '''
+        name = self.remoteName(item)
+        self.info('Streaming {} to {}.'.format(name, destination.label))
+
+        source_stat = os.stat(source_file)
+        with open(source_file, 'rb') as INPUT:
+            result = stream_to_remote(
+                destination.pool(), self._chunks(item, INPUT),
+                destination.remote_path(name),
+                bucket=self.bucket)
+        return self._recordStream(destination, item, result, source_stat)
+
+    def calibrateTransfers(self):
+        '''
+        Sends a synthetic file with each calibration setting to each
+        destination host and starts the tuner from the fastest
+        '''
+        calibration_file = os.path.join(
+            os.getcwd(), self.workingDir, 'extra', 'calibration.bin')
+        size = self.calibrationSize * 1024 * 1024
+        #  Random data, so that nothing on the way can compress it
+        with open(calibration_file, 'wb') as OUTPUT:
+            for _ in range(self.calibrationSize):
+                OUTPUT.write(os.urandom(1024 * 1024))
+
+        try:
+            calibrated = set()
+            for destination in self.destinations:
+                if destination.host in calibrated:
+                    continue
+                calibrated.add(destination.host)
+                self._calibrate(destination, calibration_file, size)
+        finally:
+            os.remove(calibration_file)
+
+    def _calibrate(self, destination, calibration_file, size):
+        remote_file = destination.remote_path('calibration.bin')
+
+        def send(window, streams):
+            status = self._send(destination, calibration_file,
+                                setting=(window, streams))
+            destination.pool().run('rm -f {}'.format(quote(remote_file)))
+            return status == 0
+
+        results = self.tuner.calibrate(destination.host, send, size)
+        self.info('Calibration to {}: {}.'.format(
+            destination.host, ', '.join(
+                '-w {}m -s {} {}'.format(
+                    w, s, '{:.1f} MB/s'.format(rate) if rate else 'failed')
+                for (w, s), rate in results)))
+
+    def _sendChunked(self, destination, item, transfer_file):
+        '''
+        Sends a prepared file in chunks, resuming an interrupted attempt
+        '''
+        name = self.remoteName(item)
+        size = os.path.getsize(transfer_file)
+        source_stat = self.sourceStat(item, transfer_file)
+        self.info('Sending {} to {} in chunks.'.format(
+            name, destination.label))
+
+        sender = ChunkedSender(destination.pool(), self.ledger,
+                               chunk_size=self.chunkSize * 1024 * 1024,
+                               bucket=self.bucket)
+        result = sender.send(item.source, destination.key, transfer_file,
+                             destination.remote_path(name))
+
+        if result is None:
+            self.ledger.record(item.source, destination.key, FAILED,
+                               artifact=transfer_file, artifact_size=size)
+            return None
+        sent, checksum = result
+        self.ledger.record(item.source, destination.key, SENT,
+                           artifact=transfer_file, artifact_size=size,
+                           checksum=checksum, source_stat=source_stat)
+        destination.inventory().record(name, size)
+        self.confirmed()
+        return sent
+
+    def _send(self, destination, transfer_file, rate_limit=None,
+              setting=None, name=None):
+        self.info('Sending {} to {} by {}.'.format(
+            name or os.path.basename(transfer_file),
+            destination.label,
+            self.transferMethod,
+        ))
+        return destination.backend.send(transfer_file, destination.remote_dir,
+                                        rate_limit, setting, name)
@@ -0,0 +1,185 @@
+import os
+import argparse
+import csv
+import heapq
+import json
+import time
+
+from pyworkflow.manager import Manager
+
+from protocol_monitor import PrintNotifier
+from protocol_qc_monitor import QCMonitor, dict_factory, standardize_label
+from qc_resources import RenderPool, SqliteReaderCache
+
+FACILITY_FIELDS = [
+    'Project',
+    'Movies',
+    'Flagged',
+    'Last Tick',
+    'Tick Seconds',
+    'Mean DF1',
+    'Mean DF1-DF2',
+    'Mean CCC',
+    'Mean Average Drift',
+    'Mean Maximum Drift',
+]
+
+
+class ProjectEntry(object):
+
+    def __init__(self, name, monitor, interval):
+        self.name = name
+        self.monitor = monitor
+        self.interval = interval
+        self.last_tick = None
+        self.tick_seconds = None
+
+    def summary(self):
+        statistics = self.monitor.statistics.summary()
+        return {
+            'project': self.name,
+            'movies': len(self.monitor.txt_fields),
+            'flagged': len(self.monitor.flagged_movies),
+            'last_tick': self.last_tick,
+            'tick_seconds': self.tick_seconds,
+            'statistics': statistics,
+        }
+
+
+class QCAggregator(object):
+    '''
+    Runs QC monitors for several Scipion projects from one process.
+
+    All monitors share one rendering pool and one SQLite reader cache. Ticks
+    are scheduled fairly: the project whose next tick is due earliest runs
+    first, and a project is only rescheduled once its own tick finishes.
+    '''
+
+    def __init__(self, output_dir, processes=None, max_connections=64):
+        self.output_dir = output_dir
+        self.manager = Manager()
+        self.renderer = RenderPool(processes)
+        self.sqlite_cache = SqliteReaderCache(
+            row_factory=dict_factory, label_function=standardize_label,
+            max_connections=max_connections)
+        self.entries = []
+
+    def add_project(self, name, input_protocol_ids, sampling_interval=60):
+        project = self.manager.loadProject(name)
+        working_dir = os.path.join(self.output_dir, name)
+        extra_dir = os.path.join(working_dir, 'extra')
+        if not os.path.isdir(extra_dir):
+            os.makedirs(extra_dir)
+
+        monitor = QCMonitor(None, workingDir=working_dir,
+                            samplingInterval=sampling_interval,
+                            monitorTime=0,
+                            project=project,
+                            inputProtocolIds=input_protocol_ids,
+                            renderer=self.renderer,
+                            sqliteCache=self.sqlite_cache,
+                            )
+        monitor.addNotifier(PrintNotifier())
+        self.entries.append(ProjectEntry(name, monitor, sampling_interval))
+
+    def run(self, duration=None):
+        timeout = time.time() + duration if duration else None
+        queue = [(time.time(), i, entry)
+                 for i, entry in enumerate(self.entries)]
+        heapq.heapify(queue)
+        sequence = len(queue)
+
+        try:
+            while queue:
+                due, _, entry = heapq.heappop(queue)
+                if timeout is not None and due > timeout:
+                    break
+                delay = due - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+
+                self.tick(entry)
+                sequence += 1
+                heapq.heappush(
+                    queue, (time.time() + entry.interval, sequence, entry))
+        finally:
+            self.renderer.close()
+            self.sqlite_cache.close()
+
+    def tick(self, entry):
+        start = time.time()
+        try:
+            entry.monitor.step()
+        except Exception as e:
+            entry.monitor.info('QC tick failed for {}: {}'.format(
+                entry.name, e))
+        entry.last_tick = start
+        entry.tick_seconds = time.time() - start
+
+        self.write_project_summary(entry)
+        self.write_facility_summary()
+
+    def write_project_summary(self, entry):
+        summary_file = os.path.join(
+            self.output_dir, entry.name, 'extra', 'project_summary.json')
+        with open(summary_file, 'w') as OUTPUT:
+            json.dump(entry.summary(), OUTPUT, indent=2, sort_keys=True)
+
+    def write_facility_summary(self):
+        summaries = [entry.summary() for entry in self.entries]
+
+        with open(os.path.join(
+                self.output_dir, 'facility_summary.json'), 'w') as OUTPUT:
+            json.dump(summaries, OUTPUT, indent=2, sort_keys=True)
+
+        with open(os.path.join(
+                self.output_dir, 'facility_summary.txt'), 'w') as OUTPUT:
+            writer = csv.DictWriter(OUTPUT, fieldnames=FACILITY_FIELDS)
+            writer.writeheader()
+            for summary in summaries:
+                row = {
+                    'Project': summary['project'],
+                    'Movies': summary['movies'],
+                    'Flagged': summary['flagged'],
+                    'Last Tick': summary['last_tick'],
+                    'Tick Seconds': summary['tick_seconds'],
+                }
+                for field in FACILITY_FIELDS:
+                    if field.startswith('Mean '):
+                        stats = summary['statistics'].get(field[5:])
+                        if stats and stats['count']:
+                            row[field] = stats['mean']
+                writer.writerow(row)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Monitor QC for several Scipion projects at once')
+    parser.add_argument('config', type=str,
+                        help='JSON file with a "projects" list of '
+                             '{"name", "inputProtocols", "samplingInterval"}')
+    parser.add_argument('output', type=str,
+                        help='Directory for per-project and facility '
+                             'summaries')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='Rendering processes shared by all projects')
+    parser.add_argument('--hours', type=float, default=None,
+                        help='Stop after this many hours')
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        config = json.load(f)
+
+    aggregator = QCAggregator(args.output, processes=args.processes)
+    for project in config['projects']:
+        aggregator.add_project(
+            project['name'],
+            project['inputProtocols'],
+            project.get('samplingInterval', 60),
+        )
+
+    try:
+        aggregator.run(args.hours * 3600 if args.hours else None)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,141 @@
+import os
+import json
+
+from PIL import Image
+
+
+def _atomic_save(image, path):
+    tmp_path = path + '.tmp'
+    image.save(tmp_path, 'PNG')
+    os.rename(tmp_path, path)
+
+
+class Atlas(object):
+    '''
+    Packs same-sized thumbnails into fixed-size sprite sheets.
+
+    Tiles are appended to the current sheet in row-major order and an index
+    maps each tile name to (sheet, x, y). Only sheets that changed since the
+    last flush are rewritten, and only the current sheet and changed sheets
+    are kept in memory.
+    '''
+
+    def __init__(self, directory, prefix, tile_size=(400, 400),
+                 grid=(8, 8)):
+        self.directory = directory
+        self.prefix = prefix
+        self.tile_size = tuple(tile_size)
+        self.grid = tuple(grid)
+        self.index_file = os.path.join(directory, prefix + '_atlas.json')
+
+        self.tiles = dict()  # Tile name -> [sheet, x, y]
+        self._sheets = dict()  # Sheet number -> Image held in memory
+        self._dirty = set()
+        self._index_dirty = False
+
+        if os.path.isfile(self.index_file):
+            with open(self.index_file) as f:
+                index = json.load(f)
+            self.tile_size = tuple(index['tile_size'])
+            self.grid = tuple(index['grid'])
+            self.tiles = index['tiles']
+
+    @property
+    def tiles_per_sheet(self):
+        return self.grid[0] * self.grid[1]
+
+    def sheet_path(self, sheet):
+        return os.path.join(
+            self.directory, '{}_atlas_{:04d}.png'.format(self.prefix, sheet))
+
+    def has(self, name):
+        return name in self.tiles
+
+    def add(self, name, image):
+        '''
+        Stores image as the tile for name, replacing any previous tile
+        '''
+        if name in self.tiles:
+            sheet, x, y = self.tiles[name]
+        else:
+            slot = len(self.tiles)
+            sheet, position = divmod(slot, self.tiles_per_sheet)
+            row, column = divmod(position, self.grid[0])
+            x = column * self.tile_size[0]
+            y = row * self.tile_size[1]
+            self.tiles[name] = [sheet, x, y]
+            self._index_dirty = True
+
+        tile = Image.new('RGB', self.tile_size)
+        image = image.convert('RGB')
+        image.thumbnail(self.tile_size, Image.ANTIALIAS)
+        tile.paste(image, (0, 0))
+
+        self._sheet(sheet).paste(tile, (x, y))
+        self._dirty.add(sheet)
+
+    def box(self, name):
+        '''
+        Returns (sheet path, crop box) for a tile
+        '''
+        sheet, x, y = self.tiles[name]
+        return self.sheet_path(sheet), (
+            x, y, x + self.tile_size[0], y + self.tile_size[1])
+
+    def extract(self, name):
+        sheet, x, y = self.tiles[name]
+        return self._sheet(sheet).crop(
+            (x, y, x + self.tile_size[0], y + self.tile_size[1]))
+
+    def _sheet(self, sheet):
+        if sheet not in self._sheets:
+            path = self.sheet_path(sheet)
+            if os.path.isfile(path):
+                image = Image.open(path)
+                image.load()
+                self._sheets[sheet] = image.convert('RGB')
+            else:
+                self._sheets[sheet] = Image.new('RGB', (
+                    self.grid[0] * self.tile_size[0],
+                    self.grid[1] * self.tile_size[1]))
+        return self._sheets[sheet]
+
+    def flush(self):
+        '''
+        Writes changed sheets and the index, then releases full sheets
+        '''
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        for sheet in sorted(self._dirty):
+            _atomic_save(self._sheets[sheet], self.sheet_path(sheet))
+        self._dirty = set()
+
+        if self._index_dirty:
+            tmp_file = self.index_file + '.tmp'
+            with open(tmp_file, 'w') as OUTPUT:
+                json.dump({
+                    'tile_size': self.tile_size,
+                    'grid': self.grid,
+                    'tiles': self.tiles,
+                }, OUTPUT)
+            os.rename(tmp_file, self.index_file)
+            self._index_dirty = False
+
+        current = len(self.tiles) // self.tiles_per_sheet
+        for sheet in list(self._sheets):
+            if sheet != current:
+                del self._sheets[sheet]
+
+
+def extract_tile(directory, prefix, name):
+    '''
+    Reads a single tile from the sprite sheets on disk
+    '''
+    with open(os.path.join(directory, prefix + '_atlas.json')) as f:
+        index = json.load(f)
+    sheet, x, y = index['tiles'][name]
+    w, h = index['tile_size']
+    image = Image.open(os.path.join(
+        directory, '{}_atlas_{:04d}.png'.format(prefix, sheet)))
+    return image.crop((x, y, x + w, y + h))
@@ -0,0 +1,344 @@
+import os
+import datetime
+import email.utils
+import json
+import threading
+from io import BytesIO
+
+from PIL import Image
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.web import Application, HTTPError, RequestHandler
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 1000
+POLL_TIMEOUT = 30
+
+INDEX_PAGE = '''<!DOCTYPE html>
+<html>
+<head><title>QC dashboard</title></head>
+<body>
+<table id="rows"></table>
+<script>
+var version = 0;
+function cell(tr, text) {
+  var td = document.createElement('td');
+  td.textContent = text;
+  tr.appendChild(td);
+  return td;
+}
+function load() {
+  fetch('api/rows?limit=1000&sort=Movie').then(function(r) {
+    return r.json();
+  }).then(function(data) {
+    version = data.version;
+    var table = document.getElementById('rows');
+    while (table.firstChild) { table.removeChild(table.firstChild); }
+    data.rows.forEach(function(row) {
+      var tr = document.createElement('tr');
+      cell(tr, row.name);
+      cell(tr, row['QC Flags'] || '');
+      var img = document.createElement('img');
+      img.src = 'thumbs/' + encodeURIComponent(row.name) + '.png';
+      img.width = 800;
+      cell(tr, '').appendChild(img);
+      table.appendChild(tr);
+    });
+    poll();
+  });
+}
+function poll() {
+  fetch('api/poll?since=' + version).then(function(r) {
+    return r.json();
+  }).then(function(data) {
+    if (data.version > version) { load(); } else { poll(); }
+  });
+}
+load();
+</script>
+</body>
+</html>
+'''
+
+
+def _json_default(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return str(value)
+
+
+class QCIndex(object):
+    '''
+    Thread-safe in-memory copy of the QC table and thumbnail locations that
+    the dashboard serves from, so requests never scan the output directory
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rows = dict()  # Movie name -> row dict
+        self._row_versions = dict()  # Movie name -> version last changed
+        self._thumbnails = dict()  # Movie name -> (path, mtime, size, box)
+        self._sorted = dict()  # (sort, reverse) -> (version, names)
+        self._waiters = []  # (io_loop, future)
+        self.version = 0
+
+    def update(self, rows):
+        '''
+        Replaces the rows for the given movie names; rows maps name -> dict
+        '''
+        if not rows:
+            return
+        with self._lock:
+            for name, row in rows.items():
+                self._rows[name] = dict(row)
+            self._changed(rows)
+
+    def set_thumbnail(self, name, path, box=None):
+        '''
+        Registers the PNG for name; box is the crop box of the tile when path
+        is an atlas sprite sheet
+        '''
+        st = os.stat(path)
+        with self._lock:
+            self._thumbnails[name] = (path, st.st_mtime, st.st_size, box)
+            self._changed([name])
+
+    def _changed(self, names):
+        '''
+        Bumps the version for names and wakes long polls; the lock must be
+        held
+        '''
+        self.version += 1
+        for name in names:
+            self._row_versions[name] = self.version
+        for io_loop, future in self._waiters:
+            io_loop.add_callback(_resolve, future, self.version)
+        self._waiters = []
+
+    def thumbnail(self, name):
+        with self._lock:
+            return self._thumbnails.get(name)
+
+    def page(self, offset=0, limit=DEFAULT_PAGE_SIZE, sort=None,
+             reverse=False):
+        with self._lock:
+            key = (sort, reverse)
+            cached = self._sorted.get(key)
+            if cached is None or cached[0] != self.version:
+                if sort is None:
+                    names = sorted(self._rows)
+                else:
+                    names = sorted(self._rows, key=lambda n: (
+                        self._rows[n].get(sort) is None,
+                        self._rows[n].get(sort), n), reverse=reverse)
+                cached = (self.version, names)
+                self._sorted[key] = cached
+            names = cached[1][offset:offset + limit]
+            return {
+                'version': self.version,
+                'total': len(self._rows),
+                'offset': offset,
+                'rows': [self._row(name) for name in names],
+            }
+
+    def changes_since(self, version):
+        with self._lock:
+            names = sorted(name for name, v in self._row_versions.items()
+                           if v > version)
+            return {
+                'version': self.version,
+                'rows': [self._row(name) for name in names],
+            }
+
+    def _row(self, name):
+        row = dict(self._rows.get(name, {}))
+        row['name'] = name
+        row['thumbnail'] = name in self._thumbnails
+        return row
+
+    def wait_for_change(self, since, io_loop):
+        '''
+        Returns a Future resolved with the index version once it passes
+        since; cancel_wait() must be called if it is given up on
+        '''
+        future = Future()
+        with self._lock:
+            if self.version > since:
+                future.set_result(self.version)
+            else:
+                self._waiters.append((io_loop, future))
+        return future
+
+    def cancel_wait(self, future):
+        with self._lock:
+            self._waiters = [w for w in self._waiters if w[1] is not future]
+
+
+def _resolve(future, version):
+    if not future.done():
+        future.set_result(version)
+
+
+class _IndexHandler(RequestHandler):
+
+    def initialize(self, index):
+        self.index = index
+
+    def write_json(self, data):
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(data, default=_json_default, sort_keys=True))
+
+
+class PageHandler(_IndexHandler):
+
+    def get(self):
+        self.write(INDEX_PAGE)
+
+
+class RowsHandler(_IndexHandler):
+    '''
+    Paginated, sortable QC table; unchanged pages get 304 through ETags
+    '''
+
+    def get(self):
+        try:
+            offset = max(0, int(self.get_argument('offset', 0)))
+            limit = min(MAX_PAGE_SIZE, max(1, int(
+                self.get_argument('limit', DEFAULT_PAGE_SIZE))))
+        except ValueError:
+            raise HTTPError(400)
+        sort = self.get_argument('sort', None)
+        reverse = self.get_argument('order', 'asc') == 'desc'
+        self.write_json(self.index.page(offset, limit, sort, reverse))
+
+
+class PollHandler(_IndexHandler):
+    '''
+    Long poll that returns the rows changed since a given version
+    '''
+
+    @gen.coroutine
+    def get(self):
+        try:
+            since = int(self.get_argument('since', 0))
+            timeout = min(POLL_TIMEOUT, float(
+                self.get_argument('timeout', POLL_TIMEOUT)))
+        except ValueError:
+            raise HTTPError(400)
+        future = self.index.wait_for_change(since, IOLoop.current())
+        try:
+            yield gen.with_timeout(datetime.timedelta(seconds=timeout),
+                                   future)
+        except gen.TimeoutError:
+            pass
+        finally:
+            #  Waiters are otherwise only dropped when the index changes
+            self.index.cancel_wait(future)
+        self.write_json(self.index.changes_since(since))
+
+
+class ThumbnailHandler(_IndexHandler):
+    '''
+    Serves quad thumbnails with ETag and Last-Modified validation
+    '''
+
+    def compute_etag(self):
+        return None  # Set explicitly from the cached file metadata
+
+    def get(self, name):
+        thumbnail = self.index.thumbnail(name)
+        if thumbnail is None:
+            raise HTTPError(404)
+        path, mtime, size, box = thumbnail
+
+        etag = '"{:x}-{:x}{}"'.format(
+            int(mtime * 1000), size,
+            '-{:x}-{:x}'.format(*box[:2]) if box else '')
+        last_modified = email.utils.formatdate(mtime, usegmt=True)
+        self.set_header('Etag', etag)
+        self.set_header('Last-Modified', last_modified)
+        self.set_header('Cache-Control', 'no-cache')
+
+        if self._not_modified(etag, mtime):
+            self.set_status(304)
+            return
+
+        self.set_header('Content-Type', 'image/png')
+        if box is None:
+            with open(path, 'rb') as f:
+                self.write(f.read())
+        else:
+            buf = BytesIO()
+            Image.open(path).crop(box).save(buf, 'PNG')
+            self.write(buf.getvalue())
+
+    def _not_modified(self, etag, mtime):
+        if_none_match = self.request.headers.get('If-None-Match')
+        if if_none_match is not None:
+            return etag in [t.strip() for t in if_none_match.split(',')] \
+                or if_none_match.strip() == '*'
+        if_modified_since = self.request.headers.get('If-Modified-Since')
+        if if_modified_since:
+            since = email.utils.parsedate_tz(if_modified_since)
+            if since is not None:
+                return int(mtime) <= email.utils.mktime_tz(since)
+        return False
+
+
+def make_app(index):
+    '''
+    Builds the dashboard application; usable with tornado.testing without
+    starting a server
+    '''
+    args = dict(index=index)
+    return Application([
+        (r'/', PageHandler, args),
+        (r'/api/rows', RowsHandler, args),
+        (r'/api/poll', PollHandler, args),
+        (r'/thumbs/(.+)\.png', ThumbnailHandler, args),
+    ])
+
+
+class DashboardServer(object):
+    '''
+    Serves a QCIndex over HTTP from a background thread
+    '''
+
+    def __init__(self, index, port, address='127.0.0.1'):
+        self.index = index
+        self.port = port
+        self.address = address
+        self.io_loop = None
+        self._thread = None
+        self._error = None
+
+    def start(self):
+        started = threading.Event()
+
+        def _run():
+            self.io_loop = IOLoop()
+            self.io_loop.make_current()
+            try:
+                server = HTTPServer(make_app(self.index),
+                                    io_loop=self.io_loop)
+                server.listen(self.port, self.address)
+            except Exception as e:
+                self._error = e
+                return
+            finally:
+                started.set()
+            self.io_loop.start()
+
+        self._thread = threading.Thread(target=_run)
+        self._thread.daemon = True
+        self._thread.start()
+        started.wait()
+        if self._error is not None:
+            raise self._error
+
+    def stop(self):
+        if self.io_loop is not None:
+            self.io_loop.add_callback(self.io_loop.stop)
+            self._thread.join()
@@ -0,0 +1,131 @@
+import os
+import sqlite3
+from collections import OrderedDict
+from multiprocessing import Pool
+
+
+def temporary_path(path):
+    '''
+    Hidden name next to path that keeps its extension, from which
+    matplotlib picks the image format
+    '''
+    directory, name = os.path.split(path)
+    return os.path.join(directory, '.tmp.' + name)
+
+
+def render_atomically(function, *args):
+    '''
+    Calls function(*args), whose last argument is the output file, with a
+    temporary output file that is renamed into place once written, so that
+    readers never open a partial image
+    '''
+    output_file = args[-1]
+    tmp_file = temporary_path(output_file)
+    try:
+        result = function(*(args[:-1] + (tmp_file,)))
+        os.rename(tmp_file, output_file)
+    except Exception:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+    return result
+
+
+class _FinishedJob(object):
+
+    def __init__(self, result=None, error=None):
+        self._result = result
+        self._error = error
+
+    def ready(self):
+        return True
+
+    def get(self):
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+class InlineRenderer(object):
+    '''
+    Runs rendering functions immediately in the calling process
+    '''
+
+    def submit(self, function, *args):
+        try:
+            return _FinishedJob(result=function(*args))
+        except Exception as e:
+            return _FinishedJob(error=e)
+
+    def close(self):
+        pass
+
+
+class RenderPool(object):
+    '''
+    Runs rendering functions in a pool of worker processes that can be
+    shared by several monitors; functions must be importable module-level
+    functions
+    '''
+
+    def __init__(self, processes=None):
+        self._pool = Pool(processes=processes)
+
+    def submit(self, function, *args):
+        return self._pool.apply_async(function, args)
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+
+class SqliteReaderCache(object):
+    '''
+    Keeps read connections to set databases open between ticks, together
+    with their column-name-to-label mapping, and can be shared by several
+    monitors. A connection is reopened when its file is regenerated.
+    '''
+
+    def __init__(self, row_factory=None, label_function=None,
+                 max_connections=32):
+        self.row_factory = row_factory
+        self.label_function = label_function or (lambda label: label)
+        self.max_connections = max_connections
+        self._connections = OrderedDict()
+
+    def open(self, sqlite_file, signature):
+        '''
+        Returns (connection, column name -> label) for sqlite_file
+        '''
+        entry = self._connections.pop(sqlite_file, None)
+        if entry is not None and entry[0] != signature:
+            entry[1].close()
+            entry = None
+
+        if entry is None:
+            connection = sqlite3.connect(sqlite_file)
+            connection.row_factory = self.row_factory
+            try:
+                labels = dict()
+                for row in connection.execute('SELECT * FROM Classes'):
+                    labels[row['column_name']] = \
+                        self.label_function(row['label_property'])
+            except sqlite3.OperationalError:
+                connection.close()
+                raise
+            entry = (signature, connection, labels)
+
+        self._connections[sqlite_file] = entry
+        while len(self._connections) > self.max_connections:
+            self._connections.popitem(last=False)[1][1].close()
+        return entry[1], entry[2]
+
+    def invalidate(self, sqlite_file):
+        entry = self._connections.pop(sqlite_file, None)
+        if entry is not None:
+            entry[1].close()
+
+    def close(self):
+        for entry in self._connections.values():
+            entry[1].close()
+        self._connections.clear()
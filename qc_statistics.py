@@ -0,0 +1,258 @@
+import math
+import re
+from collections import deque
+
+# Fields summarised by SessionStatistics unless configured otherwise
+STAT_FIELDS = [
+    'Counts',
+    'DF1',
+    'DF2',
+    'DF1-DF2',
+    'CCC',
+    'Average Drift',
+    'Maximum Drift',
+    'Path Length',
+    'Early Drift',
+    'Late Drift',
+    'Jitter',
+]
+
+
+class RunningStats(object):
+    '''
+    Welford's online mean and variance
+    '''
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.min = None
+        self.max = None
+
+    def update(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    @property
+    def variance(self):
+        if self.count < 2:
+            return 0.0
+        return self._m2 / (self.count - 1)
+
+    @property
+    def std(self):
+        return math.sqrt(self.variance)
+
+
+class RollingWindow(object):
+    '''
+    Mean and standard deviation of the last size values
+    '''
+
+    def __init__(self, size):
+        self.values = deque(maxlen=size)
+        self._sum = 0.0
+        self._sum_sq = 0.0
+
+    def update(self, value):
+        if len(self.values) == self.values.maxlen:
+            old = self.values[0]
+            self._sum -= old
+            self._sum_sq -= old * old
+        self.values.append(value)
+        self._sum += value
+        self._sum_sq += value * value
+
+    @property
+    def count(self):
+        return len(self.values)
+
+    @property
+    def mean(self):
+        return self._sum / len(self.values) if self.values else 0.0
+
+    @property
+    def std(self):
+        n = len(self.values)
+        if n < 2:
+            return 0.0
+        variance = (self._sum_sq - self._sum * self._sum / n) / (n - 1)
+        return math.sqrt(max(variance, 0.0))
+
+
+class P2Quantile(object):
+    '''
+    Jain and Chlamtac's P-square estimate of a quantile in constant memory
+    '''
+
+    def __init__(self, p):
+        self.p = p
+        self.count = 0
+        self._q = []  # Marker heights
+        self._n = [0, 1, 2, 3, 4]  # Marker positions
+        self._np = [0, 2 * p, 4 * p, 2 + 2 * p, 4]  # Desired positions
+        self._dn = [0, p / 2.0, p, (1 + p) / 2.0, 1]
+
+    def update(self, value):
+        self.count += 1
+        q = self._q
+        if len(q) < 5:
+            q.append(value)
+            q.sort()
+            return
+
+        if value < q[0]:
+            q[0] = value
+            k = 0
+        elif value >= q[4]:
+            q[4] = value
+            k = 3
+        else:
+            k = 0
+            while value >= q[k + 1]:
+                k += 1
+
+        n = self._n
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self._np[i] += self._dn[i]
+
+        for i in range(1, 4):
+            d = self._np[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or \
+                    (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                height = self._parabolic(i, d)
+                if not q[i - 1] < height < q[i + 1]:
+                    height = q[i] + d * (q[i + d] - q[i]) / float(
+                        n[i + d] - n[i])
+                q[i] = height
+                n[i] += d
+
+    def _parabolic(self, i, d):
+        q, n = self._q, self._n
+        return q[i] + d / float(n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / float(n[i + 1] - n[i])
+            + (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) /
+            float(n[i] - n[i - 1]))
+
+    @property
+    def value(self):
+        if not self._q:
+            return None
+        if len(self._q) < 5:
+            return self._q[int(round(self.p * (len(self._q) - 1)))]
+        return self._q[2]
+
+
+def parse_bounds(text):
+    '''
+    Parses bounds such as "CCC > 0.05; Maximum Drift < 10" into a dict of
+    field -> (lower, upper), either of which may be None
+    '''
+    bounds = dict()
+    for entry in re.split('[;\n]', text or ''):
+        entry = entry.strip()
+        if not entry:
+            continue
+        match = re.match(r'^(.+?)\s*([<>])=?\s*([-+0-9.eE]+)$', entry)
+        if not match:
+            raise ValueError('Cannot parse QC bound "{}"'.format(entry))
+        field, op, value = match.groups()
+        lower, upper = bounds.get(field, (None, None))
+        if op == '>':
+            lower = float(value)
+        else:
+            upper = float(value)
+        bounds[field] = (lower, upper)
+    return bounds
+
+
+class FieldStatistics(object):
+
+    def __init__(self, window, quantiles):
+        self.running = RunningStats()
+        self.window = RollingWindow(window)
+        self.quantiles = [P2Quantile(p) for p in quantiles]
+
+    def update(self, value):
+        self.running.update(value)
+        self.window.update(value)
+        for quantile in self.quantiles:
+            quantile.update(value)
+
+    def summary(self):
+        summary = {
+            'count': self.running.count,
+            'mean': self.running.mean,
+            'std': self.running.std,
+            'min': self.running.min,
+            'max': self.running.max,
+            'window_mean': self.window.mean,
+            'window_std': self.window.std,
+        }
+        for quantile in self.quantiles:
+            summary['q{:g}'.format(quantile.p * 100)] = quantile.value
+        return summary
+
+
+class SessionStatistics(object):
+    '''
+    Session-wide streaming statistics and outlier flags for QC fields.
+
+    Every update is O(1): each field keeps Welford totals, a rolling window
+    and P-square quantile markers. A value is flagged when it falls outside
+    its configured bounds or, once min_samples values are seen, more than
+    sigma rolling standard deviations from the rolling mean.
+    '''
+
+    def __init__(self, fields=STAT_FIELDS, bounds=None, window=50,
+                 quantiles=(0.05, 0.5, 0.95), sigma=3.0, min_samples=20):
+        self.bounds = bounds or dict()
+        self.sigma = sigma
+        self.min_samples = min_samples
+        self.fields = dict(
+            (field, FieldStatistics(window, quantiles))
+            for field in list(fields) + [
+                f for f in self.bounds if f not in fields])
+
+    def observe(self, field, value):
+        '''
+        Adds a value and returns a list of flag messages for it
+        '''
+        if field not in self.fields:
+            return []
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return []
+        if math.isnan(value):
+            return []
+
+        flags = []
+        lower, upper = self.bounds.get(field, (None, None))
+        if lower is not None and value < lower:
+            flags.append('{} {:g} < {:g}'.format(field, value, lower))
+        if upper is not None and value > upper:
+            flags.append('{} {:g} > {:g}'.format(field, value, upper))
+
+        stats = self.fields[field]
+        window = stats.window
+        if self.sigma and window.count >= self.min_samples and \
+                window.std > 0 and \
+                abs(value - window.mean) > self.sigma * window.std:
+            flags.append('{} {:g} outside {:g} +/- {:g}'.format(
+                field, value, window.mean, self.sigma * window.std))
+
+        stats.update(value)
+        return flags
+
+    def summary(self):
+        return dict((field, stats.summary())
+                    for field, stats in self.fields.items())
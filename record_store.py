@@ -0,0 +1,125 @@
+import json
+import sqlite3
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class Record(object):
+    '''
+    Compact row of values whose column names are shared by the whole store
+    '''
+    __slots__ = ('_index', '_values')
+
+    def __init__(self, index):
+        self._index = index
+        self._values = []
+
+    def __getitem__(self, key):
+        i = self._index[key]
+        if i >= len(self._values) or self._values[i] is _MISSING:
+            raise KeyError(key)
+        return self._values[i]
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def set(self, key, value):
+        i = self._index[key]
+        if i >= len(self._values):
+            self._values.extend([_MISSING] * (i + 1 - len(self._values)))
+        self._values[i] = value
+
+    def as_dict(self):
+        return dict((key, self._values[i])
+                    for key, i in self._index.items()
+                    if i < len(self._values)
+                    and self._values[i] is not _MISSING)
+
+
+class RecordStore(object):
+    '''
+    Holds per-movie SQLite rows with a bounded memory footprint.
+
+    Only whitelisted columns are kept (all of them if columns is None), at
+    most max_records movies stay in memory, and the least recently updated
+    ones are either dropped or spilled to a SQLite cache file.
+    '''
+
+    def __init__(self, columns=None, max_records=1000, spill_file=None):
+        self.columns = set(columns) if columns is not None else None
+        self.max_records = max_records
+        self._index = dict()  # Column name -> position in Record values
+        self._records = OrderedDict()
+        self._spill = None
+        if spill_file:
+            self._spill = sqlite3.connect(spill_file)
+            self._spill.execute(
+                'CREATE TABLE IF NOT EXISTS records '
+                '(name TEXT PRIMARY KEY, data TEXT)')
+
+    def __len__(self):
+        return len(self._records)
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def update(self, name, row):
+        record = self.get(name)
+        if record is None:
+            record = Record(self._index)
+        for key, value in row.items():
+            if self.columns is not None and key not in self.columns:
+                continue
+            if key not in self._index:
+                self._index[key] = len(self._index)
+            record.set(key, value)
+        self._put(name, record)
+
+    def get(self, name):
+        '''
+        Returns the record for name, reloading it from the spill cache if it
+        was evicted, or None
+        '''
+        record = self._records.pop(name, None)
+        if record is None and self._spill is not None:
+            row = self._spill.execute(
+                'SELECT data FROM records WHERE name = ?', (name,)).fetchone()
+            if row is not None:
+                record = Record(self._index)
+                for key, value in json.loads(row[0]).items():
+                    if key not in self._index:
+                        self._index[key] = len(self._index)
+                    record.set(key, value)
+        if record is not None:
+            self._put(name, record)
+        return record
+
+    def _put(self, name, record):
+        self._records[name] = record
+        while len(self._records) > self.max_records:
+            evicted_name, evicted = self._records.popitem(last=False)
+            if self._spill is not None:
+                self._spill.execute(
+                    'INSERT OR REPLACE INTO records VALUES (?, ?)',
+                    (evicted_name, json.dumps(evicted.as_dict())))
+
+    def flush(self):
+        if self._spill is not None:
+            self._spill.commit()
+
+    def close(self):
+        if self._spill is not None:
+            self._spill.commit()
+            self._spill.close()
+            self._spill = None
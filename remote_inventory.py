@@ -0,0 +1,88 @@
+import os
+import threading
+import time
+
+from ssh_pool import quote
+
+
+class RemoteInventory(object):
+    '''
+    Cached listing of file names and sizes in a remote directory.
+
+    The whole directory is listed with a single remote command when the
+    cache is older than ttl seconds, and transfers finished locally are
+    recorded straight into the cache.
+    '''
+
+    def __init__(self, pool, directory, ttl=60):
+        self.pool = pool
+        self.directory = directory or '.'
+        self.ttl = ttl
+        self._files = None  # File name -> size in bytes
+        self._fetched = 0
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        # A missing directory is listed as empty
+        status, output = self.pool.run(
+            'test -d {0} || exit 0; '
+            'find {0} -maxdepth 1 -type f -printf "%f\\t%s\\n"'.format(
+                quote(self.directory)))
+        if status != 0:
+            raise IOError('Cannot list {}:{}'.format(
+                self.pool.target, self.directory))
+
+        files = dict()
+        for line in output.decode('utf-8', 'replace').splitlines():
+            name, _, size = line.rpartition('\t')
+            if name:
+                files[name] = int(size)
+        with self._lock:
+            self._files = files
+            self._fetched = time.time()
+
+    def files(self):
+        with self._lock:
+            stale = self._files is None or \
+                time.time() - self._fetched > self.ttl
+        if stale:
+            self.refresh()
+        return self._files
+
+    def exists(self, name, size=None):
+        '''
+        True if name is on the remote and, when size is given, complete
+        '''
+        remote_size = self.files().get(name)
+        if remote_size is None:
+            return False
+        return size is None or remote_size == size
+
+    def record(self, name, size):
+        with self._lock:
+            if self._files is not None:
+                self._files[name] = size
+
+    def invalidate(self):
+        with self._lock:
+            self._files = None
+
+
+class LocalInventory(RemoteInventory):
+    '''
+    RemoteInventory for a destination directory that is mounted locally
+    '''
+
+    def __init__(self, directory, ttl=60):
+        RemoteInventory.__init__(self, None, directory, ttl)
+
+    def refresh(self):
+        files = dict()
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                if os.path.isfile(path):
+                    files[name] = os.path.getsize(path)
+        with self._lock:
+            self._files = files
+            self._fetched = time.time()
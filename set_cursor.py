@@ -0,0 +1,78 @@
+import os
+
+
+def file_signature(path):
+    '''
+    Identifies a file on disk so that a regenerated file can be told apart
+    from one that was only appended to
+    '''
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_dev, st.st_ino)
+
+
+class CursorTable(object):
+    '''
+    Remembers the last object id processed for each key.
+
+    A key is reset to the start when the signature of its backing file
+    changes or when its largest id falls below the remembered one, both of
+    which mean the set was regenerated.
+    '''
+
+    def __init__(self):
+        self._positions = dict()  # Key -> (signature, last processed id)
+
+    def start(self, key, signature, max_id=None):
+        '''
+        Returns the id after which iteration over key should resume
+        '''
+        last_signature, last_id = self._positions.get(key, (None, 0))
+        if signature != last_signature or \
+                (max_id is not None and max_id < last_id):
+            last_id = 0
+            self._positions[key] = (signature, last_id)
+        return last_id
+
+    def advance(self, key, obj_id):
+        signature, last_id = self._positions[key]
+        if obj_id > last_id:
+            self._positions[key] = (signature, obj_id)
+
+    def reset(self, key=None):
+        if key is None:
+            self._positions.clear()
+        else:
+            self._positions.pop(key, None)
+
+
+class SetCursor(CursorTable):
+    '''
+    Iterates only over the objects added to a Scipion output set since the
+    previous call for the same protocol and set
+    '''
+
+    def iter_new(self, prot, set_name):
+        output_set = getattr(prot, set_name, None)
+        if output_set is None:
+            return
+
+        key = (prot.getObjId(), set_name)
+        last_id = self.start(key, file_signature(output_set.getFileName()),
+                             _max_id(output_set))
+
+        for item in output_set.iterItems(orderBy='id', direction='ASC',
+                                         where='id > %d' % last_id):
+            obj_id = item.getObjId()
+            yield item
+            #  Only count the item once the caller is done with it
+            self.advance(key, obj_id)
+
+
+def _max_id(output_set):
+    for item in output_set.iterItems(orderBy='id', direction='DESC',
+                                     limit=1):
+        return item.getObjId()
+    return 0
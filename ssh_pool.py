@@ -0,0 +1,164 @@
+import os
+import hashlib
+import subprocess
+import tempfile
+import threading
+import time
+
+import pexpect
+
+try:
+    from shlex import quote as _quote
+except ImportError:
+    from pipes import quote as _quote  # noqa
+
+# ssh exits with 255 when the connection itself fails
+SSH_CONNECTION_ERROR = 255
+
+
+def quote(path):
+    '''
+    Quotes path for the remote shell; a leading ~ is still expanded to the
+    remote home directory, as it was by ssh test -f
+    '''
+    if path == '~' or path.startswith('~/'):
+        return '"$HOME"' + (path[1:] and '/' + _quote(path[2:]))
+    return _quote(path)
+
+
+class SSHConnectionPool(object):
+    '''
+    Pool of multiplexed OpenSSH ControlMaster connections to one host.
+
+    Each slot is a master connection authenticated once (answering the
+    password prompt if needed); remote commands, scp and bbcp then open
+    channels over an existing master instead of doing a full handshake.
+    A master used in the last persist / 2 seconds is taken to be alive,
+    as ControlPersist keeps it, so commands do not pay for an ssh -O check
+    each; one whose command exits with SSH_CONNECTION_ERROR, reported
+    through failed(), is checked and reconnected on its next use.
+    '''
+
+    def __init__(self, user, host, size=2, password=None, persist=600,
+                 control_dir=None):
+        self.user = user
+        self.host = host
+        self.size = max(1, size)
+        self.password = password
+        self.persist = persist
+
+        if control_dir is None:
+            # Socket paths are length limited, so keep them short
+            key = hashlib.md5(
+                '{}@{}:{}'.format(user, host, os.getpid()).encode('utf-8')
+            ).hexdigest()[:12]
+            control_dir = os.path.join(tempfile.gettempdir(),
+                                       'scipion-ssh-' + key)
+        if not os.path.isdir(control_dir):
+            os.makedirs(control_dir, 0o700)
+        self.control_dir = control_dir
+
+        self._lock = threading.Lock()
+        self._slot_locks = [threading.Lock() for _ in range(self.size)]
+        self._last_used = [None] * self.size  # None until checked alive
+        self._next = 0
+
+    @property
+    def target(self):
+        return '{}@{}'.format(self.user, self.host)
+
+    def control_path(self, slot):
+        return os.path.join(self.control_dir, str(slot))
+
+    def ssh_options(self, slot):
+        '''
+        Options that make ssh, scp or rsync reuse the master of a slot
+        '''
+        return [
+            '-o', 'ControlPath={}'.format(self.control_path(slot)),
+            '-o', 'ControlMaster=no',
+            '-o', 'BatchMode=yes',
+        ]
+
+    def ssh_command(self, slot):
+        return ' '.join(['ssh'] + self.ssh_options(slot))
+
+    def _is_alive(self, slot):
+        with open(os.devnull, 'w') as DEVNULL:
+            return subprocess.call(
+                ['ssh', '-o', 'ControlPath={}'.format(self.control_path(slot)),
+                 '-O', 'check', self.target],
+                stdout=DEVNULL, stderr=DEVNULL) == 0
+
+    def _connect(self, slot):
+        child = pexpect.spawn(' '.join([
+            'ssh', '-N', '-f',
+            '-o', 'ControlMaster=yes',
+            '-o', 'ControlPath={}'.format(self.control_path(slot)),
+            '-o', 'ControlPersist={}'.format(self.persist),
+            self.target,
+        ]))
+        if child.expect(['password:', pexpect.EOF], timeout=60) == 0:
+            child.sendline(self.password)
+            child.expect(pexpect.EOF, timeout=60)
+        child.close()
+        return self._is_alive(slot)
+
+    def acquire(self):
+        '''
+        Returns the next slot, connecting its master if needed
+        '''
+        with self._lock:
+            slot = self._next
+            self._next = (self._next + 1) % self.size
+        with self._slot_locks[slot]:
+            now = time.time()
+            used = self._last_used[slot]
+            if used is None or now - used > self.persist / 2.:
+                if not self._is_alive(slot) and not self._connect(slot):
+                    self._last_used[slot] = None
+                    raise IOError('Cannot connect to {}'.format(self.target))
+            self._last_used[slot] = now
+        return slot
+
+    def failed(self, slot):
+        '''
+        Makes the next use of slot check its master, after a command over
+        it exited with SSH_CONNECTION_ERROR
+        '''
+        self._last_used[slot] = None
+
+    def reconnect(self, slot):
+        with self._slot_locks[slot]:
+            self._exit(slot)
+            connected = self._connect(slot)
+            self._last_used[slot] = time.time() if connected else None
+            return connected
+
+    def run(self, command, stdin=None, retries=1):
+        '''
+        Runs command on the remote host; returns (exit status, stdout)
+        '''
+        for attempt in range(retries + 1):
+            slot = self.acquire()
+            process = subprocess.Popen(
+                ['ssh'] + self.ssh_options(slot) + [self.target, command],
+                stdin=subprocess.PIPE if stdin is not None else None,
+                stdout=subprocess.PIPE)
+            output = process.communicate(stdin)[0]
+            if process.returncode != SSH_CONNECTION_ERROR:
+                break
+            self.reconnect(slot)
+        return process.returncode, output
+
+    def _exit(self, slot):
+        with open(os.devnull, 'w') as DEVNULL:
+            subprocess.call(
+                ['ssh', '-o', 'ControlPath={}'.format(self.control_path(slot)),
+                 '-O', 'exit', self.target],
+                stdout=DEVNULL, stderr=DEVNULL)
+
+    def close(self):
+        for slot in range(self.size):
+            self._exit(slot)
+            self._last_used[slot] = None
@@ -0,0 +1,121 @@
+import os
+import threading
+
+
+def scan(directory, extensions):
+    '''
+    Returns the files in directory with one of the given extensions
+    '''
+    if not os.path.isdir(directory):
+        return []
+    return [os.path.join(directory, name) for name in os.listdir(directory)
+            if os.path.splitext(name)[1] in extensions]
+
+
+class StagingCache(object):
+    '''
+    Byte budget for the compressed artifacts staged before transfer.
+
+    Space is reserved before an artifact is written. When the budget is
+    full, the oldest artifacts that is_confirmed(path) reports as
+    transferred are deleted, and then, if that is not enough, those that
+    is_abandoned(path) reports as given up on, which must be recreated if
+    they are tried again. If space is still short, reserve() waits, which
+    pauses compression, until transfers are confirmed and free more. An
+    artifact larger than the whole budget is let through when nothing else
+    is staged.
+    '''
+
+    def __init__(self, budget, is_confirmed, files=(), is_abandoned=None):
+        self.budget = budget
+        self.is_confirmed = is_confirmed
+        self.is_abandoned = is_abandoned
+        self.evictions = 0
+        self.evicted_bytes = 0
+        self.abandoned = 0  # Evictions of artifacts not confirmed
+        self.paused = False
+        self._files = dict()  # Path -> (mtime, size)
+        self._reserved = 0
+        self._closed = False
+        self._changed = threading.Condition(threading.Lock())
+        for path in files:
+            self.add(path)
+
+    def usage(self):
+        with self._changed:
+            return sum(size for _, size in self._files.values())
+
+    def _used(self):
+        return sum(size for _, size in self._files.values()) + self._reserved
+
+    def _evict(self, needed):
+        '''
+        Deletes confirmed artifacts, then abandoned ones, oldest first,
+        until needed more bytes fit; the lock must be held
+        '''
+        evictable = [self.is_confirmed]
+        if self.is_abandoned is not None:
+            evictable.append(self.is_abandoned)
+        for check in evictable:
+            for path, (_, size) in sorted(self._files.items(),
+                                          key=lambda x: x[1][0]):
+                if self._used() + needed <= self.budget:
+                    return
+                if not check(path):
+                    continue
+                try:
+                    os.remove(path)
+                except OSError:
+                    if os.path.exists(path):
+                        continue
+                del self._files[path]
+                self.evictions += 1
+                self.evicted_bytes += size
+                if check is not self.is_confirmed:
+                    self.abandoned += 1
+
+    def reserve(self, size, poll=10):
+        '''
+        Blocks until size bytes fit in the budget and reserves them
+        '''
+        with self._changed:
+            while True:
+                if self._closed:
+                    raise IOError('Staging cache closed')
+                self._evict(size)
+                if self._used() + size <= self.budget or \
+                        not (self._files or self._reserved):
+                    break
+                self.paused = True
+                self._changed.wait(poll)
+            self.paused = False
+            self._reserved += size
+        return size
+
+    def release(self, reserved):
+        with self._changed:
+            self._reserved -= reserved
+            self._changed.notify_all()
+
+    def add(self, path, reserved=0):
+        '''
+        Accounts for an artifact written under a reservation of reserved
+        bytes
+        '''
+        st = os.stat(path)
+        with self._changed:
+            self._files[path] = (st.st_mtime, st.st_size)
+            self._reserved -= reserved
+            self._changed.notify_all()
+
+    def confirmed(self):
+        '''
+        Wakes writers waiting for space after a transfer was confirmed
+        '''
+        with self._changed:
+            self._changed.notify_all()
+
+    def close(self):
+        with self._changed:
+            self._closed = True
+            self._changed.notify_all()
@@ -0,0 +1,127 @@
+import cProfile
+import json
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class StepProfiler(object):
+    '''
+    Collects per-phase timings and counters for each monitor tick.
+
+    Phase times are exclusive: time spent in a nested phase is not also
+    counted in the enclosing one. Each finished tick is appended as one JSON
+    line to output_file and, every profile_every ticks, a cProfile dump is
+    written next to it.
+    '''
+
+    def __init__(self, output_file, profile_every=0):
+        self.output_file = output_file
+        self.profile_every = profile_every
+        self.tick = 0
+        self._reset()
+
+    def _reset(self):
+        self.phases = defaultdict(float)
+        self.counters = defaultdict(int)
+        self._stack = []  # [phase name, time the phase last resumed]
+        self._tick_start = None
+        self._profile = None
+
+    def start_tick(self):
+        self._reset()
+        self.tick += 1
+        self._tick_start = time.time()
+        if self.profile_every and self.tick % self.profile_every == 0:
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+
+    @contextmanager
+    def phase(self, name):
+        now = time.time()
+        if self._stack:
+            parent = self._stack[-1]
+            self.phases[parent[0]] += now - parent[1]
+        self._stack.append([name, now])
+        try:
+            yield
+        finally:
+            now = time.time()
+            self.phases[name] += now - self._stack.pop()[1]
+            if self._stack:
+                self._stack[-1][1] = now
+
+    def timed_iter(self, iterable, name):
+        '''
+        Yields from iterable, charging only the time spent fetching each item
+        to the named phase
+        '''
+        items = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+            yield item
+
+    def add_time(self, name, seconds):
+        '''
+        Charges time spent outside the monitor thread, e.g. by background
+        workers, to a phase; it is not part of the tick total
+        '''
+        self.phases[name] += seconds
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def end_tick(self):
+        '''
+        Finishes the current tick and returns its record
+        '''
+        if self._tick_start is None:
+            return None
+
+        record = {
+            'tick': self.tick,
+            'time': self._tick_start,
+            'total': time.time() - self._tick_start,
+            'phases': dict(self.phases),
+            'counters': dict(self.counters),
+        }
+
+        directory = os.path.dirname(self.output_file)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        if self._profile is not None:
+            self._profile.disable()
+            profile_file = '{}.tick{:06d}.prof'.format(
+                os.path.splitext(self.output_file)[0], self.tick)
+            self._profile.dump_stats(profile_file)
+            record['profile'] = profile_file
+
+        with open(self.output_file, 'a') as OUTPUT:
+            OUTPUT.write(json.dumps(record, sort_keys=True) + '\n')
+
+        self._reset()
+        return record
+
+
+def summarize_tick(record):
+    '''
+    Formats a tick record as a one-line summary for notifiers
+    '''
+    phases = ', '.join(
+        '{} {:.2f}s'.format(name, seconds) for name, seconds in
+        sorted(record['phases'].items(), key=lambda x: -x[1]))
+    counters = ', '.join(
+        '{} {}'.format(name, value) for name, value in
+        sorted(record['counters'].items()))
+    return 'Tick {} took {:.2f}s ({}){}'.format(
+        record['tick'],
+        record['total'],
+        phases or 'idle',
+        '; ' + counters if counters else '',
+    )
@@ -0,0 +1,161 @@
+import hashlib
+import posixpath
+import subprocess
+import threading
+
+from ssh_pool import SSH_CONNECTION_ERROR, quote
+
+try:
+    from queue import Queue, Full
+except ImportError:
+    from Queue import Queue, Full  # noqa
+
+
+def temporary_name(remote_path):
+    '''
+    Hidden name a file is written under until it is complete
+    '''
+    directory, name = posixpath.split(remote_path)
+    return posixpath.join(directory, '.{}.tmp'.format(name))
+
+
+class RemoteWriter(object):
+    '''
+    Feeds one remote file over a pooled SSH channel from its own thread.
+
+    Chunks wait in a queue of up to backlog entries. A writer whose remote
+    end fails, or which is dropped, discards what is still queued so that
+    the caller never blocks on it for long.
+    '''
+
+    def __init__(self, pool, remote_path, bucket=None, backlog=8):
+        self.pool = pool
+        self.remote_path = remote_path
+        self.tmp_path = temporary_name(remote_path)
+        self.bucket = bucket
+        self.failed = False
+
+        self.slot = pool.acquire()
+        self.process = subprocess.Popen(
+            ['ssh'] + pool.ssh_options(self.slot) +
+            [pool.target, 'cat > {}'.format(quote(self.tmp_path))],
+            stdin=subprocess.PIPE)
+        self._queue = Queue(backlog)
+        self._thread = threading.Thread(target=self._write)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _write(self):
+        for chunk in iter(self._queue.get, None):
+            if self.failed:
+                continue
+            if self.bucket is not None:
+                self.bucket.consume(len(chunk))
+            #  Only errors writing to ssh are the remote's; errors reading
+            #  the source propagate from stream_to_remotes instead
+            try:
+                self.process.stdin.write(chunk)
+            except (IOError, OSError):
+                self.failed = True  # Remote end went away
+        try:
+            self.process.stdin.close()
+        except (IOError, OSError):
+            pass
+        if self.process.wait() == SSH_CONNECTION_ERROR:
+            self.pool.failed(self.slot)
+
+    def put(self, chunk, timeout=None):
+        '''
+        Queues chunk; drops this writer if it is not taken within timeout
+        seconds
+        '''
+        try:
+            self._queue.put(chunk, timeout=timeout)
+        except Full:
+            self.drop()
+
+    def drop(self):
+        self.failed = True
+        try:
+            self.process.kill()
+        except OSError:
+            pass
+
+    def abort(self):
+        '''
+        Drops this writer, waits for its thread and removes the temporary
+        file
+        '''
+        self.drop()
+        self._queue.put(None)
+        self._thread.join()
+        self.pool.run('rm -f {}'.format(quote(self.tmp_path)))
+
+    def finish(self, size, checksum):
+        '''
+        Renames the temporary file to its final name if the remote size
+        matches size; returns (size, checksum) or None on failure
+        '''
+        self._queue.put(None)
+        self._thread.join()
+        if self.failed or self.process.returncode != 0:
+            self.pool.run('rm -f {}'.format(quote(self.tmp_path)))
+            return None
+        status, _ = self.pool.run(
+            'test "$(stat -c %s {0} 2>/dev/null)" = {1} && mv -f {0} {2} || '
+            '{{ rm -f {0}; exit 1; }}'.format(
+                quote(self.tmp_path), size, quote(self.remote_path)))
+        if status != 0:
+            return None
+        return size, checksum
+
+
+def stream_to_remotes(targets, chunks, stall=None):
+    '''
+    Writes the byte strings from chunks to several remote files at once,
+    so the source is read and compressed only once.
+
+    targets are (pool, remote_path, bucket) triples; each remote is written
+    by its own RemoteWriter and throttled by its bucket, if any, which the
+    targets may share to limit their total rate. With
+    stall, a remote that has not taken a chunk within stall seconds is
+    dropped, so one slow destination does not hold back the others. Returns,
+    for each target, (bytes sent, md5 hex digest) or None on failure. An
+    error reading chunks aborts every writer, removing the temporary remote
+    files, and is raised again.
+    '''
+    writers = []
+    md5 = hashlib.md5()
+    size = 0
+    try:
+        for pool, remote_path, bucket in targets:
+            writers.append(RemoteWriter(pool, remote_path, bucket))
+        for chunk in chunks:
+            live = [writer for writer in writers if not writer.failed]
+            if not live:
+                break
+            md5.update(chunk)
+            size += len(chunk)
+            for writer in live:
+                writer.put(chunk, stall)
+    except BaseException:
+        for writer in writers:
+            writer.abort()
+        raise
+
+    checksum = md5.hexdigest()
+    return [writer.finish(size, checksum) for writer in writers]
+
+
+def stream_to_remote(pool, chunks, remote_path, bucket=None):
+    '''
+    Writes the byte strings from chunks to remote_path over a pooled SSH
+    channel, with no local copy.
+
+    The data goes to a temporary remote name. Only once the remote size
+    matches what was sent is it renamed to remote_path, so a stream cut
+    short never shows up as a complete file. The MD5 of the stream is
+    computed as it is sent; bucket, if given, throttles the stream. Returns
+    (bytes sent, md5 hex digest) or None on failure.
+    '''
+    return stream_to_remotes([(pool, remote_path, bucket)], chunks)[0]
@@ -0,0 +1,57 @@
+import gzip
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+from parallel_gzip import compress_file, write_atomically
+
+
+class WriteAtomicallyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.destination = os.path.join(self.directory, 'movie.mrcs.gz')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_compress_file_round_trip(self):
+        source = os.path.join(self.directory, 'movie.mrcs')
+        data = os.urandom(1024) * 300
+        with open(source, 'wb') as f:
+            f.write(data)
+        stats = compress_file(source, self.destination, block_size=65536)
+        with gzip.open(self.destination, 'rb') as f:
+            self.assertEqual(f.read(), data)
+        self.assertEqual(stats.output_bytes,
+                         os.path.getsize(self.destination))
+        self.assertEqual(
+            stat.S_IMODE(os.stat(self.destination).st_mode), 0o644)
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ['movie.mrcs', 'movie.mrcs.gz'])
+
+    def test_concurrent_writers_do_not_share_a_temporary_file(self):
+        def interleaved():
+            yield b'one '
+            write_atomically(iter([b'other']), self.destination)
+            yield b'two'
+
+        write_atomically(interleaved(), self.destination)
+        with open(self.destination, 'rb') as f:
+            self.assertEqual(f.read(), b'one two')
+        self.assertEqual(os.listdir(self.directory), ['movie.mrcs.gz'])
+
+    def test_failed_write_leaves_nothing(self):
+        def failing():
+            yield b'partial'
+            raise IOError('source read failed')
+
+        self.assertRaises(IOError, write_atomically, failing(),
+                          self.destination)
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import json
+import os
+import shutil
+import tempfile
+
+from PIL import Image
+from tornado.testing import AsyncHTTPTestCase, gen_test
+
+from qc_dashboard import QCIndex, make_app
+
+
+class QCDashboardTest(AsyncHTTPTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.index = QCIndex()
+        self.index.update({
+            'movie_2': {'Movie': 2, 'QC Flags': '<b>drift</b>'},
+            'movie_1': {'Movie': 1, 'QC Flags': ''},
+        })
+        super(QCDashboardTest, self).setUp()
+
+    def tearDown(self):
+        super(QCDashboardTest, self).tearDown()
+        shutil.rmtree(self.directory)
+
+    def get_app(self):
+        return make_app(self.index)
+
+    def get_json(self, url, **kwargs):
+        response = self.fetch(url, **kwargs)
+        self.assertEqual(response.code, 200)
+        return response, json.loads(response.body.decode('utf-8'))
+
+    def test_rows_sorted_and_paginated(self):
+        _, data = self.get_json('/api/rows?sort=Movie&limit=1&offset=1')
+        self.assertEqual((data['total'], data['version']), (2, 1))
+        self.assertEqual([row['name'] for row in data['rows']], ['movie_2'])
+        self.assertEqual(data['rows'][0]['QC Flags'], '<b>drift</b>')
+
+    def test_unchanged_rows_not_modified(self):
+        response, _ = self.get_json('/api/rows')
+        etag = response.headers['Etag']
+        self.assertEqual(self.fetch(
+            '/api/rows', headers={'If-None-Match': etag}).code, 304)
+
+        self.index.update({'movie_3': {'Movie': 3}})
+        response, data = self.get_json('/api/rows',
+                                       headers={'If-None-Match': etag})
+        self.assertEqual(data['total'], 3)
+
+    @gen_test
+    def test_poll_returns_changed_rows(self):
+        self.io_loop.call_later(0.1, self.index.update,
+                                {'movie_1': {'Movie': 1, 'QC Flags': 'ctf'}})
+        response = yield self.http_client.fetch(
+            self.get_url('/api/poll?since=1&timeout=5'))
+        data = json.loads(response.body.decode('utf-8'))
+        self.assertEqual(data['version'], 2)
+        self.assertEqual([row['name'] for row in data['rows']], ['movie_1'])
+
+    def test_poll_timeout_drops_waiter(self):
+        _, data = self.get_json('/api/poll?since=1&timeout=0.1')
+        self.assertEqual((data['version'], data['rows']), (1, []))
+        self.assertEqual(self.index._waiters, [])
+
+    def test_thumbnail_not_modified(self):
+        path = os.path.join(self.directory, 'movie_1.png')
+        Image.new('L', (8, 4)).save(path)
+        self.index.set_thumbnail('movie_1', path)
+
+        response = self.fetch('/thumbs/movie_1.png')
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers['Content-Type'], 'image/png')
+        self.assertEqual(self.fetch(
+            '/thumbs/movie_1.png',
+            headers={'If-None-Match': response.headers['Etag']}).code, 304)
+        self.assertEqual(self.fetch(
+            '/thumbs/movie_1.png',
+            headers={'If-Modified-Since':
+                     response.headers['Last-Modified']}).code, 304)
+        self.assertEqual(self.fetch('/thumbs/movie_9.png').code, 404)
+
+    def test_atlas_tile_cropped(self):
+        path = os.path.join(self.directory, 'atlas.png')
+        Image.new('L', (16, 4)).save(path)
+        self.index.set_thumbnail('movie_1', path, box=(8, 0, 16, 4))
+        response = self.fetch('/thumbs/movie_1.png')
+        self.assertEqual(response.code, 200)
+        with open(os.path.join(self.directory, 'tile.png'), 'wb') as f:
+            f.write(response.body)
+        self.assertEqual(
+            Image.open(os.path.join(self.directory, 'tile.png')).size, (8, 4))
@@ -0,0 +1,56 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from remote_inventory import RemoteInventory
+
+
+class LocalShellPool(object):
+    '''
+    Runs the remote commands in a local shell whose home is home
+    '''
+    target = 'localhost'
+
+    def __init__(self, home):
+        self.home = home
+
+    def run(self, command, stdin=None, retries=1):
+        env = dict(os.environ, HOME=self.home)
+        process = subprocess.Popen(['sh', '-c', command], env=env,
+                                   stdout=subprocess.PIPE)
+        output = process.communicate()[0]
+        return process.returncode, output
+
+
+class RemoteInventoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.home = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.home, 'session 1'))
+        with open(os.path.join(self.home, 'session 1', 'a.mrcs'), 'wb') as f:
+            f.write(b'x' * 5)
+        self.pool = LocalShellPool(self.home)
+
+    def tearDown(self):
+        shutil.rmtree(self.home)
+
+    def test_lists_directory(self):
+        inventory = RemoteInventory(
+            self.pool, os.path.join(self.home, 'session 1'))
+        self.assertEqual(inventory.files(), {'a.mrcs': 5})
+        self.assertTrue(inventory.exists('a.mrcs', 5))
+        self.assertFalse(inventory.exists('a.mrcs', 4))
+
+    def test_home_relative_directory(self):
+        inventory = RemoteInventory(self.pool, '~/session 1')
+        self.assertEqual(inventory.files(), {'a.mrcs': 5})
+
+    def test_missing_directory_is_empty(self):
+        inventory = RemoteInventory(self.pool, '~/missing')
+        self.assertEqual(inventory.files(), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
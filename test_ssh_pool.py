@@ -0,0 +1,59 @@
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+from ssh_pool import SSHConnectionPool
+
+#  Logs each control command and runs the remote command locally
+FAKE_SSH = '''#!/bin/sh
+for arg; do
+    case "$arg" in -O) echo control >> "{log}"; exit 0;; esac
+    last="$arg"
+done
+exec sh -c "$last"
+'''
+
+
+class SSHConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.log = os.path.join(self.directory, 'control.log')
+        bin_dir = os.path.join(self.directory, 'bin')
+        os.makedirs(bin_dir)
+        ssh = os.path.join(bin_dir, 'ssh')
+        with open(ssh, 'w') as f:
+            f.write(FAKE_SSH.format(log=self.log))
+        os.chmod(ssh, stat.S_IRWXU)
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = bin_dir + os.pathsep + self.path
+        self.pool = SSHConnectionPool(
+            'user', 'host', size=1,
+            control_dir=os.path.join(self.directory, 'control'))
+
+    def tearDown(self):
+        os.environ['PATH'] = self.path
+        shutil.rmtree(self.directory)
+
+    def control_commands(self):
+        if not os.path.exists(self.log):
+            return 0
+        with open(self.log) as f:
+            return len(f.readlines())
+
+    def test_master_checked_once_while_in_use(self):
+        for _ in range(3):
+            self.assertEqual(self.pool.run('echo hi'), (0, b'hi\n'))
+        self.assertEqual(self.control_commands(), 1)
+
+    def test_master_checked_again_after_connection_error(self):
+        slot = self.pool.acquire()
+        self.pool.failed(slot)
+        self.pool.acquire()
+        self.assertEqual(self.control_commands(), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from staging_cache import StagingCache
+
+
+class StagingCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.confirmed = set()
+        self.abandoned = set()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def stage(self, cache, name, size):
+        reserved = cache.reserve(size, poll=0.05)
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as f:
+            f.write(b'\0' * size)
+        cache.add(path, reserved)
+        return path
+
+    def reserve_in_thread(self, cache, size):
+        '''
+        Returns the thread and a list that gets the reserve() outcome
+        '''
+        outcome = []
+
+        def reserve():
+            try:
+                outcome.append(cache.reserve(size, poll=0.05))
+            except IOError as e:
+                outcome.append(e)
+
+        thread = threading.Thread(target=reserve)
+        thread.daemon = True
+        thread.start()
+        return thread, outcome
+
+    def test_evicts_oldest_confirmed(self):
+        cache = StagingCache(100, self.confirmed.__contains__)
+        first = self.stage(cache, 'a.gz', 40)
+        time.sleep(0.01)
+        second = self.stage(cache, 'b.gz', 40)
+        self.confirmed.update([first, second])
+        self.stage(cache, 'c.gz', 40)
+        self.assertFalse(os.path.exists(first))
+        self.assertTrue(os.path.exists(second))
+        self.assertEqual((cache.evictions, cache.evicted_bytes), (1, 40))
+
+    def test_full_budget_with_unconfirmable_artifact_waits(self):
+        cache = StagingCache(100, self.confirmed.__contains__,
+                             is_abandoned=self.abandoned.__contains__)
+        stuck = self.stage(cache, 'a.gz', 80)
+
+        thread, outcome = self.reserve_in_thread(cache, 40)
+        time.sleep(0.2)
+        self.assertEqual(outcome, [])
+        self.assertTrue(cache.paused)
+        self.assertTrue(os.path.exists(stuck))
+
+        cache.close()
+        thread.join(1)
+        self.assertIsInstance(outcome[0], IOError)
+
+    def test_full_budget_evicts_abandoned_artifact(self):
+        cache = StagingCache(100, self.confirmed.__contains__,
+                             is_abandoned=self.abandoned.__contains__)
+        stuck = self.stage(cache, 'a.gz', 80)
+
+        thread, outcome = self.reserve_in_thread(cache, 40)
+        time.sleep(0.2)
+        self.assertEqual(outcome, [])
+        self.abandoned.add(stuck)
+        cache.confirmed()
+        thread.join(1)
+
+        self.assertEqual(outcome, [40])
+        self.assertFalse(os.path.exists(stuck))
+        self.assertFalse(cache.paused)
+        self.assertEqual((cache.evictions, cache.abandoned), (1, 1))
+
+    def test_confirmed_preferred_over_abandoned(self):
+        cache = StagingCache(100, self.confirmed.__contains__,
+                             is_abandoned=self.abandoned.__contains__)
+        abandoned = self.stage(cache, 'a.gz', 40)
+        time.sleep(0.01)
+        confirmed = self.stage(cache, 'b.gz', 40)
+        self.abandoned.add(abandoned)
+        self.confirmed.add(confirmed)
+        self.stage(cache, 'c.gz', 40)
+        self.assertTrue(os.path.exists(abandoned))
+        self.assertFalse(os.path.exists(confirmed))
+        self.assertEqual(cache.abandoned, 0)
+
+    def test_oversize_artifact_passes_when_empty(self):
+        cache = StagingCache(100, self.confirmed.__contains__)
+        self.assertEqual(cache.reserve(500, poll=0.05), 500)
+
+
+if __name__ == '__main__':
+    unittest.main()
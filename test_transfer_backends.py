@@ -0,0 +1,71 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from transfer_backends import LocalBackend, SourceTruncated, _copy_range, \
+    make_backend
+
+
+class LocalBackendTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.source = os.path.join(self.directory, 'movie.mrcs')
+        self.data = os.urandom(3 * 1024 * 1024 + 17)
+        with open(self.source, 'wb') as f:
+            f.write(self.data)
+        self.destination = os.path.join(self.directory, 'remote', 'session')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read(self, name):
+        with open(os.path.join(self.destination, name), 'rb') as f:
+            return f.read()
+
+    def test_make_backend(self):
+        backend = make_backend('local')
+        self.assertIsInstance(backend, LocalBackend)
+        self.assertTrue(backend.local)
+
+    def test_send_creates_destination_and_copies(self):
+        self.assertEqual(LocalBackend().send(self.source, self.destination),
+                         0)
+        self.assertEqual(self.read('movie.mrcs'), self.data)
+        self.assertEqual(
+            int(os.path.getmtime(os.path.join(self.destination,
+                                              'movie.mrcs'))),
+            int(os.path.getmtime(self.source)))
+        self.assertEqual(os.listdir(self.destination), ['movie.mrcs'])
+
+    def test_send_under_another_name(self):
+        LocalBackend().send(self.source, self.destination,
+                            name='grid1_movie.mrcs')
+        self.assertEqual(self.read('grid1_movie.mrcs'), self.data)
+
+    def test_rate_limit(self):
+        self.assertEqual(LocalBackend().send(
+            self.source, self.destination, rate_limit=1024 ** 3), 0)
+        self.assertEqual(self.read('movie.mrcs'), self.data)
+
+    def test_missing_source_leaves_nothing(self):
+        os.makedirs(self.destination)
+        self.assertEqual(LocalBackend().send(
+            os.path.join(self.directory, 'missing.mrcs'), self.destination),
+            1)
+        self.assertEqual(os.listdir(self.destination), [])
+
+    @unittest.skipUnless(hasattr(os, 'copy_file_range') or
+                         hasattr(os, 'sendfile'),
+                         'no in-kernel copy on this platform')
+    def test_short_source_is_not_taken_as_unsupported(self):
+        target = os.path.join(self.directory, 'copy')
+        with open(self.source, 'rb') as INPUT, open(target, 'wb') as OUTPUT:
+            self.assertRaises(
+                SourceTruncated, _copy_range, INPUT.fileno(),
+                OUTPUT.fileno(), len(self.data) + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from transfer_ledger import TransferLedger, SENT
+
+
+class TransferLedgerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.ledger = TransferLedger(
+            os.path.join(self.directory, 'ledger.sqlite'))
+        self.source = os.path.join(self.directory, 'summary.csv')
+        self.write(b'a,b\n')
+
+    def tearDown(self):
+        self.ledger.close()
+        shutil.rmtree(self.directory)
+
+    def write(self, data, mtime=None):
+        with open(self.source, 'wb') as f:
+            f.write(data)
+        if mtime is not None:
+            os.utime(self.source, (mtime, mtime))
+
+    def test_sent_source_is_current(self):
+        self.ledger.record(self.source, 'host:/data', SENT)
+        self.assertTrue(self.ledger.is_current(self.source, 'host:/data'))
+        self.assertFalse(self.ledger.is_current(self.source, 'other:/data'))
+
+    def test_source_rewritten_while_sent_is_not_current(self):
+        source_stat = os.stat(self.source)
+        self.write(b'a,b\n1,2\n', mtime=source_stat.st_mtime + 10)
+        self.ledger.record(self.source, 'host:/data', SENT,
+                           source_stat=source_stat)
+        self.assertFalse(self.ledger.is_current(self.source, 'host:/data'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from transfer_rules import PendingFiles, TransferRule, own_name
+
+
+class FakeCursor(object):
+
+    def __init__(self, objects):
+        self.objects = objects
+
+    def iter_new(self, prot, set_name):
+        objects, self.objects = self.objects, []
+        return iter(objects)
+
+
+class TransferRuleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.rule = TransferRule('ctf', object, 2, own_name,
+                                 set_name='outputCTF')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def touch(self, name):
+        with open(self.path(name), 'wb') as f:
+            f.write(b'psd')
+
+    def test_file_written_after_its_item_is_sent_later(self):
+        self.touch('a_psd.mrc')
+        cursor = FakeCursor([self.path('a_psd.mrc'), self.path('b_psd.mrc')])
+        pending = PendingFiles()
+
+        items = list(self.rule.iter_items(None, cursor, pending=pending))
+        self.assertEqual([i.name for i in items], ['a_psd.mrc'])
+        self.assertEqual(len(pending), 1)
+        self.assertEqual(pending.ready(), [])
+
+        self.touch('b_psd.mrc')
+        self.assertEqual(list(self.rule.iter_items(None, cursor,
+                                                   pending=pending)), [])
+        ready = pending.ready()
+        self.assertEqual([i.name for i in ready], ['b_psd.mrc'])
+        self.assertFalse(ready[0].rewritten)
+        self.assertEqual(len(pending), 0)
+
+    def test_file_never_written_is_forgotten(self):
+        cursor = FakeCursor([self.path('a_psd.mrc')])
+        pending = PendingFiles(timeout=0)
+        list(self.rule.iter_items(None, cursor, pending=pending))
+        self.assertEqual(pending.ready(), [])
+        self.assertEqual(len(pending), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
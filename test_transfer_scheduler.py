@@ -0,0 +1,55 @@
+import time
+import unittest
+
+from transfer_scheduler import TokenBucket, TransferScheduler
+
+
+class TransferSchedulerTest(unittest.TestCase):
+
+    def run_scheduler(self, send, **kwargs):
+        scheduler = TransferScheduler(lambda key: key, send, retries=0,
+                                      **kwargs)
+        scheduler.start()
+        self.addCleanup(scheduler.stop)
+        return scheduler
+
+    def test_sends_and_reports(self):
+        scheduler = self.run_scheduler(lambda key, artifact, rate: 10)
+        scheduler.submit('a')
+        self.assertTrue(scheduler.drain(5))
+        result, = scheduler.poll()
+        self.assertEqual((result.key, result.success, result.bytes,
+                          result.resubmits), ('a', True, 10, 0))
+
+    def test_given_up_job_resubmitted_up_to_limit(self):
+        scheduler = self.run_scheduler(lambda key, artifact, rate: None,
+                                       max_resubmits=2)
+        scheduler.submit('a')
+        resubmits = []
+        for _ in range(4):
+            self.assertTrue(scheduler.drain(5))
+            resubmits.extend(r.resubmits for r in scheduler.poll())
+            scheduler.resubmit_given_up(delay=0)
+        self.assertEqual(resubmits, [0, 1, 2])
+        self.assertEqual(scheduler.resubmit_given_up(delay=0), 0)
+
+    def test_given_up_job_dropped_unless_kept(self):
+        scheduler = self.run_scheduler(lambda key, artifact, rate: None)
+        scheduler.submit('a')
+        self.assertTrue(scheduler.drain(5))
+        self.assertEqual(
+            scheduler.resubmit_given_up(delay=0, keep=lambda key: False), 0)
+        self.assertEqual(scheduler.resubmit_given_up(delay=0), 0)
+
+    def test_shared_bucket_splits_rate(self):
+        bucket = TokenBucket(120)
+        schedulers = [TransferScheduler(None, None, slots=2, bucket=bucket)
+                      for _ in range(3)]
+        self.assertEqual(schedulers[0].rate_limit(), 20)
+        self.assertEqual(
+            TransferScheduler(None, None, slots=2, bandwidth=120)
+            .rate_limit(), 60)
+
+
+if __name__ == '__main__':
+    unittest.main()
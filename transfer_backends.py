@@ -0,0 +1,181 @@
+import os
+import shutil
+from subprocess import call
+
+from ssh_pool import SSH_CONNECTION_ERROR
+from transfer_scheduler import TokenBucket
+from transfer_tuner import DEFAULT as DEFAULT_BBCP_SETTING
+
+COPY_BLOCK = 8 * 1024 * 1024
+
+
+class SourceTruncated(Exception):
+    '''
+    The source ended before the size it had when the copy started; not an
+    OSError, so that it is not mistaken for a copy method being unsupported
+    '''
+
+
+class TransferBackend(object):
+    '''
+    Sends one file into a destination directory.
+
+    send() returns 0 on success like the command line tools it wraps.
+    rate_limit is in bytes per second; setting is the (window MB, streams)
+    pair for backends that are tunable; name is the destination file name,
+    the source's own by default.
+    '''
+
+    name = None
+    local = False
+    tunable = False
+
+    def send(self, source, destination_dir, rate_limit=None, setting=None,
+             name=None):
+        raise NotImplementedError
+
+
+class SSHBackend(TransferBackend):
+    '''
+    Backend whose command runs over a slot of an SSHConnectionPool;
+    get_pool is called on each send so that the pool can be created lazily
+    '''
+
+    def __init__(self, get_pool):
+        self.get_pool = get_pool
+
+    def command(self, pool, slot, source, destination, rate_limit, setting):
+        raise NotImplementedError
+
+    def send(self, source, destination_dir, rate_limit=None, setting=None,
+             name=None):
+        pool = self.get_pool()
+        slot = pool.acquire()
+        destination = '{}:{}/{}'.format(
+            pool.target, destination_dir, name or os.path.basename(source))
+        status = call(self.command(pool, slot, source, destination,
+                                   rate_limit, setting))
+        if status == SSH_CONNECTION_ERROR:
+            pool.failed(slot)
+        return status
+
+
+class ScpBackend(SSHBackend):
+    name = 'scp'
+
+    def command(self, pool, slot, source, destination, rate_limit, setting):
+        command = ['scp'] + pool.ssh_options(slot)
+        if rate_limit:
+            #  scp limits in Kbit/s
+            command += ['-l', str(max(1, int(rate_limit * 8 / 1000)))]
+        return command + [source, destination]
+
+
+class BbcpBackend(SSHBackend):
+    name = 'bbcp'
+    tunable = True
+
+    def command(self, pool, slot, source, destination, rate_limit, setting):
+        window, streams = setting or DEFAULT_BBCP_SETTING
+        command = [
+            'bbcp', '-w', '{}m'.format(window), '-s', str(streams),
+            '-T', pool.ssh_command(slot) + ' -x -a -l %U %H bbcp',
+        ]
+        if rate_limit:
+            command += ['-x', str(int(rate_limit))]
+        return command + [source, destination]
+
+
+class RsyncBackend(SSHBackend):
+    name = 'rsync'
+
+    def command(self, pool, slot, source, destination, rate_limit, setting):
+        #  Interrupted files are kept aside and completed by the next run
+        command = [
+            'rsync', '--partial', '--partial-dir=.rsync-partial',
+            '-e', pool.ssh_command(slot),
+        ]
+        if rate_limit:
+            #  rsync limits in KB/s
+            command += ['--bwlimit={}'.format(max(1, int(rate_limit / 1024)))]
+        return command + [source, destination]
+
+
+def _copy_range(source, destination, size, bucket=None):
+    '''
+    Copies size bytes between file descriptors inside the kernel when the
+    platform allows it; returns False if neither call is available, which
+    is always the case under Python 2, where os has neither
+    '''
+    for name in ('copy_file_range', 'sendfile'):
+        copy = getattr(os, name, None)
+        if copy is None:
+            continue
+        copied = 0
+        try:
+            while copied < size:
+                n = min(COPY_BLOCK, size - copied)
+                if bucket is not None:
+                    bucket.consume(n)
+                if name == 'sendfile':
+                    done = copy(destination, source, copied, n)
+                else:
+                    done = copy(source, destination, n, copied, copied)
+                if done == 0:
+                    raise SourceTruncated('Source ended early')
+                copied += done
+        except OSError:
+            if copied:
+                raise
+            continue  # Not supported between these file systems
+        return True
+    return False
+
+
+class LocalBackend(TransferBackend):
+    '''
+    Copies into a mounted directory (NFS, Lustre, a local disk), using
+    copy_file_range or sendfile under Python 3 so the data does not pass
+    through user space, and a plain block copy otherwise. Files appear
+    under their final name only once complete. Also stands in for a remote
+    host in tests.
+    '''
+
+    name = 'local'
+    local = True
+
+    def send(self, source, destination_dir, rate_limit=None, setting=None,
+             name=None):
+        if not os.path.isdir(destination_dir):
+            os.makedirs(destination_dir)
+        name = name or os.path.basename(source)
+        destination = os.path.join(destination_dir, name)
+        tmp_file = os.path.join(destination_dir, '.{}.tmp'.format(name))
+        bucket = TokenBucket(rate_limit) if rate_limit else None
+        try:
+            with open(source, 'rb') as INPUT, open(tmp_file, 'wb') as OUTPUT:
+                size = os.fstat(INPUT.fileno()).st_size
+                if not _copy_range(INPUT.fileno(), OUTPUT.fileno(), size,
+                                   bucket):
+                    for block in iter(lambda: INPUT.read(COPY_BLOCK), b''):
+                        if bucket is not None:
+                            bucket.consume(len(block))
+                        OUTPUT.write(block)
+            shutil.copystat(source, tmp_file)
+            os.rename(tmp_file, destination)
+        except (IOError, OSError, SourceTruncated):
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            return 1
+        return 0
+
+
+BACKENDS = [ScpBackend, BbcpBackend, RsyncBackend, LocalBackend]
+BACKEND_NAMES = [backend.name for backend in BACKENDS]
+
+
+def make_backend(name, get_pool=None):
+    backend = BACKENDS[BACKEND_NAMES.index(name)]
+    if issubclass(backend, SSHBackend):
+        return backend(get_pool)
+    return backend()
@@ -0,0 +1,83 @@
+import os
+import threading
+
+from remote_inventory import RemoteInventory, LocalInventory
+from transfer_backends import make_backend
+from transfer_ledger import format_destination, parse_destination
+
+
+def parse_destinations(text):
+    '''
+    Returns (user, host, directory) for each line of text, written as
+    user@host:directory, or as a plain directory for a mounted destination.
+    Blank lines and lines starting with # are skipped.
+    '''
+    destinations = []
+    for line in (text or '').splitlines():
+        line = line.strip()
+        if line and not line.startswith('#'):
+            destinations.append(parse_destination(line))
+    return destinations
+
+
+class TransferDestination(object):
+    '''
+    One place files are sent to, with its own backend and cached listing.
+
+    get_pool(user, host) returns the SSH connection pool for a host, so
+    that destinations on the same host share connections. scheduler is the
+    TransferScheduler that sends to this destination, with its own slots,
+    bandwidth and retries; it is set by the monitor.
+    '''
+
+    def __init__(self, user, host, directory, method, get_pool,
+                 inventory_ttl=60):
+        self.user = user
+        self.host = host
+        self.directory = directory or ''
+        self.inventory_ttl = inventory_ttl
+        self.backend = make_backend(method, self.pool)
+        self.scheduler = None
+        self._get_pool = get_pool
+        self._inventory = None
+        self._lock = threading.Lock()
+
+    @property
+    def local(self):
+        return self.backend.local
+
+    @property
+    def remote_dir(self):
+        return self.directory or '.'
+
+    @property
+    def key(self):
+        '''
+        Name of the destination in the transfer ledger
+        '''
+        if self.local:
+            return os.path.abspath(self.remote_dir)
+        return format_destination(self.user, self.host, self.remote_dir)
+
+    @property
+    def label(self):
+        if self.local:
+            return self.remote_dir
+        return '{}:{}'.format(self.host, self.remote_dir)
+
+    def remote_path(self, name):
+        return '/'.join([self.remote_dir, name])
+
+    def pool(self):
+        return self._get_pool(self.user, self.host)
+
+    def inventory(self):
+        pool = self.pool() if not self.local else None
+        with self._lock:
+            if self._inventory is None and self.local:
+                self._inventory = LocalInventory(
+                    self.directory, ttl=self.inventory_ttl)
+            elif self._inventory is None:
+                self._inventory = RemoteInventory(
+                    pool, self.directory, ttl=self.inventory_ttl)
+        return self._inventory
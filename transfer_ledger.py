@@ -0,0 +1,291 @@
+import os
+import argparse
+import getpass
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+
+from ssh_pool import SSHConnectionPool, quote
+from remote_inventory import RemoteInventory, LocalInventory
+
+SENT = 'sent'
+FAILED = 'failed'
+MISSING = 'missing'
+
+LEDGER_COLUMNS = [
+    'source',
+    'destination',
+    'size',
+    'mtime',
+    'artifact',
+    'artifact_size',
+    'checksum',
+    'status',
+    'attempts',
+    'updated',
+]
+
+
+def file_checksum(path, block_size=1 << 20):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def format_destination(user, host, directory):
+    return '{}@{}:{}'.format(user, host, directory)
+
+
+def parse_destination(destination):
+    '''
+    Splits "user@host:directory" into (user, host, directory); a local
+    destination directory has no user or host
+    '''
+    if ':' not in destination:
+        return None, None, destination
+    target, _, directory = destination.partition(':')
+    user, _, host = target.rpartition('@')
+    return user, host, directory
+
+
+class TransferLedger(object):
+    '''
+    Local SQLite record of what has been sent where.
+
+    Each row is keyed by source file and destination and stores the
+    source size and mtime at transfer time, the artifact actually sent, its
+    size and checksum, and the result. A source whose size or mtime changed
+    is no longer considered sent.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS transfers ('
+            'source TEXT, destination TEXT, size INTEGER, mtime REAL, '
+            'artifact TEXT, artifact_size INTEGER, checksum TEXT, '
+            'status TEXT, attempts INTEGER DEFAULT 0, updated REAL, '
+            'PRIMARY KEY (source, destination))')
+        #  Chunks of interrupted transfers the remote has acknowledged
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS chunks ('
+            'source TEXT, destination TEXT, artifact_size INTEGER, '
+            'chunk_size INTEGER, chunk INTEGER, checksum TEXT, '
+            'PRIMARY KEY (source, destination, chunk))')
+        self._connection.commit()
+
+    def entry(self, source, destination):
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT {} FROM transfers WHERE source = ? AND '
+                'destination = ?'.format(', '.join(LEDGER_COLUMNS)),
+                (source, destination)).fetchone()
+        return dict(zip(LEDGER_COLUMNS, row)) if row else None
+
+    def is_current(self, source, destination):
+        '''
+        True if source was sent to destination and has not changed since
+        '''
+        entry = self.entry(source, destination)
+        if entry is None or entry['status'] != SENT:
+            return False
+        try:
+            st = os.stat(source)
+        except OSError:
+            return True  # Source cleaned up after it was sent
+        return st.st_size == entry['size'] and st.st_mtime == entry['mtime']
+
+    def record(self, source, destination, status, artifact=None,
+               artifact_size=None, checksum=None, source_stat=None):
+        '''
+        source_stat is the os.stat() of source taken before it was read, so
+        that a file rewritten while it was sent is not taken as current; by
+        default source is stat'ed now
+        '''
+        st = source_stat if source_stat is not None else os.stat(source)
+        with self._lock:
+            attempts = self._connection.execute(
+                'SELECT attempts FROM transfers WHERE source = ? AND '
+                'destination = ?', (source, destination)).fetchone()
+            attempts = (attempts[0] if attempts else 0) + 1
+            self._connection.execute(
+                'INSERT OR REPLACE INTO transfers ({}) VALUES ({})'.format(
+                    ', '.join(LEDGER_COLUMNS),
+                    ', '.join('?' for _ in LEDGER_COLUMNS)),
+                (source, destination, st.st_size, st.st_mtime, artifact,
+                 artifact_size, checksum, status, attempts, time.time()))
+            self._connection.commit()
+
+    def artifact_sent(self, artifact, destinations=None):
+        '''
+        True if every transfer of artifact is complete, i.e. the local copy
+        is no longer needed. With destinations, each of them must have
+        received it, not only those already tried.
+        '''
+        with self._lock:
+            statuses = dict(self._connection.execute(
+                'SELECT destination, status FROM transfers WHERE '
+                'artifact = ?', (artifact,)).fetchall())
+        if destinations is None:
+            destinations = list(statuses)
+        return bool(destinations) and \
+            all(statuses.get(d) == SENT for d in destinations)
+
+    def set_status(self, source, destination, status):
+        with self._lock:
+            self._connection.execute(
+                'UPDATE transfers SET status = ?, updated = ? WHERE '
+                'source = ? AND destination = ?',
+                (status, time.time(), source, destination))
+            self._connection.commit()
+
+    def entries(self, destination=None, status=None):
+        query = 'SELECT {} FROM transfers WHERE 1'.format(
+            ', '.join(LEDGER_COLUMNS))
+        args = []
+        if destination is not None:
+            query += ' AND destination = ?'
+            args.append(destination)
+        if status is not None:
+            query += ' AND status = ?'
+            args.append(status)
+        with self._lock:
+            rows = self._connection.execute(query, args).fetchall()
+        return [dict(zip(LEDGER_COLUMNS, row)) for row in rows]
+
+    def acknowledged_chunks(self, source, destination, artifact_size,
+                            chunk_size):
+        '''
+        Returns {chunk index: checksum} for the chunks already on the
+        remote; chunks recorded for a different artifact or chunk size are
+        dropped
+        '''
+        with self._lock:
+            self._connection.execute(
+                'DELETE FROM chunks WHERE source = ? AND destination = ? AND '
+                '(artifact_size != ? OR chunk_size != ?)',
+                (source, destination, artifact_size, chunk_size))
+            self._connection.commit()
+            rows = self._connection.execute(
+                'SELECT chunk, checksum FROM chunks WHERE source = ? AND '
+                'destination = ?', (source, destination)).fetchall()
+        return dict(rows)
+
+    def acknowledge_chunk(self, source, destination, artifact_size,
+                          chunk_size, chunk, checksum):
+        with self._lock:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?, ?, ?)',
+                (source, destination, artifact_size, chunk_size, chunk,
+                 checksum))
+            self._connection.commit()
+
+    def clear_chunks(self, source, destination):
+        with self._lock:
+            self._connection.execute(
+                'DELETE FROM chunks WHERE source = ? AND destination = ?',
+                (source, destination))
+            self._connection.commit()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+def verify_ledger(ledger, destination, pool, checksums=False, mark=False):
+    '''
+    Compares the sent entries for destination with the remote files.
+
+    Returns a list of (entry, problem) pairs; with mark, entries that are
+    missing or differ are set to MISSING so the monitor sends them again.
+    pool is None for a locally mounted destination.
+    '''
+    _, _, directory = parse_destination(destination)
+    if pool is None:
+        inventory = LocalInventory(directory)
+    else:
+        inventory = RemoteInventory(pool, directory)
+    entries = ledger.entries(destination=destination, status=SENT)
+
+    problems = []
+    to_checksum = []
+    for entry in entries:
+        name = os.path.basename(entry['artifact'])
+        if not inventory.exists(name):
+            problems.append((entry, 'missing on remote'))
+        elif not inventory.exists(name, entry['artifact_size']):
+            problems.append((entry, 'size differs'))
+        elif checksums and entry['checksum']:
+            to_checksum.append(entry)
+
+    # Checksum in batches to keep the number of round trips low
+    for i in range(0, len(to_checksum), 100):
+        batch = to_checksum[i:i + 100]
+        paths = [os.path.join(directory or '.',
+                              os.path.basename(e['artifact']))
+                 for e in batch]
+        if pool is None:
+            remote = dict((path, file_checksum(path)) for path in paths
+                          if os.path.isfile(path))
+        else:
+            _, output = pool.run(
+                'md5sum ' + ' '.join(quote(p) for p in paths))
+            remote = dict()
+            for line in output.decode('utf-8', 'replace').splitlines():
+                checksum, _, path = line.partition('  ')
+                remote[path] = checksum
+        for entry, path in zip(batch, paths):
+            if remote.get(path) != entry['checksum']:
+                problems.append((entry, 'checksum differs'))
+
+    if mark:
+        for entry, _ in problems:
+            ledger.set_status(entry['source'], destination, MISSING)
+    return problems
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Check a TransferMonitor ledger against the remote')
+    parser.add_argument('ledger', type=str, help='transfer_ledger.sqlite')
+    parser.add_argument('--checksum', action='store_true',
+                        help='Also compare MD5 checksums on the remote')
+    parser.add_argument('--mark', action='store_true',
+                        help='Mark bad entries so they are sent again')
+    parser.add_argument('--password', action='store_true',
+                        help='Prompt for the SSH password')
+    args = parser.parse_args()
+
+    password = getpass.getpass() if args.password else None
+    ledger = TransferLedger(args.ledger)
+
+    by_destination = defaultdict(int)
+    for entry in ledger.entries(status=SENT):
+        by_destination[entry['destination']] += 1
+
+    for destination, count in sorted(by_destination.items()):
+        user, host, _ = parse_destination(destination)
+        pool = SSHConnectionPool(user, host, size=1, password=password) \
+            if host else None
+        try:
+            problems = verify_ledger(ledger, destination, pool,
+                                     checksums=args.checksum, mark=args.mark)
+        finally:
+            if pool is not None:
+                pool.close()
+        print('{}: {} sent, {} problems'.format(
+            destination, count, len(problems)))
+        for entry, problem in problems:
+            print('  {}: {}'.format(entry['source'], problem))
+
+    ledger.close()
@@ -0,0 +1,101 @@
+import os
+import time
+from collections import namedtuple
+
+#  source: local path; name: file name on the destination; compress: whether
+#  the movie codec applies to it; rewritten: whether the file is rewritten in
+#  place, so that a remote file of the same size may still be stale
+TransferItem = namedtuple('TransferItem', [
+    'source',
+    'name',
+    'kind',
+    'priority',
+    'compress',
+    'rewritten',
+])
+
+
+class TransferRule(object):
+    '''
+    Selects the files of one kind from input protocols of a class.
+
+    With set_name, files(item) is called for each item added to that output
+    set since the previous tick. Without it, files(prot) is called on every
+    tick, for outputs that are rewritten in place; unchanged files are then
+    skipped by the transfer ledger. files returns (source path, destination
+    name) pairs. Lower priorities are sent first. Files of set items that
+    are not written yet go to pending, if given, since the set cursor does
+    not offer their item again.
+    '''
+
+    def __init__(self, kind, protocol_class, priority, files, set_name=None,
+                 compress=False):
+        self.kind = kind
+        self.protocol_class = protocol_class
+        self.priority = priority
+        self.files = files
+        self.set_name = set_name
+        self.compress = compress
+
+    def matches(self, prot):
+        return isinstance(prot, self.protocol_class)
+
+    def iter_items(self, prot, set_cursor, timed_iter=None, pending=None):
+        if self.set_name is None:
+            objects = [prot]
+        else:
+            objects = set_cursor.iter_new(prot, self.set_name)
+            if timed_iter is not None:
+                objects = timed_iter(objects, 'set_iteration')
+        for obj in objects:
+            for source, name in self.files(obj):
+                item = TransferItem(source, name, self.kind, self.priority,
+                                    self.compress, self.set_name is None)
+                if os.path.isfile(source):
+                    yield item
+                elif pending is not None and self.set_name is not None:
+                    pending.add(item)
+
+
+class PendingFiles(object):
+    '''
+    Files of set items that were not on disk when the item was added, e.g.
+    CTF outputs written after the micrograph appears in the set. ready()
+    returns them once they are written; those still missing after timeout
+    seconds are forgotten.
+    '''
+
+    def __init__(self, timeout=3600):
+        self.timeout = timeout
+        self._items = dict()  # Source -> (TransferItem, time first missed)
+
+    def __len__(self):
+        return len(self._items)
+
+    def add(self, item):
+        if item.source not in self._items:
+            self._items[item.source] = (item, time.time())
+
+    def ready(self):
+        now = time.time()
+        ready = []
+        for source, (item, missed) in list(self._items.items()):
+            if os.path.isfile(source):
+                ready.append(item)
+            elif missed > now - self.timeout:
+                continue
+            del self._items[source]
+        return ready
+
+
+def own_name(path):
+    return [(path, os.path.basename(path))]
+
+
+def prefixed_name(path):
+    '''
+    Names a file after its directory too, for outputs written as
+    <movie>/<fixed name>
+    '''
+    return [(path, '{}_{}'.format(
+        os.path.basename(os.path.dirname(path)), os.path.basename(path)))]
@@ -0,0 +1,347 @@
+import heapq
+import itertools
+import threading
+import time
+from collections import namedtuple
+
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty  # noqa
+
+TransferResult = namedtuple('TransferResult', [
+    'key',
+    'success',
+    'attempts',
+    'bytes',
+    'prepare_time',
+    'send_time',
+    'error',
+    'resubmits',  # Times the job had been given up and queued again
+])
+
+
+class TokenBucket(object):
+    '''
+    Byte budget shared by all transfers, refilled at rate bytes per second.
+
+    consume() reserves bytes straight away and sleeps for as long as the
+    bucket is in debt, so concurrent senders are throttled in proportion to
+    what they ask for and the total never exceeds rate plus one burst.
+    '''
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else rate)
+        self._tokens = self.burst
+        self._last = time.time()
+        self._lock = threading.Lock()
+        self.slots = 0  # Concurrent transfers sharing the bucket
+
+    def consume(self, n):
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst,
+                               self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= n
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+    def attach(self, slots):
+        '''
+        Counts slots more concurrent transfers sharing the bucket
+        '''
+        with self._lock:
+            self.slots += slots
+
+    def share(self, slots=None):
+        '''
+        Rate each of slots external transfer processes may use, by default
+        all the transfers attached to the bucket
+        '''
+        return self.rate / max(1, self.slots if slots is None else slots)
+
+
+class AgingQueue(object):
+    '''
+    Thread-safe priority queue, lowest priority first, in which waiting
+    items gain one priority level every aging seconds, so that a steady
+    stream of urgent items cannot starve the rest.
+
+    All queued items age at the same rate, so the order only depends on
+    priority + enqueue time / aging and a plain heap keeps it.
+    '''
+
+    def __init__(self, aging=None):
+        self.aging = aging
+        self._heap = []
+        self._counter = itertools.count()
+        self._not_empty = threading.Condition(threading.Lock())
+
+    def put(self, item, priority=0):
+        rank = priority + (time.time() / self.aging if self.aging else 0)
+        with self._not_empty:
+            heapq.heappush(self._heap, (rank, next(self._counter), item))
+            self._not_empty.notify()
+
+    def get(self):
+        with self._not_empty:
+            while not self._heap:
+                self._not_empty.wait()
+            return heapq.heappop(self._heap)[2]
+
+    def __len__(self):
+        with self._not_empty:
+            return len(self._heap)
+
+
+class TransferScheduler(object):
+    '''
+    Runs file transfers in background threads.
+
+    Each job goes through prepare(key), which returns the artifact to send
+    or None when there is nothing left to send, and then through
+    send(key, artifact, rate_limit), which returns the number of bytes sent
+    or None on failure. Preparation runs in its own workers, so the next
+    files are compressed while earlier ones are being sent, and at most
+    max_prepared prepared artifacts wait for a free send slot. Jobs are
+    prepared in priority order with aging, see AgingQueue. The sends are
+    throttled by bucket, which several schedulers may share, or else by a
+    bucket of their own refilled at bandwidth bytes per second. Failed jobs
+    are retried with exponential backoff; jobs that run out of retries are
+    kept and queued again by resubmit_given_up(), so an outage longer than
+    the backoff does not lose them, up to max_resubmits times so that a job
+    that can never succeed is eventually dropped.
+    '''
+
+    def __init__(self, prepare, send, slots=2, prepare_workers=1,
+                 bandwidth=None, retries=3, backoff=30, max_backoff=600,
+                 max_prepared=None, aging=None, on_finish=None,
+                 bucket=None, max_resubmits=12):
+        self.prepare = prepare
+        self.send = send
+        self.on_finish = on_finish  # Called with each TransferResult
+        self.slots = max(1, slots)
+        self.prepare_workers = max(1, prepare_workers)
+        self.bucket = bucket if bucket is not None else \
+            TokenBucket(bandwidth) if bandwidth else None
+        if self.bucket is not None:
+            self.bucket.attach(self.slots)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_resubmits = max_resubmits
+
+        self._prepare_queue = AgingQueue(aging)
+        self._send_queue = Queue(max_prepared or self.slots)
+        self._results = Queue()
+
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        #  Key -> [attempts, prepare time, priority, resubmits]
+        self._in_flight = dict()
+        self._given_up = dict()  # Key -> (priority, time, resubmits)
+        self._timers = set()
+        self._threads = []
+        self._stopping = False
+
+    def start(self):
+        for _ in range(self.prepare_workers):
+            self._spawn(self._prepare_loop)
+        for _ in range(self.slots):
+            self._spawn(self._send_loop)
+
+    def _spawn(self, target):
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+
+    def rate_limit(self):
+        '''
+        Bytes per second a single send may use, or None if unlimited
+        '''
+        return self.bucket.share() if self.bucket else None
+
+    def submit(self, key, priority=0):
+        '''
+        Queues key unless it is already being transferred; never blocks.
+        Lower priorities are prepared first.
+        '''
+        return self._submit(key, priority, 0)
+
+    def _submit(self, key, priority, resubmits):
+        with self._lock:
+            if key in self._in_flight or self._stopping:
+                return False
+            self._given_up.pop(key, None)
+            self._in_flight[key] = [0, 0., priority, resubmits]
+        self._prepare_queue.put(key, priority)
+        return True
+
+    def resubmit_given_up(self, delay=None, keep=None):
+        '''
+        Queues again the jobs that ran out of retries at least delay
+        seconds ago, max_backoff by default; returns how many. Jobs already
+        queued again max_resubmits times, or for which keep(key) is False,
+        are dropped instead.
+        '''
+        delay = self.max_backoff if delay is None else delay
+        now = time.time()
+        with self._lock:
+            due = [(key, priority, resubmits) for key, (
+                priority, given_up, resubmits) in self._given_up.items()
+                if given_up <= now - delay]
+        resubmitted = 0
+        for key, priority, resubmits in due:
+            if resubmits >= self.max_resubmits or \
+                    (keep is not None and not keep(key)):
+                with self._lock:
+                    self._given_up.pop(key, None)
+            elif self._submit(key, priority, resubmits + 1):
+                resubmitted += 1
+        return resubmitted
+
+    def pending(self):
+        with self._lock:
+            return len(self._in_flight)
+
+    def queued(self):
+        '''
+        Returns the keys of the jobs not finished yet
+        '''
+        with self._lock:
+            return list(self._in_flight)
+
+    def _prepare_loop(self):
+        while True:
+            key = self._prepare_queue.get()
+            if key is None:
+                return
+            if self._stopping:
+                self._finish(key, False, 0, error='stopped')
+                continue
+            start = time.time()
+            try:
+                artifact = self.prepare(key)
+            except Exception as e:
+                self._failed(key, e)
+                continue
+            with self._lock:
+                self._in_flight[key][1] += time.time() - start
+            if artifact is None:
+                self._finish(key, True, 0)
+            else:
+                self._send_queue.put((key, artifact))
+
+    def _send_loop(self):
+        while True:
+            job = self._send_queue.get()
+            if job is None:
+                return
+            key, artifact = job
+            if self._stopping:
+                self._finish(key, False, 0, error='stopped')
+                continue
+            start = time.time()
+            try:
+                sent = self.send(key, artifact, self.rate_limit())
+            except Exception as e:
+                sent, error = None, e
+            else:
+                error = None
+            if sent is None:
+                self._failed(key, error)
+            else:
+                self._finish(key, True, sent, time.time() - start)
+
+    def _failed(self, key, error):
+        with self._lock:
+            self._in_flight[key][0] += 1
+            attempts = self._in_flight[key][0]
+            if self._stopping:
+                give_up = True
+            elif attempts > self.retries:
+                give_up = True
+                self._given_up[key] = (self._in_flight[key][2], time.time(),
+                                       self._in_flight[key][3])
+            else:
+                give_up = False
+                delay = min(self.max_backoff,
+                            self.backoff * 2 ** (attempts - 1))
+                timer = threading.Timer(delay, self._retry, [key])
+                timer.daemon = True
+                self._timers.add(timer)
+        if give_up:
+            self._finish(key, False, 0, error=error)
+        else:
+            timer.start()
+
+    def _retry(self, key):
+        with self._lock:
+            self._timers = set(t for t in self._timers if t.is_alive())
+            if self._stopping:
+                return
+            priority = self._in_flight[key][2]
+        self._prepare_queue.put(key, priority)
+
+    def _finish(self, key, success, sent, send_time=0., error=None):
+        with self._lock:
+            attempts, prepare_time, _, resubmits = self._in_flight.pop(key)
+            self._idle.notify_all()
+        result = TransferResult(
+            key, success, attempts + (1 if success else 0), sent,
+            prepare_time, send_time,
+            str(error) if error is not None else None, resubmits)
+        self._results.put(result)
+        if self.on_finish is not None:
+            self.on_finish(result)
+
+    def poll(self):
+        '''
+        Returns the jobs finished since the previous call
+        '''
+        results = []
+        while True:
+            try:
+                results.append(self._results.get_nowait())
+            except Empty:
+                return results
+
+    def drain(self, timeout=None):
+        '''
+        Waits until every queued job has finished, retries included;
+        returns False if timeout seconds passed first
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        with self._lock:
+            while self._in_flight:
+                remaining = None if deadline is None else \
+                    deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._idle.wait(remaining if remaining is not None else 1.)
+        return True
+
+    def stop(self):
+        '''
+        Cancels pending retries and stops the workers once the jobs they
+        are running finish
+        '''
+        with self._lock:
+            self._stopping = True
+            timers, self._timers = self._timers, set()
+        for timer in timers:
+            timer.cancel()
+        #  Preparation stops first so nothing is left waiting for a slot
+        for _ in range(self.prepare_workers):
+            self._prepare_queue.put(None, float('-inf'))
+        for thread in self._threads[:self.prepare_workers]:
+            thread.join()
+        for _ in range(self.slots):
+            self._send_queue.put(None)
+        for thread in self._threads[self.prepare_workers:]:
+            thread.join()
+        self._threads = []
@@ -0,0 +1,217 @@
+import os
+import json
+import threading
+import time
+from collections import defaultdict, deque
+
+#  (name, type, help) of each metric in the Prometheus textfile
+METRICS = [
+    ('scipion_transfer_queued_files', 'gauge',
+     'Files in each queue: preparation or sending to a destination'),
+    ('scipion_transfer_pending_bytes', 'gauge',
+     'Source bytes of the queued files'),
+    ('scipion_transfer_throughput_bytes', 'gauge',
+     'Bytes per second sent over the rolling window'),
+    ('scipion_transfer_eta_seconds', 'gauge',
+     'Estimated seconds until the queue is empty, -1 if unknown'),
+    ('scipion_transfer_files_total', 'counter',
+     'Files finished, by destination and result'),
+    ('scipion_transfer_bytes_total', 'counter',
+     'Bytes sent, by destination'),
+    ('scipion_transfer_source_bytes_total', 'counter',
+     'Source bytes of the files sent, by destination'),
+    ('scipion_transfer_compress_seconds_total', 'counter',
+     'Time spent compressing'),
+    ('scipion_transfer_send_seconds_total', 'counter',
+     'Time spent sending, by destination'),
+    ('scipion_transfer_retries_total', 'counter',
+     'Failed attempts that were retried, by destination'),
+]
+
+
+def _labels(**labels):
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+                         .replace('"', '\\"'))
+        for name, value in sorted(labels.items())))
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return 'unknown'
+    seconds = int(seconds)
+    return '{}:{:02d}:{:02d}'.format(
+        seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+class TransferTelemetry(object):
+    '''
+    Throughput and backlog records for the transfers of a monitor.
+
+    file_done() is called once per file and destination and may be called
+    from worker threads; tick() once per monitor tick with the state of the
+    queues. Both append a JSON line to output_file, with "record" set to
+    "file" or "tick". Each tick also rewrites prometheus_file, if given,
+    for the node exporter's textfile collector.
+
+    Throughput is measured over the files finished in the last window
+    seconds. The ETA divides the source bytes still queued by the rate at
+    which source bytes were cleared over the same window, so that it holds
+    whether or not files are compressed.
+    '''
+
+    def __init__(self, output_file, prometheus_file=None, window=300):
+        self.output_file = output_file
+        self.prometheus_file = prometheus_file
+        self.window = window
+        self.tick_count = 0
+        self._lock = threading.Lock()
+        self._recent = deque()  # (time, source bytes, bytes sent)
+        self._files = defaultdict(int)  # (destination, result) -> files
+        self._totals = defaultdict(float)  # (metric, destination) -> sum
+        self._finished = 0  # Files finished since the previous tick
+        directory = os.path.dirname(output_file)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _write(self, record):
+        with open(self.output_file, 'a') as OUTPUT:
+            OUTPUT.write(json.dumps(record, sort_keys=True) + '\n')
+
+    def file_done(self, name, kind, destination, success, bytes_in=0,
+                  bytes_out=0, compress_time=None, transfer_time=0.,
+                  retries=0, error=None):
+        '''
+        Records one file sent to, or given up on for, destination.
+        bytes_in is the size of the source, bytes_out what went over the
+        network; compress_time is None if compression was not timed apart
+        from the transfer, as when streaming.
+        '''
+        now = time.time()
+        record = {
+            'record': 'file',
+            'time': now,
+            'name': name,
+            'kind': kind,
+            'destination': destination,
+            'success': success,
+            'bytes_in': bytes_in,
+            'bytes_out': bytes_out,
+            'compress_time': compress_time,
+            'transfer_time': transfer_time,
+            'retries': retries,
+        }
+        if error is not None:
+            record['error'] = error
+        with self._lock:
+            self._finished += 1
+            self._files[(destination, 'sent' if success else 'failed')] += 1
+            self._totals[('retries', destination)] += retries
+            self._totals[('send_seconds', destination)] += transfer_time
+            self._totals[('compress_seconds', None)] += compress_time or 0.
+            if success:
+                self._recent.append((now, bytes_in, bytes_out))
+                self._totals[('bytes', destination)] += bytes_out
+                self._totals[('source_bytes', destination)] += bytes_in
+            self._write(record)
+
+    def throughput(self, now=None):
+        '''
+        Returns (source bytes per second, bytes sent per second) over the
+        rolling window
+        '''
+        now = time.time() if now is None else now
+        with self._lock:
+            while self._recent and self._recent[0][0] < now - self.window:
+                self._recent.popleft()
+            if not self._recent:
+                return 0., 0.
+            #  A window not yet full is measured from its first file
+            span = min(self.window, max(1., now - self._recent[0][0]))
+            return sum(r[1] for r in self._recent) / span, \
+                sum(r[2] for r in self._recent) / span
+
+    def tick(self, queued, pending_bytes):
+        '''
+        Records the state of the queues; queued maps the name of each queue,
+        e.g. a destination, to its number of files. pending_bytes is the
+        source bytes still to be sent, counted once per destination.
+        Returns the record.
+        '''
+        now = time.time()
+        rate_in, rate_out = self.throughput(now)
+        with self._lock:
+            self.tick_count += 1
+            finished, self._finished = self._finished, 0
+            record = {
+                'record': 'tick',
+                'tick': self.tick_count,
+                'time': now,
+                'queued': dict(queued),
+                'queued_files': sum(queued.values()),
+                'pending_bytes': pending_bytes,
+                'finished_files': finished,
+                'throughput_in': rate_in,
+                'throughput_out': rate_out,
+                'eta': pending_bytes / rate_in if rate_in else
+                (0. if not pending_bytes else None),
+            }
+            self._write(record)
+            if self.prometheus_file is not None:
+                self._write_prometheus(record)
+        return record
+
+    def _write_prometheus(self, record):
+        '''
+        Rewrites the textfile; the lock must be held
+        '''
+        samples = defaultdict(list)
+        for queue, n in sorted(record['queued'].items()):
+            samples['scipion_transfer_queued_files'].append(
+                (_labels(queue=queue), n))
+        samples['scipion_transfer_pending_bytes'].append(
+            ('', record['pending_bytes']))
+        samples['scipion_transfer_throughput_bytes'].append(
+            (_labels(side='source'), record['throughput_in']))
+        samples['scipion_transfer_throughput_bytes'].append(
+            (_labels(side='network'), record['throughput_out']))
+        samples['scipion_transfer_eta_seconds'].append(
+            ('', record['eta'] if record['eta'] is not None else -1))
+        for (destination, result), n in sorted(self._files.items()):
+            samples['scipion_transfer_files_total'].append(
+                (_labels(destination=destination, result=result), n))
+        for (metric, destination), value in sorted(
+                self._totals.items(), key=lambda x: (x[0][0], str(x[0][1]))):
+            labels = _labels(destination=destination) \
+                if destination is not None else ''
+            samples['scipion_transfer_{}_total'.format(metric)].append(
+                (labels, value))
+
+        lines = []
+        for name, kind, description in METRICS:
+            if not samples[name]:
+                continue
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, value in samples[name]:
+                lines.append('{}{} {}'.format(name, labels, float(value)))
+
+        #  The collector must never read a half-written file
+        tmp_file = self.prometheus_file + '.tmp'
+        with open(tmp_file, 'w') as OUTPUT:
+            OUTPUT.write('\n'.join(lines) + '\n')
+        os.rename(tmp_file, self.prometheus_file)
+
+
+def summarize_telemetry(record):
+    '''
+    Formats a tick record as a one-line summary for notifiers
+    '''
+    return 'Transfer: {} files ({:.2f} GB) queued, {:.1f} MB/s sent, ' \
+        '{:.1f} MB/s of source cleared, ETA {}.'.format(
+            record['queued_files'], record['pending_bytes'] / 1024. ** 3,
+            record['throughput_out'] / 1024. ** 2,
+            record['throughput_in'] / 1024. ** 2,
+            format_duration(record['eta']))
@@ -0,0 +1,151 @@
+import os
+import json
+import random
+import threading
+import time
+
+WINDOWS = [1, 2, 4, 8, 16, 32, 64]  # bbcp -w, in MB
+STREAMS = [1, 2, 4, 8, 16, 32]  # bbcp -s
+DEFAULT = (8, 16)
+
+#  Coarse subset of the grid measured by a calibration sweep
+CALIBRATION_SETTINGS = [(w, s) for w in (2, 8, 32) for s in (1, 4, 16)]
+
+#  Transfers smaller than this finish too quickly to say much
+MIN_BYTES = 64 * 1024 * 1024
+
+
+class TransferTuner(object):
+    '''
+    Learns the bbcp window size and stream count that give the best
+    throughput to each destination host.
+
+    Throughput of each setting is tracked as an exponentially weighted mean
+    of MB/s. Each host sits at a current setting and moves to a neighbour
+    on the (window, streams) grid once that neighbour does better, i.e.
+    hill-climbing; with probability epsilon a transfer tries a neighbour
+    instead, preferring ones not measured yet. What is learnt is saved to
+    state_file after every measurement.
+    '''
+
+    def __init__(self, state_file, epsilon=0.1, alpha=0.3, margin=0.05):
+        self.state_file = state_file
+        self.epsilon = epsilon
+        self.alpha = alpha
+        self.margin = margin
+        self._lock = threading.Lock()
+        self._hosts = dict()  # Host -> {'current': [w, s], 'stats': {...}}
+        if os.path.isfile(state_file):
+            with open(state_file) as f:
+                self._hosts = json.load(f)
+
+    @staticmethod
+    def _key(setting):
+        return '{},{}'.format(*setting)
+
+    def _host(self, host):
+        return self._hosts.setdefault(host, {
+            'current': list(DEFAULT),
+            'stats': dict(),  # "w,s" -> [mean MB/s, measurements]
+        })
+
+    @staticmethod
+    def neighbours(setting):
+        window, streams = setting
+        if window not in WINDOWS or streams not in STREAMS:
+            return []
+        i, j = WINDOWS.index(window), STREAMS.index(streams)
+        result = []
+        for di, dj in ((-1, 0), (1, 0), (0, -1), (0, 1)):
+            if 0 <= i + di < len(WINDOWS) and 0 <= j + dj < len(STREAMS):
+                result.append((WINDOWS[i + di], STREAMS[j + dj]))
+        return result
+
+    def choose(self, host):
+        '''
+        Returns the (window MB, streams) to use for the next transfer
+        '''
+        with self._lock:
+            state = self._host(host)
+            current = tuple(state['current'])
+            if random.random() >= self.epsilon:
+                return current
+            candidates = self.neighbours(current)
+            if not candidates:
+                return current
+            unmeasured = [c for c in candidates
+                          if self._key(c) not in state['stats']]
+            return random.choice(unmeasured or candidates)
+
+    def record(self, host, setting, size, seconds):
+        '''
+        Adds the throughput of one transfer and moves the host's current
+        setting to a better neighbour if there is one
+        '''
+        if size < MIN_BYTES or seconds <= 0:
+            return
+        rate = size / 1024. / 1024. / seconds
+        with self._lock:
+            state = self._host(host)
+            key = self._key(setting)
+            mean, n = state['stats'].get(key, [rate, 0])
+            state['stats'][key] = [
+                (1 - self.alpha) * mean + self.alpha * rate, n + 1]
+
+            current = tuple(state['current'])
+            best, best_rate = current, self._mean(state, current)
+            for candidate in self.neighbours(current):
+                candidate_rate = self._mean(state, candidate)
+                if candidate_rate is not None and (
+                        best_rate is None or
+                        candidate_rate > best_rate * (1 + self.margin)):
+                    best, best_rate = candidate, candidate_rate
+            state['current'] = list(best)
+            self._save()
+
+    def _mean(self, state, setting):
+        stats = state['stats'].get(self._key(setting))
+        return stats[0] if stats else None
+
+    def calibrate(self, host, send, size, settings=None):
+        '''
+        Times send(window, streams) for each setting, which returns True on
+        success, and starts the host from the fastest one. Earlier
+        measurements of the settings tried are discarded. Returns
+        [(setting, MB/s or None)].
+        '''
+        results = []
+        for setting in settings or CALIBRATION_SETTINGS:
+            start = time.time()
+            ok = send(*setting)
+            seconds = time.time() - start
+            if not ok or seconds <= 0:
+                results.append((setting, None))
+                continue
+            rate = size / 1024. / 1024. / seconds
+            with self._lock:
+                self._host(host)['stats'][self._key(setting)] = [rate, 1]
+            results.append((setting, rate))
+
+        measured = [r for r in results if r[1] is not None]
+        if measured:
+            with self._lock:
+                self._host(host)['current'] = list(
+                    max(measured, key=lambda r: r[1])[0])
+                self._save()
+        return results
+
+    def best(self, host):
+        with self._lock:
+            state = self._host(host)
+            return tuple(state['current']), \
+                self._mean(state, state['current'])
+
+    def _save(self):
+        directory = os.path.dirname(self.state_file)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp_file = self.state_file + '.tmp'
+        with open(tmp_file, 'w') as OUTPUT:
+            json.dump(self._hosts, OUTPUT, indent=1, sort_keys=True)
+        os.rename(tmp_file, self.state_file)